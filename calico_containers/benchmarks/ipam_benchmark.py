@@ -0,0 +1,354 @@
+#!/usr/bin/python
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+IPAM throughput and contention benchmark.
+
+Simulates a number of hosts, each running a number of concurrent workers,
+assigning and releasing addresses through the IPAMClient against an in-memory
+etcd backend.  Each worker churns workloads: it assigns addresses (using
+auto_assign_ips, or assign_ip for a specific address), then later releases
+them (using release_ip_by_handle or release_ips).
+
+The results are written as JSON, containing per-operation throughput and
+latency percentiles, and the datastore load: etcd operations per allocated
+address and the rate of compare-and-swap conflicts.
+
+Usage (from the calico_containers directory):
+    python -m benchmarks.ipam_benchmark --hosts 10 --workers 4 \\
+        --output results.json
+"""
+
+import argparse
+import json
+import logging
+import math
+import random
+import sys
+import threading
+import time
+from timeit import default_timer
+
+from netaddr import IPNetwork
+
+from pycalico.datastore_datatypes import IPPool
+from pycalico.ipam import IPAMClient
+from pycalico.memory_etcd import MemoryEtcdClient, MemoryEtcdTxnClient
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+# Version of the results format.  Bump this if the format changes
+# incompatibly.
+RESULTS_VERSION = 1
+
+AUTO_ASSIGN = "auto_assign_ips"
+ASSIGN_IP = "assign_ip"
+RELEASE_IPS = "release_ips"
+RELEASE_BY_HANDLE = "release_ip_by_handle"
+OPERATIONS = (AUTO_ASSIGN, ASSIGN_IP, RELEASE_IPS, RELEASE_BY_HANDLE)
+
+# Datastore operations counted towards the etcd load.
+DATASTORE_OPERATIONS = ("read", "write", "delete", "txn")
+
+
+class _OperationStats(object):
+    """
+    Timings and errors for one type of IPAM operation.
+    """
+    def __init__(self):
+        self.latencies = []
+        self.errors = {}
+
+    def record(self, latency, error=None):
+        self.latencies.append(latency)
+        if error is not None:
+            name = type(error).__name__
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        for name, count in other.errors.iteritems():
+            self.errors[name] = self.errors.get(name, 0) + count
+
+    def summary(self, duration):
+        """
+        :param duration: The wall clock duration of the run in seconds.
+        :return: A dict summarizing the operation.
+        """
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        return {
+            "count": count,
+            "errors": dict(self.errors),
+            "ops_per_sec": count / duration if duration else 0.0,
+            "mean_ms": 1000.0 * sum(latencies) / count if count else 0.0,
+            "p50_ms": 1000.0 * _percentile(latencies, 50),
+            "p99_ms": 1000.0 * _percentile(latencies, 99),
+            "max_ms": 1000.0 * latencies[-1] if count else 0.0,
+        }
+
+
+def _percentile(values, percentile):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percentile / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+class _Worker(object):
+    """
+    A simulated workload orchestrator on a host, churning address
+    assignments.
+    """
+    def __init__(self, client, host, worker_id, pool, iterations, rng,
+                 addresses_per_workload, max_workloads, release_ratio,
+                 assign_ip_ratio):
+        self.client = client
+        self.host = host
+        self.worker_id = worker_id
+        self.pool = pool
+        self.iterations = iterations
+        self.rng = rng
+        self.addresses_per_workload = addresses_per_workload
+        self.max_workloads = max_workloads
+        self.release_ratio = release_ratio
+        self.assign_ip_ratio = assign_ip_ratio
+        self.stats = dict((op, _OperationStats()) for op in OPERATIONS)
+        self.allocated = 0
+
+        # The workloads currently running, as (handle_id, [addresses]).
+        self.workloads = []
+
+    def run(self):
+        for iteration in xrange(self.iterations):
+            if self.workloads and \
+                    (len(self.workloads) >= self.max_workloads or
+                     self.rng.random() < self.release_ratio):
+                self._release()
+            else:
+                self._assign("%s-%s-%s" % (self.host, self.worker_id,
+                                           iteration))
+
+    def _assign(self, handle_id):
+        if self.rng.random() < self.assign_ip_ratio:
+            address = self.pool[self.rng.randrange(self.pool.size)]
+            # assign_ip returns None when it succeeds.
+            succeeded, _ = self._timed(ASSIGN_IP, self.client.assign_ip,
+                                       address, handle_id, {},
+                                       host=self.host)
+            addresses = [address] if succeeded else []
+        else:
+            succeeded, result = self._timed(AUTO_ASSIGN,
+                                            self.client.auto_assign_ips,
+                                            self.addresses_per_workload, 0,
+                                            handle_id, {}, host=self.host)
+            addresses = result[0] if succeeded else []
+        if addresses:
+            self.allocated += len(addresses)
+            self.workloads.append((handle_id, addresses))
+
+    def _release(self):
+        index = self.rng.randrange(len(self.workloads))
+        handle_id, addresses = self.workloads.pop(index)
+        if self.rng.random() < 0.5:
+            self._timed(RELEASE_BY_HANDLE, self.client.release_ip_by_handle,
+                        handle_id)
+        else:
+            self._timed(RELEASE_IPS, self.client.release_ips, set(addresses))
+
+    def _timed(self, operation, fn, *args, **kwargs):
+        """
+        Time a single IPAM operation.
+
+        :return: A tuple of (succeeded, result), where result is the result
+        of the operation, or None if it failed.
+        """
+        start = default_timer()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            # Failures are expected (for example AlreadyAssignedError when
+            # assigning a random address) and are counted by type.
+            _log.debug("%s failed: %r", operation, e)
+            self.stats[operation].record(default_timer() - start, e)
+            return False, None
+        self.stats[operation].record(default_timer() - start)
+        return True, result
+
+
+def run_benchmark(hosts=4, workers=4, iterations=200, pool="10.0.0.0/16",
+                  latency=0.001, jitter=0.0, addresses_per_workload=1,
+                  max_workloads=20, release_ratio=0.3, assign_ip_ratio=0.1,
+                  seed=0, transactions=False):
+    """
+    Run the IPAM benchmark.
+
+    :param hosts: Number of simulated hosts.
+    :param workers: Number of concurrent workers per host.
+    :param iterations: Number of assign or release operations per worker.
+    :param pool: The IPv4 pool CIDR to assign from.
+    :param latency: The simulated etcd round trip time in seconds.
+    :param jitter: Maximum random variation added to the latency in seconds.
+    :param addresses_per_workload: Addresses assigned per auto-assignment.
+    :param max_workloads: Maximum number of workloads held by each worker.
+    A worker at the maximum releases a workload rather than assigning.
+    :param release_ratio: Probability of releasing (rather than assigning)
+    when below the maximum.
+    :param assign_ip_ratio: Probability an assignment uses assign_ip for a
+    random address, rather than auto_assign_ips.
+    :param seed: Random seed, for repeatable runs.
+    :param transactions: Whether the datastore supports multi-key
+    transactions, as the etcd v3 backend does.
+    :return: The results, as a JSON serializable dict.
+    """
+    if jitter:
+        jitter_rng = random.Random(seed)
+        delay = lambda: latency + jitter_rng.uniform(0, jitter)
+    else:
+        delay = latency
+    etcd_client_class = MemoryEtcdTxnClient if transactions else \
+        MemoryEtcdClient
+    etcd_client = etcd_client_class(latency=delay)
+    pool_cidr = IPNetwork(pool)
+    IPAMClient(etcd_client=etcd_client).add_ip_pool(4, IPPool(pool_cidr))
+
+    # Measure datastore load of the run only, not the set up.
+    start_stats = etcd_client.stats.copy()
+
+    run_workers = []
+    for host_index in xrange(hosts):
+        host = "host%s" % host_index
+        for worker_index in xrange(workers):
+            rng = random.Random("%s-%s-%s" % (seed, host_index,
+                                              worker_index))
+            run_workers.append(_Worker(IPAMClient(etcd_client=etcd_client),
+                                       host, worker_index, pool_cidr,
+                                       iterations, rng,
+                                       addresses_per_workload, max_workloads,
+                                       release_ratio, assign_ip_ratio))
+
+    threads = [threading.Thread(target=worker.run) for worker in run_workers]
+    start = default_timer()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = default_timer() - start
+
+    stats = dict((op, _OperationStats()) for op in OPERATIONS)
+    total = _OperationStats()
+    for worker in run_workers:
+        for op, op_stats in worker.stats.iteritems():
+            stats[op].merge(op_stats)
+            total.merge(op_stats)
+    allocated = sum(worker.allocated for worker in run_workers)
+
+    datastore = dict((op, etcd_client.stats[op] - start_stats[op])
+                     for op in DATASTORE_OPERATIONS + ("cas_failures",))
+    datastore_ops = sum(datastore[op] for op in DATASTORE_OPERATIONS)
+    writes = datastore["write"] + datastore["delete"] + datastore["txn"]
+    datastore["total"] = datastore_ops
+    datastore["cas_conflict_rate"] = \
+        float(datastore["cas_failures"]) / writes if writes else 0.0
+    datastore["ops_per_allocation"] = \
+        float(datastore_ops) / allocated if allocated else 0.0
+
+    return {
+        "version": RESULTS_VERSION,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "config": {
+            "hosts": hosts,
+            "workers_per_host": workers,
+            "iterations": iterations,
+            "pool": str(pool_cidr),
+            "latency": latency,
+            "jitter": jitter,
+            "addresses_per_workload": addresses_per_workload,
+            "max_workloads": max_workloads,
+            "release_ratio": release_ratio,
+            "assign_ip_ratio": assign_ip_ratio,
+            "seed": seed,
+            "transactions": transactions,
+        },
+        "duration_s": duration,
+        "addresses_allocated": allocated,
+        "operations": dict((op, stats[op].summary(duration))
+                           for op in OPERATIONS),
+        "total": total.summary(duration),
+        "datastore": datastore,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark IPAM throughput and contention against an "
+                    "in-memory etcd.")
+    parser.add_argument("--hosts", type=int, default=4,
+                        help="number of simulated hosts")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="concurrent workers per host")
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="operations per worker")
+    parser.add_argument("--pool", default="10.0.0.0/16",
+                        help="IPv4 pool to assign from")
+    parser.add_argument("--latency-ms", type=float, default=1.0,
+                        help="simulated etcd round trip time")
+    parser.add_argument("--jitter-ms", type=float, default=0.0,
+                        help="maximum random variation of the latency")
+    parser.add_argument("--addresses-per-workload", type=int, default=1,
+                        help="addresses per auto-assignment")
+    parser.add_argument("--max-workloads", type=int, default=20,
+                        help="maximum workloads held by each worker")
+    parser.add_argument("--release-ratio", type=float, default=0.3,
+                        help="probability of releasing a workload")
+    parser.add_argument("--assign-ip-ratio", type=float, default=0.1,
+                        help="probability of assigning a specific address")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed")
+    parser.add_argument("--txn", action="store_true",
+                        help="use a datastore with multi-key transactions")
+    parser.add_argument("--output", default="-",
+                        help="file to write the JSON results to "
+                             "(default: stdout)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(hosts=args.hosts,
+                            workers=args.workers,
+                            iterations=args.iterations,
+                            pool=args.pool,
+                            latency=args.latency_ms / 1000.0,
+                            jitter=args.jitter_ms / 1000.0,
+                            addresses_per_workload=(
+                                args.addresses_per_workload),
+                            max_workloads=args.max_workloads,
+                            release_ratio=args.release_ratio,
+                            assign_ip_ratio=args.assign_ip_ratio,
+                            seed=args.seed,
+                            transactions=args.txn)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if args.output == "-":
+        print output
+    else:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
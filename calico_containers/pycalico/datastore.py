@@ -12,8 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import base64
+import collections
 import json
+import logging
 import os
+import sys
+import threading
+import time
 import uuid
 import etcd
 import re
@@ -24,7 +30,14 @@ from pycalico.datastore_datatypes import Rules, BGPPeer, IPPool, \
     Endpoint, Profile, Rule, IF_PREFIX, IPAMConfig, Policy
 from pycalico.datastore_errors import DataStoreError, \
     ProfileNotInEndpoint, ProfileAlreadyInEndpoint, MultipleEndpointsMatch
-from pycalico.util import get_hostname, validate_hostname_port
+from pycalico import metrics
+from pycalico.etcdv3 import EtcdV3Client
+from pycalico.util import get_hostname, map_concurrently, \
+    validate_hostname_port
+from pycalico.watch import TreeWatcher
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
 
 ETCD_AUTHORITY_DEFAULT = "127.0.0.1:2379"
 ETCD_AUTHORITY_ENV = "ETCD_AUTHORITY"
@@ -37,6 +50,33 @@ ETCD_KEY_FILE_ENV = "ETCD_KEY_FILE"
 ETCD_CERT_FILE_ENV = "ETCD_CERT_FILE"
 ETCD_CA_CERT_FILE_ENV = "ETCD_CA_CERT_FILE"
 
+# The etcd API used to access the datastore.  The v3 API (through the etcd v3
+# JSON gateway) lets IPAM update blocks and handles in single transactions.
+ETCD_API_ENV = "ETCD_API"
+ETCD_API_V2 = "v2"
+ETCD_API_V3 = "v3"
+ETCD_API_DEFAULT = ETCD_API_V2
+
+# The maximum number of connections pooled for each etcd host.
+ETCD_POOL_SIZE_ENV = "ETCD_POOL_SIZE"
+ETCD_POOL_SIZE_DEFAULT = 10
+
+# The environment variables (and their defaults) configuring the etcd client.
+_ETCD_CLIENT_ENVS = ((ETCD_ENDPOINTS_ENV, ''),
+                     (ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT),
+                     (ETCD_SCHEME_ENV, ETCD_SCHEME_DEFAULT),
+                     (ETCD_KEY_FILE_ENV, ''),
+                     (ETCD_CERT_FILE_ENV, ''),
+                     (ETCD_CA_CERT_FILE_ENV, ''),
+                     (ETCD_API_ENV, ETCD_API_DEFAULT),
+                     (ETCD_POOL_SIZE_ENV, ETCD_POOL_SIZE_DEFAULT))
+
+# The shared etcd clients, keyed off the process ID and the values of
+# _ETCD_CLIENT_ENVS.  The process ID is included so that a forked process
+# does not share connections with its parent.
+_etcd_clients = {}
+_etcd_clients_lock = threading.Lock()
+
 # etcd paths for Calico workloads, endpoints and IPAM.
 CALICO_V_PATH = "/calico/v1"
 CONFIG_PATH = CALICO_V_PATH + "/config/"
@@ -54,11 +94,28 @@ PROFILES_PATH = CALICO_V_PATH + "/policy/profile/"
 PROFILE_PATH = PROFILES_PATH + "%(profile_id)s/"
 TAGS_PATH = PROFILE_PATH + "tags"
 RULES_PATH = PROFILE_PATH + "rules"
-TIER_PATH = CALICO_V_PATH + "/policy/tier/%(tier_name)s"
+TIERS_PATH = CALICO_V_PATH + "/policy/tier/"
+TIER_PATH = TIERS_PATH + "%(tier_name)s"
 POLICY_PATH = TIER_PATH + "/policy/%(policy_name)s/"
 IP_POOLS_PATH = CALICO_V_PATH + "/ipam/v%(version)s/pool/"
 IP_POOL_KEY = IP_POOLS_PATH + "%(pool)s"
 
+# Secondary indexes of the endpoints, maintained by DatastoreClients with
+# endpoint indexing enabled.  Each index entry is a key, named by the encoded
+# endpoint key, in a directory named by the encoded indexed value, with the
+# time it was written as its value.  The ready key is written once the indexes
+# have been built for the existing endpoints.
+ENDPOINT_INDEX_PATH = "/calico/index/v1/endpoint/"
+ENDPOINT_INDEX_READY_PATH = ENDPOINT_INDEX_PATH + "ready"
+ENDPOINT_INDEX_WORKLOAD_PATH = ENDPOINT_INDEX_PATH + "workload/%(workload_id)s/"
+ENDPOINT_INDEX_IP_PATH = ENDPOINT_INDEX_PATH + "ip/%(ip)s/"
+ENDPOINT_INDEX_LABEL_PATH = ENDPOINT_INDEX_PATH + "label/%(key)s/%(value)s/"
+ENDPOINT_INDEX_PROFILE_PATH = ENDPOINT_INDEX_PATH + "profile/%(profile_id)s/"
+
+# The time, in seconds, for which an index entry for an endpoint that does not
+# exist is kept, since the endpoint may be about to be written.
+ENDPOINT_INDEX_GRACE = 60
+
 # Felix IPv4 host value.
 # @TODO This is a throw-back to the previous datamodel, and the field is badly
 # @TODO named.  New PR will sort out the naming in calico-docker and felix.
@@ -110,6 +167,20 @@ DEFAULT_LOG_FILE_PATH = "none"
 IP_IN_IP_DISABLED = "false"
 IP_IN_IP_ENABLED = "true"
 
+# The default maximum number of endpoints written or removed in parallel by
+# the batch endpoint APIs.
+MAX_CONCURRENT_ENDPOINTS = 10
+
+# The maximum number of independent writes made in parallel when
+# bootstrapping the global and host configuration.
+MAX_CONCURRENT_CONFIG_WRITES = 10
+
+# Per-endpoint results of the batch endpoint APIs.
+ENDPOINT_OK = "ok"
+ENDPOINT_CONFLICT = "conflict"
+ENDPOINT_NOT_FOUND = "not-found"
+ENDPOINT_ERROR = "error"
+
 # IPAM paths
 IPAM_V_PATH = "/calico/ipam/v2/"
 IPAM_CONFIG_PATH = IPAM_V_PATH + "config"
@@ -118,6 +189,8 @@ IPAM_HOST_PATH = IPAM_HOSTS_PATH + "/%(host)s"
 IPAM_HOST_AFFINITY_PATH = IPAM_HOST_PATH + "/ipv%(version)d/block/"
 IPAM_BLOCK_PATH = IPAM_V_PATH + "assignment/ipv%(version)d/block/"
 IPAM_HANDLE_PATH = IPAM_V_PATH + "handle/"
+IPAM_HANDLE_SHARDS_PATH = IPAM_V_PATH + "handle-shard/"
+IPAM_HANDLE_SHARD_PATH = IPAM_HANDLE_SHARDS_PATH + "%(shard)s/"
 
 
 def handle_errors(fn):
@@ -128,174 +201,298 @@ def handle_errors(fn):
     :return: The decorated function.
     """
     def wrapped(*args, **kwargs):
-        try:
-            return fn(*args, **kwargs)
-        except etcd.EtcdException as e:
-            # Don't leak out etcd exceptions.
-            raise DataStoreError("%s: Error accessing etcd (%s).  Is etcd "
-                                 "running?" % (fn.__name__, e.message))
+        with metrics.api_call(fn.__name__):
+            try:
+                return fn(*args, **kwargs)
+            except etcd.EtcdException as e:
+                # Don't leak out etcd exceptions.
+                raise _datastore_error(fn.__name__, e)
     return wrapped
 
 
+def _datastore_error(name, e):
+    """
+    :param name: The name of the Datastore API method.
+    :param e: The etcd exception hit by the method.
+    :return: The DataStoreError to report in place of the etcd exception.
+    """
+    return DataStoreError("%s: Error accessing etcd (%s).  Is etcd "
+                          "running?" % (name, e.message))
+
+
+def get_etcd_client():
+    """
+    Get the etcd client for the etcd environment variables.  This is a
+    python-etcd Client or, if the ETCD_API environment variable is "v3", an
+    EtcdV3Client.
+
+    Clients are shared by all of the DatastoreClients in the process with the
+    same etcd configuration, so that connections to etcd (and TLS sessions)
+    are pooled and reused, rather than created for each DatastoreClient.  The
+    ETCD_POOL_SIZE environment variable sets the maximum number of
+    connections kept to each etcd host.
+
+    :return: The etcd client.
+    """
+    key = (os.getpid(),) + tuple(os.getenv(env, default) for env, default in
+                                 _ETCD_CLIENT_ENVS)
+    with _etcd_clients_lock:
+        etcd_client = _etcd_clients.get(key)
+        if etcd_client is None:
+            etcd_client = _create_etcd_client()
+            _etcd_clients[key] = etcd_client
+        return etcd_client
+
+
+def clear_etcd_clients():
+    """
+    Discard the shared etcd clients, so that new clients (and connections)
+    are created for subsequent DatastoreClients.
+    """
+    with _etcd_clients_lock:
+        _etcd_clients.clear()
+
+
+def _create_etcd_client():
+    """
+    Create an etcd client from the etcd environment variables.
+
+    :return: The etcd client.
+    """
+    etcd_endpoints = os.getenv(ETCD_ENDPOINTS_ENV, '')
+    etcd_authority = os.getenv(ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT)
+    etcd_scheme = os.getenv(ETCD_SCHEME_ENV, ETCD_SCHEME_DEFAULT)
+    etcd_key = os.getenv(ETCD_KEY_FILE_ENV, '')
+    etcd_cert = os.getenv(ETCD_CERT_FILE_ENV, '')
+    etcd_ca = os.getenv(ETCD_CA_CERT_FILE_ENV, '')
+    etcd_api = os.getenv(ETCD_API_ENV, ETCD_API_DEFAULT)
+    etcd_pool_size = os.getenv(ETCD_POOL_SIZE_ENV, ETCD_POOL_SIZE_DEFAULT)
+
+    addr_env = None
+    scheme_env = None
+    etcd_addrs_raw = []
+    if etcd_endpoints:
+        # ETCD_ENDPOINTS specified: use it to determine scheme and etcd
+        # location.
+        endpoints = [x.strip() for x in etcd_endpoints.split(",")]
+        try:
+            scheme = None
+            for e in endpoints:
+                s, a = e.split("://")
+                etcd_addrs_raw.append(a)
+                if scheme == None:
+                    scheme = s
+                else:
+                    if scheme != s:
+                        raise DataStoreError(
+                            "Inconsistent protocols in %s.  Value "
+                            "provided is '%s'" %
+                            (ETCD_ENDPOINTS_ENV, etcd_endpoints)
+                        )
+            etcd_scheme = scheme
+            addr_env = ETCD_ENDPOINTS_ENV
+            scheme_env = ETCD_ENDPOINTS_ENV
+        except ValueError:
+            raise DataStoreError("Invalid %s. It must take the form"
+                                 "'ENDPOINT[,ENDPOINT][,...]' where "
+                                 "ENDPOINT:='http[s]://ADDRESS:PORT'. "
+                                 "Value provided is '%s'" %
+                                 (ETCD_ENDPOINTS_ENV, etcd_endpoints))
+    else:
+        # ETCD_ENDPOINTS not specified, fall back to ETCD_AUTHORITY and
+        # ETCD_SCHEME instead.
+        etcd_addrs_raw.append(etcd_authority)
+        addr_env = ETCD_AUTHORITY_ENV
+        scheme_env = ETCD_SCHEME_ENV
+
+    etcd_addrs = []
+    for addr in etcd_addrs_raw:
+        if not validate_hostname_port(addr):
+            raise DataStoreError(
+                "Invalid %s. Address must take the form "
+                "<address>:<port>. Value provided is '%s'" %
+                (addr_env, addr)
+            )
+        (host, port) = addr.split(":", 1)
+        etcd_addrs.append((host, int(port)))
+
+    key_pair = (etcd_cert, etcd_key) if (etcd_cert and etcd_key) else None
+
+    if etcd_scheme == "https":
+        # key and certificate must be both specified or both not specified
+        if bool(etcd_key) != bool(etcd_cert):
+            raise DataStoreError("Invalid %s, %s combination. Key and "
+                                 "certificate must both be specified or "
+                                 "both be blank. Values provided: %s=%s, "
+                                 "%s=%s" % (ETCD_KEY_FILE_ENV,
+                                            ETCD_CERT_FILE_ENV,
+                                            ETCD_KEY_FILE_ENV, etcd_key,
+                                            ETCD_CERT_FILE_ENV, etcd_cert))
+        # Make sure etcd key and certificate are readable
+        if etcd_key and etcd_cert and not (os.path.isfile(etcd_key) and
+                                           os.access(etcd_key, os.R_OK) and
+                                           os.path.isfile(etcd_cert) and
+                                           os.access(etcd_cert, os.R_OK)):
+            raise DataStoreError("Cannot read %s and/or %s. Both must "
+                                 "be readable file paths. Values "
+                                 "provided: %s=%s, %s=%s" %
+                                 (ETCD_KEY_FILE_ENV,
+                                  ETCD_CERT_FILE_ENV,
+                                  ETCD_KEY_FILE_ENV, etcd_key,
+                                  ETCD_CERT_FILE_ENV, etcd_cert))
+        # Certificate Authority cert must be provided, check it's readable
+        if not etcd_ca or not (os.path.isfile(etcd_ca) and
+                               os.access(etcd_ca, os.R_OK)):
+            raise DataStoreError("Invalid %s. Certificate Authority "
+                                 "cert is required and must be a "
+                                 "readable file path. Value provided: "
+                                 "%s" % (ETCD_CA_CERT_FILE_ENV, etcd_ca))
+    elif etcd_scheme != "http":
+        raise DataStoreError("Invalid %s. Value must be one of: \"\", "
+                             "\"http\", \"https\". Value provided: %s" %
+                             (scheme_env, etcd_scheme))
+
+    # Set CA value to None if it is a None-value string
+    etcd_ca = None if not etcd_ca else etcd_ca
+
+    try:
+        etcd_pool_size = int(etcd_pool_size)
+        if etcd_pool_size < 1:
+            raise ValueError()
+    except ValueError:
+        raise DataStoreError("Invalid %s. Value must be a positive integer. "
+                             "Value provided: %s" %
+                             (ETCD_POOL_SIZE_ENV, etcd_pool_size))
+
+    if etcd_api == ETCD_API_V3:
+        return EtcdV3Client(host=tuple(etcd_addrs),
+                            protocol=etcd_scheme,
+                            cert=key_pair,
+                            ca_cert=etcd_ca,
+                            per_host_pool_size=etcd_pool_size)
+    elif etcd_api != ETCD_API_V2:
+        raise DataStoreError("Invalid %s. Value must be one of: \"%s\", "
+                             "\"%s\". Value provided: %s" %
+                             (ETCD_API_ENV, ETCD_API_V2, ETCD_API_V3,
+                              etcd_api))
+
+    # python-etcd Client requires a different invocation when there's only
+    # a single etcd host.
+    if len(etcd_addrs) > 1:
+        # Specify allow_reconnect when there are multiple endpoints, so
+        # python-etcd will try connecting to all of them if one fails.
+        return etcd.Client(host=tuple(etcd_addrs),
+                           protocol=etcd_scheme,
+                           cert=key_pair,
+                           ca_cert=etcd_ca,
+                           allow_reconnect=True,
+                           per_host_pool_size=etcd_pool_size)
+    else:
+        return etcd.Client(host=etcd_addrs[0][0],
+                           port=etcd_addrs[0][1],
+                           protocol=etcd_scheme,
+                           cert=key_pair,
+                           ca_cert=etcd_ca,
+                           per_host_pool_size=etcd_pool_size)
+
+
 class DatastoreClient(object):
     """
     An datastore client that exposes high level Calico operations needed by the
     calico CLI.
     """
 
-    def __init__(self):
-        etcd_endpoints = os.getenv(ETCD_ENDPOINTS_ENV, '')
-        etcd_authority = os.getenv(ETCD_AUTHORITY_ENV, ETCD_AUTHORITY_DEFAULT)
-        etcd_scheme = os.getenv(ETCD_SCHEME_ENV, ETCD_SCHEME_DEFAULT)
-        etcd_key = os.getenv(ETCD_KEY_FILE_ENV, '')
-        etcd_cert = os.getenv(ETCD_CERT_FILE_ENV, '')
-        etcd_ca = os.getenv(ETCD_CA_CERT_FILE_ENV, '')
-
-        addr_env = None
-        scheme_env = None
-        etcd_addrs_raw = []
-        if etcd_endpoints:
-            # ETCD_ENDPOINTS specified: use it to determine scheme and etcd
-            # location.
-            endpoints = [x.strip() for x in etcd_endpoints.split(",")]
-            try:
-                scheme = None
-                for e in endpoints:
-                    s, a = e.split("://")
-                    etcd_addrs_raw.append(a)
-                    if scheme == None:
-                        scheme = s
-                    else:
-                        if scheme != s:
-                            raise DataStoreError(
-                                "Inconsistent protocols in %s.  Value "
-                                "provided is '%s'" %
-                                (ETCD_ENDPOINTS_ENV, etcd_endpoints)
-                            )
-                etcd_scheme = scheme
-                addr_env = ETCD_ENDPOINTS_ENV
-                scheme_env = ETCD_ENDPOINTS_ENV
-            except ValueError:
-                raise DataStoreError("Invalid %s. It must take the form"
-                                     "'ENDPOINT[,ENDPOINT][,...]' where "
-                                     "ENDPOINT:='http[s]://ADDRESS:PORT'. "
-                                     "Value provided is '%s'" %
-                                     (ETCD_ENDPOINTS_ENV, etcd_endpoints))
-        else:
-            # ETCD_ENDPOINTS not specified, fall back to ETCD_AUTHORITY and
-            # ETCD_SCHEME instead.
-            etcd_addrs_raw.append(etcd_authority)
-            addr_env = ETCD_AUTHORITY_ENV
-            scheme_env = ETCD_SCHEME_ENV
-
-        etcd_addrs = []
-        for addr in etcd_addrs_raw:
-            if not validate_hostname_port(addr):
-                raise DataStoreError(
-                    "Invalid %s. Address must take the form "
-                    "<address>:<port>. Value provided is '%s'" %
-                    (addr_env, addr)
-                )
-            (host, port) = addr.split(":", 1)
-            etcd_addrs.append((host, int(port)))
-
-        key_pair = (etcd_cert, etcd_key) if (etcd_cert and etcd_key) else None
-
-        if etcd_scheme == "https":
-            # key and certificate must be both specified or both not specified
-            if bool(etcd_key) != bool(etcd_cert):
-                raise DataStoreError("Invalid %s, %s combination. Key and "
-                                     "certificate must both be specified or "
-                                     "both be blank. Values provided: %s=%s, "
-                                     "%s=%s" % (ETCD_KEY_FILE_ENV,
-                                                ETCD_CERT_FILE_ENV,
-                                                ETCD_KEY_FILE_ENV, etcd_key,
-                                                ETCD_CERT_FILE_ENV, etcd_cert))
-            # Make sure etcd key and certificate are readable
-            if etcd_key and etcd_cert and not (os.path.isfile(etcd_key) and
-                                               os.access(etcd_key, os.R_OK) and
-                                               os.path.isfile(etcd_cert) and
-                                               os.access(etcd_cert, os.R_OK)):
-                raise DataStoreError("Cannot read %s and/or %s. Both must "
-                                     "be readable file paths. Values "
-                                     "provided: %s=%s, %s=%s" %
-                                     (ETCD_KEY_FILE_ENV,
-                                      ETCD_CERT_FILE_ENV,
-                                      ETCD_KEY_FILE_ENV, etcd_key,
-                                      ETCD_CERT_FILE_ENV, etcd_cert))
-            # Certificate Authority cert must be provided, check it's readable
-            if not etcd_ca or not (os.path.isfile(etcd_ca) and
-                                   os.access(etcd_ca, os.R_OK)):
-                raise DataStoreError("Invalid %s. Certificate Authority "
-                                     "cert is required and must be a "
-                                     "readable file path. Value provided: "
-                                     "%s" % (ETCD_CA_CERT_FILE_ENV, etcd_ca))
-        elif etcd_scheme != "http":
-            raise DataStoreError("Invalid %s. Value must be one of: \"\", "
-                                 "\"http\", \"https\". Value provided: %s" %
-                                 (scheme_env, etcd_scheme))
-
-        # Set CA value to None if it is a None-value string
-        etcd_ca = None if not etcd_ca else etcd_ca
-
-        # python-etcd Client requires a different invocation when there's only
-        # a single etcd host.
-        if len(etcd_addrs) > 1:
-            # Specify allow_reconnect when there are multiple endpoints, so
-            # python-etcd will try connecting to all of them if one fails.
-            self.etcd_client = etcd.Client(host=tuple(etcd_addrs),
-                                           protocol=etcd_scheme,
-                                           cert=key_pair,
-                                           ca_cert=etcd_ca,
-                                           allow_reconnect=True)
-        else:
-            self.etcd_client = etcd.Client(host=etcd_addrs[0][0],
-                                           port=etcd_addrs[0][1],
-                                           protocol=etcd_scheme,
-                                           cert=key_pair,
-                                           ca_cert=etcd_ca)
+    def __init__(self, etcd_client=None, index_endpoints=False,
+                 cache_host_ips=False):
+        """
+        :param etcd_client: (optional) The datastore backend.  This may be any
+        object providing the read, write, update and delete methods of the
+        python-etcd Client with etcd v2 semantics, for example a
+        pycalico.memory_etcd.MemoryEtcdClient.  A backend may also provide
+        the txn method of pycalico.etcdv3.EtcdV3Client for multi-key
+        transactions.  If not specified, the process wide etcd client for the
+        etcd environment variables is used - see get_etcd_client().
+        :param index_endpoints: (optional) Maintain secondary indexes of the
+        endpoints by workload ID, IP address and label when endpoints are
+        written or removed, and use them to look up endpoints without
+        reading every endpoint in the cluster.  Endpoints are also indexed
+        by profile, for get_profile_members().  The indexes are only used for
+        lookups once they have been built for the existing endpoints with
+        build_endpoint_index(), and this should be enabled on every client
+        that writes endpoints - endpoints written by other clients are not
+        indexed until the indexes are rebuilt.
+        :param cache_host_ips: (optional) Answer get_hostnames_from_ips()
+        from an in-memory index of the BGP host IPs, which is loaded on first
+        use and then kept up to date by watching etcd from a background
+        thread.  Call close() to stop the watch.
+        """
+        if etcd_client is None:
+            etcd_client = get_etcd_client()
+        self.etcd_client = etcd_client
+        self.index_endpoints = index_endpoints
+        self._endpoint_index_ready = False
+        self.cache_host_ips = cache_host_ips
+        self._host_ip_cache = None
+        self._host_ip_cache_lock = threading.Lock()
+
+    def close(self):
+        """
+        Stop any background watches started by this client.
+        """
+        with self._host_ip_cache_lock:
+            if self._host_ip_cache is not None:
+                self._host_ip_cache.stop()
+                self._host_ip_cache = None
 
     @handle_errors
     def ensure_global_config(self):
         """
         Ensure the global config settings for Calico exist, creating them with
         defaults if they don't.
+
+        The settings are independent, so they are written in parallel, each
+        as a single conditional create.
         :return: None.
         """
-        # Configure Felix config.
-        self._ensure_interface_prefix()
-
-        # Configure IPAM directory structures (to ensure confd is able to
-        # watch appropriate directory trees).
-        for version in (4, 6):
-            pool_path = IP_POOLS_PATH % {"version": version}
-            self._write_global_dir(pool_path)
-
-        # create directories for custom filters
-        self._write_global_dir(BGP_CUSTOM_FILTERS_IPV4_PATH)
-        self._write_global_dir(BGP_CUSTOM_FILTERS_IPV6_PATH)
-
-        # Configure BGP global (default) config if it doesn't exist.
-        self._write_global_config(BGP_NODE_DEF_AS_PATH, str(DEFAULT_AS_NUM))
-        self._write_global_config(BGP_NODE_MESH_PATH,
-                                  json.dumps(DEFAULT_NODE_MESH))
-
-        # Configure logging levels.
-        self._write_global_config(LOG_SEVERITY_FILE_PATH,
-                                  DEFAULT_LOG_SEVERITY_FILE)
-        self._write_global_config(LOG_SEVERITY_SCREEN_PATH,
-                                  DEFAULT_LOG_SEVERITY_SCREEN)
-        self._write_global_config(LOG_FILE_PATH_PATH,
-                                  DEFAULT_LOG_FILE_PATH)
-
-        # IP in IP is disabled globally.
-        self._write_global_config(IP_IN_IP_PATH, IP_IN_IP_DISABLED)
-
-        # Disable felix status reporting, which consumes etcd write bandwidth.
-        self._write_global_config(FELIX_REPORTING_INTERVAL_PATH, "0")
-
-        # Create our Cluster GUID (if it does not already exist).
-        self._ensure_cluster_guid(CLUSTER_GUID_PATH)
+        _call_concurrently([
+            # Configure Felix config.
+            self._ensure_interface_prefix,
+
+            # Configure IPAM directory structures (to ensure confd is able to
+            # watch appropriate directory trees).
+            lambda: self._write_global_dir(IP_POOLS_PATH % {"version": 4}),
+            lambda: self._write_global_dir(IP_POOLS_PATH % {"version": 6}),
+
+            # create directories for custom filters
+            lambda: self._write_global_dir(BGP_CUSTOM_FILTERS_IPV4_PATH),
+            lambda: self._write_global_dir(BGP_CUSTOM_FILTERS_IPV6_PATH),
+
+            # Configure BGP global (default) config if it doesn't exist.
+            lambda: self._write_global_config(BGP_NODE_DEF_AS_PATH,
+                                              str(DEFAULT_AS_NUM)),
+            lambda: self._write_global_config(BGP_NODE_MESH_PATH,
+                                              json.dumps(DEFAULT_NODE_MESH)),
+
+            # Configure logging levels.
+            lambda: self._write_global_config(LOG_SEVERITY_FILE_PATH,
+                                              DEFAULT_LOG_SEVERITY_FILE),
+            lambda: self._write_global_config(LOG_SEVERITY_SCREEN_PATH,
+                                              DEFAULT_LOG_SEVERITY_SCREEN),
+            lambda: self._write_global_config(LOG_FILE_PATH_PATH,
+                                              DEFAULT_LOG_FILE_PATH),
+
+            # IP in IP is disabled globally.
+            lambda: self._write_global_config(IP_IN_IP_PATH,
+                                              IP_IN_IP_DISABLED),
+
+            # Disable felix status reporting, which consumes etcd write
+            # bandwidth.
+            lambda: self._write_global_config(FELIX_REPORTING_INTERVAL_PATH,
+                                              "0"),
+
+            # Create our Cluster GUID (if it does not already exist).
+            lambda: self._ensure_cluster_guid(CLUSTER_GUID_PATH),
+        ])
 
         # We are always ready.
         self.etcd_client.write(CALICO_V_PATH + "/Ready", "true")
@@ -317,27 +514,22 @@ class DatastoreClient(object):
         datastore. The prevExist=False creates the value (safely with CaS)
         if it doesn't exist.
         """
-        try:
-            self.etcd_client.read(key)
-        except etcd.EtcdKeyNotFound:
-            guid = uuid.uuid4()
-            guid_string = guid.get_hex()
-            try:
-                self.etcd_client.write(key, guid_string, prevExist=False)
-            except etcd.EtcdAlreadyExist:
-                # ignore
-                pass
+        guid = uuid.uuid4()
+        self._write_global_config(key, guid.get_hex())
 
     def _write_global_config(self, key, value):
         """
         Write global config into the datastore if it does not already exist.
+        The prevExist=False creates the value in a single request, without
+        first reading it.
         :param key: The configuration key.
         :param value: The configuration value.
         """
         try:
-            self.etcd_client.read(key)
-        except etcd.EtcdKeyNotFound:
-            self.etcd_client.write(key, value)
+            self.etcd_client.write(key, value, prevExist=False)
+        except etcd.EtcdAlreadyExist:
+            # Already configured.
+            pass
 
     def _write_global_dir(self, key):
         """
@@ -368,45 +560,48 @@ class DatastoreClient(object):
         bgp_ipv6 = BGP_HOST_IPV6_PATH % {"hostname": hostname}
         bgp_as = BGP_HOST_AS_PATH % {"hostname": hostname}
 
-        # Create the per-host affinity paths.
-        for version in (4, 6):
-            affinity_path = IPAM_HOST_AFFINITY_PATH % {"host": hostname,
-                                                       "version": version}
-            self._write_global_dir(affinity_path)
-
-        # Set up the host
-        self.etcd_client.write(host_ipv4, ipv4)
-        self.etcd_client.write(bgp_ipv4, ipv4)
-        self.etcd_client.write(bgp_ipv6, ipv6)
-        workload_dir = host_path + "workload"
-        try:
-            self.etcd_client.read(workload_dir)
-        except etcd.EtcdKeyNotFound:
-            # Didn't exist, create it now.
-            self.etcd_client.write(workload_dir, None, dir=True)
-
-        # Set or delete the node specific BGP AS number as required.  If the
-        # value is missing from the etcd datastore, the BIRD templates will
-        # inherit the configured global default value (and then the
-        # hardcoded default value).
-        if as_num is None:
-            try:
-                self.etcd_client.delete(bgp_as)
-            except etcd.EtcdKeyNotFound:
-                pass
-        else:
-            self.etcd_client.write(bgp_as, as_num)
-
-        # Configure Felix to allow traffic from the containers to the host (if
-        # not otherwise firewalled by the host administrator or profiles).
-        # This is important for Mesos, where the containerized executor process
-        # needs to exchange messages with the Mesos Slave process running on
-        # the host.  Don't overwrite the value if it's already present.
-        if self.get_per_host_config(hostname, "DefaultEndpointToHostAction") is None:
-            self.set_per_host_config(hostname, "DefaultEndpointToHostAction",
-                                    "RETURN")
-
-        # Flag that the host is created.
+        def set_as_num():
+            # Set or delete the node specific BGP AS number as required.  If
+            # the value is missing from the etcd datastore, the BIRD templates
+            # will inherit the configured global default value (and then the
+            # hardcoded default value).
+            if as_num is None:
+                try:
+                    self.etcd_client.delete(bgp_as)
+                except etcd.EtcdKeyNotFound:
+                    pass
+            else:
+                self.etcd_client.write(bgp_as, as_num)
+
+        # The host keys are independent, so write them in parallel.
+        _call_concurrently([
+            # Create the per-host affinity paths.
+            lambda: self._write_global_dir(IPAM_HOST_AFFINITY_PATH % {
+                "host": hostname, "version": 4}),
+            lambda: self._write_global_dir(IPAM_HOST_AFFINITY_PATH % {
+                "host": hostname, "version": 6}),
+
+            # Set up the host
+            lambda: self.etcd_client.write(host_ipv4, ipv4),
+            lambda: self.etcd_client.write(bgp_ipv4, ipv4),
+            lambda: self.etcd_client.write(bgp_ipv6, ipv6),
+            lambda: self._write_global_dir(host_path + "workload"),
+            set_as_num,
+
+            # Configure Felix to allow traffic from the containers to the host
+            # (if not otherwise firewalled by the host administrator or
+            # profiles).  This is important for Mesos, where the containerized
+            # executor process needs to exchange messages with the Mesos Slave
+            # process running on the host.  Don't overwrite the value if it's
+            # already present.
+            lambda: self._write_global_config(
+                HOST_CONFIG_KEY_PATH % {
+                    "hostname": hostname,
+                    "config_param": "DefaultEndpointToHostAction"},
+                "RETURN"),
+        ])
+
+        # Flag that the host is created, once everything else is written.
         self.set_per_host_config(hostname, "marker", "created")
 
         return
@@ -488,39 +683,55 @@ class DatastoreClient(object):
         :return: Dictionary of host dictionaries, indexed by hostname, with data
         for ipv4, ipv6, bgp peers and as_num
         """
-        try:
-            # Get all host data
-            host_data = self.etcd_client.read(BGP_HOSTS_PATH, recursive=True)
-        except etcd.EtcdKeyNotFound:
-            # No BGP hosts currently configured in etcd
-            return {}
-
         host_dict = {}
-        for host_leaf in host_data.leaves:
-            # Match expected host data values
-            match = HOSTNAME_ANY_BGP_DATASTORE_RE.match(host_leaf.key)
-            if match:
-                # Get hostname and key name from match data
-                hostname = match.group(1)
-                data_name = match.group(2)
-                if hostname not in host_dict.keys():
-                    # Hostname has not been added to dict, init host data now
-                    host_dict[hostname] = {"as_num":     "",
-                                           "ip_addr_v4": "",
-                                           "ip_addr_v6": "",
-                                           "peer_v4":    [],
-                                           "peer_v6":    []}
-                if data_name in ["as_num", "ip_addr_v4", "ip_addr_v6"]:
-                    host_dict[hostname][data_name] = host_leaf.value
-                else:
-                    # data_name is "peer_v[46]/<ip>", get "peer_v[46]
-                    peer_key = data_name.split("/")[0]
+        for hostname, data in _iter_hosts_data(self._read_hosts_data(), None,
+                                               lazy_peers=False):
+            existing = host_dict.get(hostname)
+            if existing is None:
+                host_dict[hostname] = data
+                continue
+            # The backend returned the host's keys out of order, so merge
+            # the records.
+            for data_name in ("as_num", "ip_addr_v4", "ip_addr_v6"):
+                existing[data_name] = data[data_name] or existing[data_name]
+            existing["peer_v4"].extend(data["peer_v4"])
+            existing["peer_v6"].extend(data["peer_v6"])
+        return host_dict
 
-                    # Save BGP peer dict {"ip": <ip>, "as_num": <as>} in data
-                    leaf_dict = json.loads(host_leaf.value)
-                    host_dict[hostname][peer_key].append(leaf_dict)
+    @handle_errors
+    def iter_hosts_data(self, hostname_prefix=None):
+        """
+        Iterate through the hosts with data in the etcd datastore, in
+        hostname order.
 
-        return host_dict
+        This makes a single recursive read, and yields each host as soon as
+        its data has been parsed, rather than building a dictionary of every
+        host.  The BGP peers of each host are only decoded when they are
+        accessed.
+
+        :param hostname_prefix: (optional) Only include hosts whose hostname
+        starts with this prefix.
+        :return: An iterator of (hostname, host dictionary) tuples, with the
+        same host dictionaries as get_hosts_data_dict(), except that the
+        peer_v4 and peer_v6 values are read-only sequences.
+        """
+        # Read the hosts here, rather than when the iterator is first used,
+        # so that errors are handled by the decorator.
+        return _iter_hosts_data(self._read_hosts_data(), hostname_prefix,
+                                lazy_peers=True)
+
+    def _read_hosts_data(self):
+        """
+        :return: The leaves of the BGP host data, sorted by key.
+        """
+        try:
+            # Get all host data.  Sorting the keys returns the keys of each
+            # host together.
+            return self.etcd_client.read(BGP_HOSTS_PATH, recursive=True,
+                                         sorted=True).leaves
+        except etcd.EtcdKeyNotFound:
+            # No BGP hosts currently configured in etcd
+            return []
 
     @handle_errors
     def get_hostnames_from_ips(self, ip_list):
@@ -529,6 +740,13 @@ class DatastoreClient(object):
         :param ip_list: The list of IPs to get hostnames for.
         :return: A dictionary of {IP:hostname} the hosts that own the given IPs.
         """
+        if self.cache_host_ips:
+            with self._host_ip_cache_lock:
+                if self._host_ip_cache is None:
+                    self._host_ip_cache = _HostIPCache(self.etcd_client)
+                cache = self._host_ip_cache
+            return cache.get_hostnames(ip_list)
+
         try:
             hosts = self.etcd_client.read(BGP_HOSTS_PATH, recursive=True)
             host_ips = hosts.leaves
@@ -537,12 +755,13 @@ class DatastoreClient(object):
             raise KeyError("No BGP host configurations found.")
 
         ip_host_dict = {}
+        ip_set = set(ip_list)
 
         # Loop through key-value pairs to find IP addresses
         for host_ip in host_ips:
             # Check for the ipv4 or ipv6 address key values
             host_match = HOSTNAME_IP_DATASTORE_RE.match(host_ip.key)
-            if host_match and host_ip.value in ip_list:
+            if host_match and host_ip.value in ip_set:
                 # Pull the hostname from the datastore key string
                 hostname = host_match.group(1)
                 ip_host_dict[host_ip.value] = hostname
@@ -1063,28 +1282,54 @@ class DatastoreClient(object):
         """
         profile_path = PROFILE_PATH % {"profile_id": name}
         try:
-            _ = self.etcd_client.read(profile_path)
-            profile = Profile(name)
+            leaves = self.etcd_client.read(profile_path,
+                                           recursive=True).leaves
         except etcd.EtcdKeyNotFound:
             raise KeyError("%s is not a configured profile." % name)
 
-        tags_path = TAGS_PATH % {"profile_id": name}
-        try:
-            tags_result = self.etcd_client.read(tags_path)
-            tags = json.loads(tags_result.value)
-            profile.tags = set(tags)
-        except etcd.EtcdKeyNotFound:
-            pass
+        profile = Profile(name)
+        for leaf in leaves:
+            _set_profile_data(profile, leaf.key.rsplit("/", 1)[1], leaf,
+                              lazy_rules=False)
+        return profile
+
+    @handle_errors
+    def get_profiles(self, names=None):
+        """
+        Get Profile objects for all of the configured profiles, or the named
+        profiles, from a single read of the data store.
 
-        rules_path = RULES_PATH % {"profile_id": name}
+        The rules of each profile are only parsed when they are first
+        accessed, so that loading many profiles is cheap.
+
+        :param names: (optional) An iterable of the names of the profiles to
+        get.  Names that are not configured profiles are ignored.
+        :return: A dictionary of profile name to Profile object.
+        """
+        if names is not None:
+            names = set(names)
         try:
-            rules_result = self.etcd_client.read(rules_path)
-            rules = Rules.from_json(rules_result.value)
-            profile.rules = rules
+            leaves = self.etcd_client.read(PROFILES_PATH,
+                                           recursive=True).leaves
         except etcd.EtcdKeyNotFound:
-            pass
+            # Means the PROFILES_PATH was not set up.  So, no profiles exist.
+            return {}
 
-        return profile
+        profiles = {}
+        for leaf in leaves:
+            if not leaf.key.startswith(PROFILES_PATH):
+                # The profiles directory itself, when it is empty.
+                continue
+            parts = leaf.key[len(PROFILES_PATH):].split("/", 1)
+            name = parts[0]
+            if names is not None and name not in names:
+                continue
+            profile = profiles.get(name)
+            if profile is None:
+                profile = profiles[name] = Profile(name)
+            if len(parts) > 1:
+                _set_profile_data(profile, parts[1], leaf, lazy_rules=True)
+        return profiles
 
     @handle_errors
     def get_profile_members(self, profile_name):
@@ -1094,8 +1339,38 @@ class DatastoreClient(object):
         :param profile_name: Unique string name of the profile.
         :return: a list of Endpoint objects.
         """
-        return [endpoint for endpoint in self.get_endpoints()
-                if profile_name in endpoint.profile_ids]
+        return self.get_profiles_members([profile_name])[profile_name]
+
+    @handle_errors
+    def get_profiles_members(self, profile_names):
+        """
+        Get the endpoint members of several profiles at once.
+
+        If the endpoint indexes are in use, the members of each profile are
+        looked up in the profile index, and each endpoint is read once.
+        Otherwise, every endpoint is read once, rather than once for each
+        profile.
+
+        :param profile_names: The names of the profiles.
+        :return: Dictionary of profile name to a list of Endpoint objects.
+        """
+        members = dict((profile_name, []) for profile_name in profile_names)
+        if self._use_endpoint_index():
+            endpoints = {}
+            for profile_name in members:
+                index_path = ENDPOINT_INDEX_PROFILE_PATH % {
+                    "profile_id": _index_name(profile_name)}
+                members[profile_name] = self._get_indexed_endpoints(
+                    index_path,
+                    lambda ep: profile_name in ep.profile_ids,
+                    endpoints=endpoints)
+            return members
+
+        for endpoint in self.get_endpoints():
+            for profile_name in set(endpoint.profile_ids):
+                if profile_name in members:
+                    members[profile_name].append(endpoint)
+        return members
 
     @handle_errors
     def profile_update_tags(self, profile):
@@ -1188,7 +1463,8 @@ class DatastoreClient(object):
 
     @handle_errors
     def get_endpoints(self, hostname=None, orchestrator_id=None,
-                      workload_id=None, endpoint_id=None):
+                      workload_id=None, endpoint_id=None, lazy=False,
+                      compact=False):
         """
         Optimized function to get endpoint(s).
 
@@ -1201,9 +1477,28 @@ class DatastoreClient(object):
         :param hostname: The hostname that the endpoint lives on.
         :param workload_id: The workload that the endpoint belongs to.
         :param orchestrator_id: The workload that the endpoint belongs to.
+        :param lazy: (optional) Whether to decode the endpoints lazily, which
+        is much cheaper when listing large numbers of endpoints.  See
+        Endpoint.from_json().
+        :param compact: (optional) Whether to return compact Endpoints, which
+        are decoded lazily and keep the etcd modifiedIndex of the endpoint for
+        atomic updates rather than its JSON.
         :return: A list of Endpoint Objects which match the criteria, or an
         empty list if none match
         """
+        lazy = lazy or compact
+        # Without a hostname, the query would read every endpoint in the
+        # cluster, so look up the workload in the index if possible.
+        if not hostname and workload_id and self._use_endpoint_index():
+            index_path = ENDPOINT_INDEX_WORKLOAD_PATH % {
+                "workload_id": _index_name(workload_id)}
+            return self._get_indexed_endpoints(
+                index_path,
+                lambda ep: ep.matches(orchestrator_id=orchestrator_id,
+                                      workload_id=workload_id,
+                                      endpoint_id=endpoint_id),
+                lazy=lazy, compact=compact)
+
         # First build the query string as specific as possible. Note, we want
         # the query to be as specific as possible, so we proceed any variables
         # with known constants e.g. we add '/workload' after the hostname
@@ -1233,7 +1528,9 @@ class DatastoreClient(object):
         # Filter through result
         matches = []
         for leaf in leaves:
-            endpoint = Endpoint.from_json(leaf.key, leaf.value)
+            endpoint = Endpoint.from_json(
+                leaf.key, leaf.value, lazy=lazy,
+                modified_index=leaf.modifiedIndex if compact else None)
 
             # If its an endpoint, compare it to search criteria
             if endpoint and endpoint.matches(hostname=hostname,
@@ -1274,6 +1571,271 @@ class DatastoreClient(object):
         else:
             return eps.pop()
 
+    @handle_errors
+    def get_endpoints_by_ip(self, ip):
+        """
+        Get the endpoints with an IP address.
+
+        :param ip: The IPAddress (or IP address string) to look up.
+        :return: A list of Endpoint objects with a network containing the
+        address.
+        """
+        ip = IPAddress(ip)
+
+        def has_ip(endpoint):
+            return any(ip == net.ip for net in
+                       endpoint.ipv4_nets | endpoint.ipv6_nets)
+
+        if self._use_endpoint_index():
+            index_path = ENDPOINT_INDEX_IP_PATH % {"ip": _index_name(ip)}
+            return self._get_indexed_endpoints(index_path, has_ip)
+        return [endpoint for endpoint in self.get_endpoints()
+                if has_ip(endpoint)]
+
+    @handle_errors
+    def get_endpoints_by_label(self, key, value):
+        """
+        Get the endpoints with a label.
+
+        :param key: The label key.
+        :param value: The label value.
+        :return: A list of Endpoint objects with the label.
+        """
+        def has_label(endpoint):
+            return endpoint.labels.get(key) == value
+
+        if self._use_endpoint_index():
+            index_path = ENDPOINT_INDEX_LABEL_PATH % {
+                "key": _index_name(key), "value": _index_name(value)}
+            return self._get_indexed_endpoints(index_path, has_label)
+        return [endpoint for endpoint in self.get_endpoints()
+                if has_label(endpoint)]
+
+    @handle_errors
+    def build_endpoint_index(self):
+        """
+        Build the endpoint indexes for all of the existing endpoints, and
+        mark the indexes as ready for lookups.  This must be run once after
+        enabling endpoint indexing (and again if endpoints have been written
+        by clients without indexing enabled), and may be run while other
+        clients are writing endpoints.
+
+        Index entries for endpoints that have since been removed are not
+        deleted here - they are ignored, and deleted, when looked up.
+
+        :return: The number of endpoints indexed.
+        """
+        endpoints = self._read_all_endpoints()
+        for endpoint in endpoints:
+            for key in _endpoint_index_keys(endpoint):
+                self.etcd_client.write(key, _index_entry_value())
+        self.etcd_client.write(ENDPOINT_INDEX_READY_PATH, "")
+        self._endpoint_index_ready = True
+        return len(endpoints)
+
+    def _read_all_endpoints(self):
+        """
+        Read every endpoint, without using the indexes.
+
+        :return: A list of Endpoint objects.
+        """
+        try:
+            leaves = self.etcd_client.read(HOSTS_PATH, recursive=True).leaves
+        except etcd.EtcdKeyNotFound:
+            return []
+        endpoints = [Endpoint.from_json(leaf.key, leaf.value)
+                     for leaf in leaves]
+        return [endpoint for endpoint in endpoints if endpoint]
+
+    def _use_endpoint_index(self):
+        """
+        :return: True if endpoint indexing is enabled, and the indexes have
+        been built.
+        """
+        if not self.index_endpoints:
+            return False
+        if not self._endpoint_index_ready:
+            try:
+                self.etcd_client.read(ENDPOINT_INDEX_READY_PATH)
+            except etcd.EtcdKeyNotFound:
+                return False
+            self._endpoint_index_ready = True
+        return True
+
+    def _get_indexed_endpoints(self, index_path, match, endpoints=None,
+                               lazy=False, compact=False):
+        """
+        Get the endpoints in an endpoint index directory.  Each endpoint is
+        read, up to MAX_CONCURRENT_ENDPOINTS at a time, and checked against
+        the index, and index entries that are out of date are deleted.
+
+        An entry that doesn't match its endpoint may have been added by a
+        writer that has not yet written the endpoint, so it is only deleted
+        if the endpoint has been written since the entry was, or if the
+        endpoint does not exist and the entry is older than
+        ENDPOINT_INDEX_GRACE.
+
+        :param index_path: The index directory.
+        :param match: Function returning whether an Endpoint belongs in the
+        index directory.
+        :param endpoints: (optional) Dictionary of endpoint key to a tuple of
+        (Endpoint, modifiedIndex), or (None, None) if the endpoint does not
+        exist, used to avoid reading an endpoint more than once across
+        several lookups.
+        :param lazy: (optional) Whether to decode the endpoints lazily.
+        :param compact: (optional) Whether to return compact Endpoints.
+        :return: A list of the matching Endpoint objects.
+        """
+        if endpoints is None:
+            endpoints = {}
+        try:
+            entries = self.etcd_client.read(index_path).children
+        except etcd.EtcdKeyNotFound:
+            return []
+
+        # Skip empty index directories.
+        entries = [(entry, HOSTS_PATH + base64.urlsafe_b64decode(
+                        str(entry.key.rsplit("/", 1)[1])))
+                   for entry in entries if not entry.dir]
+
+        def read_endpoint(ep_path):
+            try:
+                result = self.etcd_client.read(ep_path)
+            except etcd.EtcdKeyNotFound:
+                return None, None
+            return (Endpoint.from_json(
+                result.key, result.value, lazy=lazy,
+                modified_index=result.modifiedIndex if compact else None),
+                result.modifiedIndex)
+
+        # Read the endpoints that have not already been read in parallel,
+        # rather than making a round trip to etcd for each in turn.
+        ep_paths = sorted(set(ep_path for _, ep_path in entries
+                              if ep_path not in endpoints))
+        results = map_concurrently(read_endpoint, ep_paths,
+                                   MAX_CONCURRENT_ENDPOINTS)
+        for ep_path, (result, error) in zip(ep_paths, results):
+            if error is not None:
+                raise error
+            endpoints[ep_path] = result
+
+        matches = []
+        now = time.time()
+        for entry, ep_path in entries:
+            endpoint, modified_index = endpoints[ep_path]
+
+            if endpoint and match(endpoint):
+                matches.append(endpoint)
+            elif (endpoint and modified_index > entry.modifiedIndex) or \
+                    (not endpoint and
+                     now - _index_entry_time(entry.value) >
+                     ENDPOINT_INDEX_GRACE):
+                _log.debug("Deleting stale endpoint index entry %s",
+                           entry.key)
+                # Only delete the entry if it has not been rewritten since
+                # it was read.
+                self._delete_endpoint_index_key(entry.key,
+                                                prev_index=entry.modifiedIndex)
+        return matches
+
+    def _update_endpoint_index(self, old_endpoint, new_endpoint, remove):
+        """
+        Update the endpoint index entries for an endpoint, if endpoint
+        indexing is enabled.  Entries are added before the endpoint is
+        written, and removed after it is written or deleted, so that a lookup
+        never misses an endpoint - entries that don't match the endpoint are
+        ignored.
+
+        :param old_endpoint: The Endpoint previously written, or None.
+        :param new_endpoint: The Endpoint being written, or None if the
+        endpoint is being deleted.
+        :param remove: False to add the new entries, True to remove the old
+        entries.
+        :return: A list of tuples of (key, modifiedIndex) of the entries
+        created, when adding entries.  Existing entries are rewritten, so
+        that lookups don't take them to be out of date, but not returned.
+        """
+        if not self.index_endpoints:
+            return []
+        old_keys = set()
+        new_keys = set()
+        if old_endpoint is not None:
+            old_keys = _endpoint_index_keys(old_endpoint)
+        if new_endpoint is not None:
+            new_keys = _endpoint_index_keys(new_endpoint)
+        created = []
+        if remove:
+            for key in old_keys - new_keys:
+                self._delete_endpoint_index_key(key)
+        else:
+            for key in new_keys - old_keys:
+                value = _index_entry_value()
+                try:
+                    result = self.etcd_client.write(key, value,
+                                                    prevExist=False)
+                except etcd.EtcdAlreadyExist:
+                    self.etcd_client.write(key, value)
+                else:
+                    created.append((key, result.modifiedIndex))
+        return created
+
+    def _delete_endpoint_index_key(self, key, prev_index=None):
+        kwargs = {}
+        if prev_index is not None:
+            kwargs["prevIndex"] = prev_index
+        try:
+            self.etcd_client.delete(key, **kwargs)
+        except (etcd.EtcdKeyNotFound, etcd.EtcdCompareFailed):
+            pass
+
+    def _write_endpoint(self, endpoint, **kwargs):
+        """
+        Write an endpoint, updating the endpoint indexes.
+
+        :param endpoint: The Endpoint to write.
+        :param kwargs: Additional arguments for the etcd write.
+        """
+        ep_path = _endpoint_path(endpoint)
+        old_endpoint = None
+        if self.index_endpoints:
+            old_endpoint = self._original_endpoint(ep_path, endpoint)
+        new_json = endpoint.to_json()
+        created = self._update_endpoint_index(old_endpoint, endpoint, False)
+        try:
+            result = self.etcd_client.write(ep_path, new_json, **kwargs)
+        except Exception:
+            # Remove the entries created for the write, unless another writer
+            # has since rewritten them.
+            exc_info = sys.exc_info()
+            for key, modified_index in created:
+                self._delete_endpoint_index_key(key, prev_index=modified_index)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self._update_endpoint_index(old_endpoint, endpoint, True)
+        if endpoint._original_index is None:
+            endpoint._original_json = new_json
+        else:
+            endpoint._original_index = result.modifiedIndex
+
+    def _original_endpoint(self, ep_path, endpoint):
+        """
+        Get an endpoint as it was read from the datastore.
+
+        :param ep_path: The endpoint key.
+        :param endpoint: The Endpoint.
+        :return: The Endpoint as it was read, or None if it was not read from
+        the datastore.  For compact Endpoints, this is the endpoint currently
+        stored.
+        """
+        if endpoint._original_json:
+            return Endpoint.from_json(ep_path, endpoint._original_json)
+        if endpoint._original_index is None:
+            return None
+        try:
+            result = self.etcd_client.read(ep_path)
+        except etcd.EtcdKeyNotFound:
+            return None
+        return Endpoint.from_json(ep_path, result.value)
+
     @handle_errors
     def set_endpoint(self, endpoint):
         """
@@ -1281,13 +1843,7 @@ class DatastoreClient(object):
 
         :param endpoint: The Endpoint to add to the workload.
         """
-        ep_path = ENDPOINT_PATH % {"hostname": endpoint.hostname,
-                                   "orchestrator_id": endpoint.orchestrator_id,
-                                   "workload_id": endpoint.workload_id,
-                                   "endpoint_id": endpoint.endpoint_id}
-        new_json = endpoint.to_json()
-        self.etcd_client.write(ep_path, new_json)
-        endpoint._original_json = new_json
+        self._write_endpoint(endpoint)
 
     @handle_errors
     def update_endpoint(self, endpoint):
@@ -1301,15 +1857,123 @@ class DatastoreClient(object):
 
         :param endpoint: The Endpoint to add to the workload.
         """
-        ep_path = ENDPOINT_PATH % {"hostname": endpoint.hostname,
-                                   "orchestrator_id": endpoint.orchestrator_id,
-                                   "workload_id": endpoint.workload_id,
-                                   "endpoint_id": endpoint.endpoint_id}
-        new_json = endpoint.to_json()
-        self.etcd_client.write(ep_path,
-                               new_json,
-                               prevValue=endpoint._original_json)
-        endpoint._original_json = new_json
+        self._update_endpoint(endpoint)
+
+    def _update_endpoint(self, endpoint):
+        """
+        Write an endpoint, if it has not changed since it was read.
+
+        :param endpoint: The Endpoint to write.
+        """
+        if endpoint._original_index is not None:
+            self._write_endpoint(endpoint, prevIndex=endpoint._original_index)
+        else:
+            self._write_endpoint(endpoint, prevValue=endpoint._original_json)
+
+    @handle_errors
+    def set_endpoints(self, endpoints,
+                      max_concurrent=MAX_CONCURRENT_ENDPOINTS):
+        """
+        Write a list of endpoint objects to the datastore, up to
+        max_concurrent at a time.  Each endpoint is written as by
+        set_endpoint().
+
+        :param endpoints: The list of Endpoints to write.
+        :param max_concurrent: (optional) The maximum number of endpoints to
+        write in parallel.
+        :return: A list, in endpoint order, of tuples of
+                 (Endpoint, <result>, <exception>), where result is
+                 ENDPOINT_OK or ENDPOINT_ERROR.  The exception is the error
+                 hit writing the endpoint, or None if the result is not
+                 ENDPOINT_ERROR.
+        """
+        return self._batch_endpoints(endpoints, self._write_endpoint, [],
+                                     max_concurrent)
+
+    @handle_errors
+    def update_endpoints(self, endpoints,
+                         max_concurrent=MAX_CONCURRENT_ENDPOINTS):
+        """
+        Update a list of endpoint objects in the datastore, up to
+        max_concurrent at a time.  Each endpoint is only updated if it has
+        not changed since it was read, as by update_endpoint().
+
+        :param endpoints: The list of Endpoints to update.
+        :param max_concurrent: (optional) The maximum number of endpoints to
+        update in parallel.
+        :return: A list, in endpoint order, of tuples of
+                 (Endpoint, <result>, <exception>), where result is one of
+                 ENDPOINT_OK, ENDPOINT_CONFLICT (the endpoint has been
+                 changed or removed since it was read) or ENDPOINT_ERROR.
+                 The exception is the error hit updating the endpoint, or
+                 None if the result is not ENDPOINT_ERROR.
+        """
+        return self._batch_endpoints(
+            endpoints, self._update_endpoint,
+            [(etcd.EtcdCompareFailed, ENDPOINT_CONFLICT),
+             (etcd.EtcdKeyNotFound, ENDPOINT_CONFLICT)],
+            max_concurrent)
+
+    @handle_errors
+    def remove_endpoints(self, endpoints,
+                         max_concurrent=MAX_CONCURRENT_ENDPOINTS):
+        """
+        Remove a list of endpoint objects from the datastore, up to
+        max_concurrent at a time.
+
+        :param endpoints: The list of Endpoints to remove.
+        :param max_concurrent: (optional) The maximum number of endpoints to
+        remove in parallel.
+        :return: A list, in endpoint order, of tuples of
+                 (Endpoint, <result>, <exception>), where result is one of
+                 ENDPOINT_OK, ENDPOINT_NOT_FOUND or ENDPOINT_ERROR.  The
+                 exception is the error hit removing the endpoint, or None if
+                 the result is not ENDPOINT_ERROR.
+        """
+        return self._batch_endpoints(
+            endpoints, self._remove_endpoint,
+            [(etcd.EtcdKeyNotFound, ENDPOINT_NOT_FOUND)], max_concurrent)
+
+    def _batch_endpoints(self, endpoints, fn, failures, max_concurrent):
+        """
+        Write or remove a list of endpoints in parallel.
+
+        :param endpoints: The list of Endpoints.
+        :param fn: Called with each Endpoint to write or remove it.
+        :param failures: A list of tuples of (exception class, result) for
+        the expected failures of fn.
+        :param max_concurrent: The maximum number of endpoints to process in
+        parallel.
+        :return: A list, in endpoint order, of tuples of
+                 (Endpoint, result, exception).  Unexpected exceptions
+                 raised by fn are reported with a result of ENDPOINT_ERROR,
+                 with etcd exceptions converted to DataStoreErrors.
+        """
+        endpoints = list(endpoints)
+
+        def process(endpoint):
+            try:
+                fn(endpoint)
+            except Exception as e:
+                for exc_type, result in failures:
+                    if isinstance(e, exc_type):
+                        return result
+                raise
+            return ENDPOINT_OK
+
+        report = []
+        results = map_concurrently(process, endpoints, max_concurrent)
+        for endpoint, (result, error) in zip(endpoints, results):
+            if error is not None:
+                _log.warning("Error processing endpoint %s: %r",
+                             endpoint.endpoint_id, error)
+                if isinstance(error, etcd.EtcdException):
+                    # Don't leak out etcd exceptions.
+                    error = _datastore_error(fn.__name__.lstrip("_"), error)
+                report.append((endpoint, ENDPOINT_ERROR, error))
+            else:
+                report.append((endpoint, result, None))
+        return report
 
     @handle_errors
     def create_endpoint(self, hostname, orchestrator_id, workload_id,
@@ -1350,11 +2014,23 @@ class DatastoreClient(object):
 
         :param endpoint: The Endpoint to remove.
         """
-        ep_path = ENDPOINT_PATH % {"hostname": endpoint.hostname,
-                                   "orchestrator_id": endpoint.orchestrator_id,
-                                   "workload_id": endpoint.workload_id,
-                                   "endpoint_id": endpoint.endpoint_id}
+        self._remove_endpoint(endpoint)
+
+    def _remove_endpoint(self, endpoint):
+        """
+        Remove an endpoint, updating the endpoint indexes.
+
+        :param endpoint: The Endpoint to remove.
+        """
+        ep_path = _endpoint_path(endpoint)
+        old_endpoint = None
+        if self.index_endpoints:
+            old_endpoint = self._original_endpoint(ep_path, endpoint)
         self.etcd_client.delete(ep_path, dir=True, recursive=True)
+        if old_endpoint is not None:
+            # Remove the entries for the endpoint as it was stored.
+            self._update_endpoint_index(old_endpoint, None, True)
+        self._update_endpoint_index(endpoint, None, True)
 
     @handle_errors
     def remove_all_data(self):
@@ -1441,3 +2117,257 @@ class DatastoreClient(object):
             return str(DEFAULT_AS_NUM)
         else:
             return str(as_num)
+
+
+class _LazyJSONList(collections.Sequence):
+    """
+    A read-only list of JSON encoded values, which are decoded when the list
+    is first accessed.
+    """
+
+    def __init__(self):
+        self._raw = []
+        self._values = None
+
+    def append_json(self, value):
+        """
+        Append a JSON encoded value.  The list must not yet have been
+        accessed.
+        """
+        self._raw.append(value)
+
+    def _decoded(self):
+        if self._values is None:
+            self._values = [json.loads(value) for value in self._raw]
+            self._raw = None
+        return self._values
+
+    def __getitem__(self, index):
+        return self._decoded()[index]
+
+    def __len__(self):
+        if self._values is None:
+            return len(self._raw)
+        return len(self._values)
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return repr(self._decoded())
+
+
+class _HostIPCache(object):
+    """
+    An in-memory index of the BGP host IPs to hostnames, kept up to date by
+    watching the BGP hosts tree.
+    """
+
+    def __init__(self, etcd_client):
+        self._lock = threading.Lock()
+        self._exists = False
+        # Datastore key to IP, and IP to (datastore key, hostname).
+        self._key_ips = {}
+        self._ips = {}
+        self._watcher = TreeWatcher(etcd_client, BGP_HOSTS_PATH,
+                                    self._on_load, self._on_change)
+        self._watcher.start()
+
+    def stop(self):
+        self._watcher.stop()
+
+    def get_hostnames(self, ip_list):
+        """
+        :param ip_list: The IPs to get hostnames for.
+        :return: A dictionary of {IP:hostname} the hosts that own the given
+        IPs.
+        """
+        with self._lock:
+            if not self._exists:
+                raise KeyError("No BGP host configurations found.")
+            return dict((ip, self._ips[ip][1]) for ip in set(ip_list)
+                        if ip in self._ips)
+
+    def _on_load(self, items):
+        with self._lock:
+            self._exists = items is not None
+            self._key_ips.clear()
+            self._ips.clear()
+            for key, value in items or []:
+                self._set(key, value)
+
+    def _on_change(self, action, key, value, is_dir):
+        with self._lock:
+            if action in ("delete", "compareAndDelete", "expire"):
+                if BGP_HOSTS_PATH.startswith(key.rstrip("/") + "/"):
+                    # The hosts tree, or one of its parents, was deleted.
+                    self._exists = False
+                prefix = key.rstrip("/") + "/"
+                for removed in [k for k in self._key_ips
+                                if k == key or k.startswith(prefix)]:
+                    self._remove(removed)
+            else:
+                self._exists = True
+                if not is_dir:
+                    self._set(key, value)
+
+    def _set(self, key, value):
+        match = HOSTNAME_IP_DATASTORE_RE.match(key)
+        if not match:
+            return
+        self._remove(key)
+        self._key_ips[key] = value
+        self._ips[value] = (key, match.group(1))
+
+    def _remove(self, key):
+        ip = self._key_ips.pop(key, None)
+        if ip is not None and self._ips.get(ip, (None,))[0] == key:
+            del self._ips[ip]
+
+
+def _iter_hosts_data(leaves, hostname_prefix, lazy_peers):
+    """
+    Iterate through the hosts in the BGP host data.
+
+    :param leaves: The leaves of the BGP host data, sorted by key.
+    :param hostname_prefix: Only include hosts whose hostname starts with
+    this prefix, or None for all hosts.
+    :param lazy_peers: Whether to decode the BGP peers lazily.
+    :return: An iterator of (hostname, host dictionary) tuples.
+    """
+    hostname = None
+    data = None
+    for host_leaf in leaves:
+        # Match expected host data values
+        match = HOSTNAME_ANY_BGP_DATASTORE_RE.match(host_leaf.key)
+        if not match:
+            continue
+        # Get hostname and key name from match data
+        leaf_hostname, data_name = match.groups()
+        if hostname_prefix and not leaf_hostname.startswith(
+                hostname_prefix):
+            continue
+
+        if leaf_hostname != hostname:
+            if data is not None:
+                yield hostname, data
+            hostname = leaf_hostname
+            peer_type = _LazyJSONList if lazy_peers else list
+            data = {"as_num":     "",
+                    "ip_addr_v4": "",
+                    "ip_addr_v6": "",
+                    "peer_v4":    peer_type(),
+                    "peer_v6":    peer_type()}
+
+        if data_name in ("as_num", "ip_addr_v4", "ip_addr_v6"):
+            data[data_name] = host_leaf.value
+        else:
+            # data_name is "peer_v[46]/<ip>", get "peer_v[46]".  Each
+            # peer is a BGP peer dict {"ip": <ip>, "as_num": <as>}.
+            peer_key = data_name.split("/")[0]
+            if lazy_peers:
+                data[peer_key].append_json(host_leaf.value)
+            else:
+                data[peer_key].append(json.loads(host_leaf.value))
+
+    if data is not None:
+        yield hostname, data
+
+
+def _set_profile_data(profile, data_name, leaf, lazy_rules):
+    """
+    Set the data in a key of a profile directory on a Profile.
+
+    :param profile: The Profile.
+    :param data_name: The name of the key within the profile directory.
+    :param leaf: The EtcdResult for the key.
+    :param lazy_rules: Whether to parse the rules when first accessed.
+    """
+    if leaf.dir:
+        return
+    if data_name == "tags":
+        profile.tags = set(json.loads(leaf.value))
+    elif data_name == "rules":
+        if lazy_rules:
+            profile._raw_rules = leaf.value
+        else:
+            profile.rules = Rules.from_json(leaf.value)
+
+
+def _call_concurrently(fns, max_concurrent=MAX_CONCURRENT_CONFIG_WRITES):
+    """
+    Call a list of independent functions in parallel, and raise the first
+    error (in list order) once they have all completed.
+
+    :param fns: The list of functions, which take no arguments.
+    :param max_concurrent: (optional) The maximum number of functions to call
+    in parallel.
+    """
+    for _, error in map_concurrently(lambda fn: fn(), fns, max_concurrent):
+        if error is not None:
+            raise error
+
+
+def _endpoint_path(endpoint):
+    """
+    :return: The datastore key of an Endpoint.
+    """
+    return ENDPOINT_PATH % {"hostname": endpoint.hostname,
+                            "orchestrator_id": endpoint.orchestrator_id,
+                            "workload_id": endpoint.workload_id,
+                            "endpoint_id": endpoint.endpoint_id}
+
+
+def _index_name(value):
+    """
+    Encode a value for use in an index key.  Values are base64 encoded so
+    that they may contain any characters, including "/".
+
+    :param value: The value to encode.
+    :return: The encoded value.
+    """
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return base64.urlsafe_b64encode(str(value))
+
+
+def _index_entry_value():
+    """
+    :return: The value of an endpoint index entry written now.
+    """
+    return "%d" % time.time()
+
+
+def _index_entry_time(value):
+    """
+    :param value: The value of an endpoint index entry.
+    :return: The time at which the entry was written.  Entries written
+    without a time are treated as old.
+    """
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return 0
+
+
+def _endpoint_index_keys(endpoint):
+    """
+    :param endpoint: An Endpoint.
+    :return: The set of endpoint index keys for the Endpoint.
+    """
+    entry = _index_name(_endpoint_path(endpoint)[len(HOSTS_PATH):])
+    keys = {ENDPOINT_INDEX_WORKLOAD_PATH %
+            {"workload_id": _index_name(endpoint.workload_id)} + entry}
+    for net in endpoint.ipv4_nets | endpoint.ipv6_nets:
+        keys.add(ENDPOINT_INDEX_IP_PATH % {"ip": _index_name(net.ip)} + entry)
+    for key, value in endpoint.labels.iteritems():
+        keys.add(ENDPOINT_INDEX_LABEL_PATH %
+                 {"key": _index_name(key), "value": _index_name(value)} +
+                 entry)
+    for profile_id in endpoint.profile_ids:
+        keys.add(ENDPOINT_INDEX_PROFILE_PATH %
+                 {"profile_id": _index_name(profile_id)} + entry)
+    return keys
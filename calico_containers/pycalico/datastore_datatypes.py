@@ -34,6 +34,14 @@ prefix that appears in all Calico interface names in the root namespace. e.g.
 cali123456789ab.
 """
 
+# Maximum number of strings shared between decoded endpoints.
+SHARED_STRINGS_MAX = 10000
+
+# Hostname and orchestrator strings shared between decoded endpoints.  Each
+# value is repeated across many endpoints, so sharing a single copy saves
+# memory when listing large numbers of endpoints.
+_shared_strings = {}
+
 
 class Rules(namedtuple("Rules", ["inbound_rules", "outbound_rules"])):
     """
@@ -222,7 +230,17 @@ class Endpoint(object):
     Class encapsulating an Endpoint.
     This class keeps track of the original JSON representation of the
     endpoint to allow atomic updates to be performed.
+
+    The attributes are stored in slots to keep large numbers of Endpoints
+    compact.  Other attributes may still be set, and are stored in an
+    instance dictionary that is only created when first needed.
     """
+    __slots__ = ("hostname", "orchestrator_id", "workload_id", "endpoint_id",
+                 "state", "mac", "name", "_ipv4_nets", "_ipv6_nets",
+                 "_raw_ipv4_nets", "_raw_ipv6_nets", "profile_ids",
+                 "_original_json", "_original_index", "labels",
+                 "__dict__", "__weakref__")
+
     # Endpoint path match regex
     ENDPOINT_KEY_MATCH = re.compile("/calico/v1/host/(?P<hostname>[^/]*)/"
                                 "workload/(?P<orchestrator_id>[^/]*)/"
@@ -240,14 +258,49 @@ class Endpoint(object):
         self.name = name or generate_cali_interface_name(IF_PREFIX,
                                                          endpoint_id)
 
-        self.ipv4_nets = set()
-        self.ipv6_nets = set()
+        self._ipv4_nets = set()
+        self._ipv6_nets = set()
+
+        # The raw nets of an Endpoint decoded lazily, which are only
+        # converted to IPNetworks when first accessed.
+        self._raw_ipv4_nets = None
+        self._raw_ipv6_nets = None
 
         self.profile_ids = []
+
+        # The JSON representation of the endpoint when it was read, or, for
+        # compact Endpoints, its etcd modifiedIndex.
         self._original_json = None
+        self._original_index = None
 
         self.labels = {}
 
+    @property
+    def ipv4_nets(self):
+        if self._raw_ipv4_nets is not None:
+            self._ipv4_nets = set(IPNetwork(net) for net in
+                                  self._raw_ipv4_nets)
+            self._raw_ipv4_nets = None
+        return self._ipv4_nets
+
+    @ipv4_nets.setter
+    def ipv4_nets(self, nets):
+        self._ipv4_nets = nets
+        self._raw_ipv4_nets = None
+
+    @property
+    def ipv6_nets(self):
+        if self._raw_ipv6_nets is not None:
+            self._ipv6_nets = set(IPNetwork(net) for net in
+                                  self._raw_ipv6_nets)
+            self._raw_ipv6_nets = None
+        return self._ipv6_nets
+
+    @ipv6_nets.setter
+    def ipv6_nets(self, nets):
+        self._ipv6_nets = nets
+        self._raw_ipv6_nets = None
+
     def to_json(self):
         json_dict = {"state": self.state,
                      "name": self.name,
@@ -259,32 +312,42 @@ class Endpoint(object):
         return json.dumps(json_dict)
 
     @classmethod
-    def from_json(cls, endpoint_key, json_str):
+    def from_json(cls, endpoint_key, json_str, lazy=False,
+                  modified_index=None):
         """
         Create an Endpoint from the endpoint raw JSON and the endpoint key.
 
         :param endpoint_key: The endpoint key (the etcd path to the endpoint)
         :param json_str: The raw endpoint JSON data.
+        :param lazy: (optional) Whether to defer parsing the IP networks of
+        the endpoint until they are first accessed.  This makes decoding large
+        numbers of endpoints cheaper, but an invalid network is then only
+        reported when the networks are accessed.
+        :param modified_index: (optional) The etcd modifiedIndex of the
+        endpoint.  If specified, this is kept for atomic updates of the
+        endpoint, rather than the original JSON.
         :return: An Endpoint object, or None if the endpoint_key does not
         represent and Endpoint.
         """
-        match = Endpoint.ENDPOINT_KEY_MATCH.match(endpoint_key)
-        if not match:
+        key_fields = _split_endpoint_key(endpoint_key)
+        if not key_fields:
             return None
-
-        hostname = match.group("hostname")
-        orchestrator_id = match.group("orchestrator_id")
-        workload_id = match.group("workload_id")
-        endpoint_id = match.group("endpoint_id")
+        hostname, orchestrator_id, workload_id, endpoint_id = key_fields
+        hostname = _share_string(hostname)
+        orchestrator_id = _share_string(orchestrator_id)
 
         json_dict = json.loads(json_str)
         ep = cls(hostname, orchestrator_id, workload_id, endpoint_id,
                  json_dict["state"], json_dict["mac"], name=json_dict["name"])
 
-        for net in json_dict["ipv4_nets"]:
-            ep.ipv4_nets.add(IPNetwork(net))
-        for net in json_dict["ipv6_nets"]:
-            ep.ipv6_nets.add(IPNetwork(net))
+        if lazy:
+            ep._raw_ipv4_nets = json_dict["ipv4_nets"]
+            ep._raw_ipv6_nets = json_dict["ipv6_nets"]
+        else:
+            ep._ipv4_nets = set(IPNetwork(net)
+                                for net in json_dict["ipv4_nets"])
+            ep._ipv6_nets = set(IPNetwork(net)
+                                for net in json_dict["ipv6_nets"])
         labels = json_dict.get("labels", {})
         ep.labels = labels
 
@@ -293,8 +356,12 @@ class Endpoint(object):
         ep.profile_ids = [profile_id] if profile_id else \
                          json_dict.get("profile_ids", [])
 
-        # Store the original JSON representation of this Endpoint.
-        ep._original_json = json_str
+        # Store the original JSON representation of this Endpoint, or its
+        # index.
+        if modified_index is None:
+            ep._original_json = json_str
+        else:
+            ep._original_index = modified_index
 
         return ep
 
@@ -382,6 +449,41 @@ class Endpoint(object):
         return "Endpoint(%s)" % self.to_json()
 
 
+def _share_string(value):
+    """
+    :return: A shared copy of the string value.
+    """
+    shared = _shared_strings.get(value)
+    if shared is None:
+        if len(_shared_strings) >= SHARED_STRINGS_MAX:
+            _shared_strings.clear()
+        _shared_strings[value] = shared = value
+    return shared
+
+
+def _split_endpoint_key(endpoint_key):
+    """
+    Split an endpoint key into its fields.
+
+    :param endpoint_key: The endpoint key (the etcd path to the endpoint)
+    :return: Tuple of (hostname, orchestrator_id, workload_id, endpoint_id),
+    or None if the endpoint_key does not represent an Endpoint.
+    """
+    # Splitting the key is much cheaper than matching the regex, and handles
+    # every well formed endpoint key.
+    parts = endpoint_key.split("/")
+    if (len(parts) == 10 and not parts[0] and parts[1] == "calico" and
+            parts[2] == "v1" and parts[3] == "host" and
+            parts[5] == "workload" and parts[8] == "endpoint"):
+        return parts[4], parts[6], parts[7], parts[9]
+
+    match = Endpoint.ENDPOINT_KEY_MATCH.match(endpoint_key)
+    if not match:
+        return None
+    return (match.group("hostname"), match.group("orchestrator_id"),
+            match.group("workload_id"), match.group("endpoint_id"))
+
+
 class Profile(object):
     """A Calico policy profile."""
 
@@ -390,7 +492,23 @@ class Profile(object):
         self.tags = set()
 
         # Default to empty lists of rules.
-        self.rules = Rules([], [])
+        self._rules = Rules([], [])
+
+        # The raw JSON rules of a Profile decoded lazily, which are only
+        # parsed when first accessed.
+        self._raw_rules = None
+
+    @property
+    def rules(self):
+        if self._raw_rules is not None:
+            self._rules = Rules.from_json(self._raw_rules)
+            self._raw_rules = None
+        return self._rules
+
+    @rules.setter
+    def rules(self, rules):
+        self._rules = rules
+        self._raw_rules = None
 
 
 class Policy(object):
@@ -0,0 +1,520 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+etcd v3 datastore backend, using the etcd v3 JSON gateway.
+
+EtcdV3Client provides the read, write, update and delete methods of the
+python-etcd Client, with etcd v2 semantics, on top of the flat etcd v3 key
+space: a directory is any key prefix ending in "/", and the etcd index of a
+key (modifiedIndex, createdIndex) is its v3 revision.  In addition it
+provides txn(), which the IPAMClient uses to write a block and its
+allocation handles in a single atomic transaction.
+
+A datastore backend supports transactions if it has a txn() method, with the
+signature:
+
+    txn(compare, success)
+
+    :param compare: List of (key, modifiedIndex) tuples.  The transaction only
+    succeeds if each key currently has the given modifiedIndex, or, if the
+    modifiedIndex is None, if the key does not exist.
+    :param success: List of (TXN_PUT, key, value) and (TXN_DELETE, key, None)
+    tuples, applied atomically if the comparisons succeed.
+    :return: True if the transaction succeeded, False if a comparison failed.
+
+Note that the etcd v3 key space is separate from the v2 key space, so data
+written through the v2 API is not visible through this client.
+"""
+
+import base64
+import json
+import logging
+import socket
+import ssl
+from httplib import HTTPException
+
+import etcd
+import urllib3
+from urllib3.connection import HTTPConnection
+from urllib3.exceptions import HTTPError
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+# Transaction operations.
+TXN_PUT = "put"
+TXN_DELETE = "delete"
+
+# The default path of the v3 JSON gateway API.  etcd 3.2 serves the gateway
+# at "/v3alpha/" instead.
+DEFAULT_API_PATH = "/v3/"
+
+
+class EtcdV3Client(object):
+    """
+    A datastore backend using the etcd v3 JSON gateway.
+
+    Watches (read with wait=True) and in-order keys (write with append=True)
+    are not supported.
+    """
+
+    def __init__(self, host="127.0.0.1", port=2379, protocol="http",
+                 cert=None, ca_cert=None, api_path=DEFAULT_API_PATH,
+                 read_timeout=60, per_host_pool_size=10):
+        """
+        :param host: The etcd host, or a tuple of (host, port) tuples.  When
+        there are several hosts, each is tried in turn if a request fails to
+        connect.
+        :param port: The etcd port, if host is a single host.
+        :param protocol: "http" or "https".
+        :param cert: (optional) The client certificate file, or a tuple of
+        (certificate file, key file).
+        :param ca_cert: (optional) The CA certificate file.
+        :param api_path: The path of the v3 JSON gateway API.
+        :param read_timeout: The request timeout in seconds.
+        :param per_host_pool_size: The maximum number of connections to pool
+        for each host.
+        """
+        if isinstance(host, tuple):
+            hosts = list(host)
+        else:
+            hosts = [(host, port)]
+        self._base_uris = ["%s://%s:%d" % (protocol, h, p) for h, p in hosts]
+        self._api_path = api_path
+
+        # Connections are pooled and kept alive, with TCP keepalives so that
+        # idle connections to etcd are not silently dropped.
+        kw = {"maxsize": per_host_pool_size,
+              "timeout": read_timeout,
+              "socket_options": HTTPConnection.default_socket_options +
+                                [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]}
+        if cert:
+            if isinstance(cert, tuple):
+                kw["cert_file"], kw["key_file"] = cert
+            else:
+                kw["cert_file"] = cert
+        if ca_cert:
+            kw["ca_certs"] = ca_cert
+            kw["cert_reqs"] = ssl.CERT_REQUIRED
+        self.http = urllib3.PoolManager(num_pools=10, **kw)
+
+    def read(self, key, recursive=False, sorted=False, quorum=False,
+             wait=False, **kwdargs):
+        """
+        Read a key or directory.
+
+        :param key: The key to read.
+        :param recursive: Whether to return the full subtree of a directory.
+        :param sorted: Whether to sort the child nodes by key.  Child nodes
+        are always returned in key order.
+        :param quorum: Whether to perform a linearizable read.
+        :param wait: Not supported.
+        :return: An EtcdResult.
+        """
+        if wait:
+            raise etcd.EtcdException("Watches are not supported by the etcd "
+                                     "v3 backend")
+        key = _normalize(key)
+        serializable = not quorum
+        response = self._request("kv/range", {"key": _encode(key),
+                                              "serializable": serializable})
+        kvs = response.get("kvs", [])
+        if kvs:
+            return self._result("get", _kv_node(kvs[0]), response=response)
+
+        prefix = _dir_prefix(key)
+        response = self._request("kv/range",
+                                 {"key": _encode(prefix),
+                                  "range_end": _encode(_prefix_end(prefix)),
+                                  "serializable": serializable})
+        kvs = [_decode_kv(kv) for kv in response.get("kvs", [])]
+        if not kvs:
+            raise _key_not_found(key)
+        return self._result("get", _dir_node(key, kvs, recursive),
+                            response=response)
+
+    def get(self, key):
+        """
+        Read a key.
+
+        :param key: The key to read.
+        :return: An EtcdResult.
+        """
+        return self.read(key)
+
+    def write(self, key, value, ttl=None, dir=False, append=False,
+              prevExist=None, prevValue=None, prevIndex=None, **kwdargs):
+        """
+        Write a key, optionally as a compare-and-swap.  Directories do not
+        exist in etcd v3, so creating a directory does nothing.
+
+        :param key: The key to write.
+        :param value: The value to write.
+        :param ttl: (optional) Time to live of the key, in seconds.
+        :param dir: Whether to create a directory.
+        :param append: Not supported.
+        :param prevExist: (optional) If False, the write only succeeds if the
+        key does not exist.  If True, it only succeeds if the key exists.
+        :param prevValue: (optional) The write only succeeds if the current
+        value of the key matches.
+        :param prevIndex: (optional) The write only succeeds if the current
+        modifiedIndex of the key matches.
+        :return: An EtcdResult.
+        """
+        if append:
+            raise etcd.EtcdException("In-order keys are not supported by the "
+                                     "etcd v3 backend")
+        key = _normalize(key)
+        if dir:
+            return self._result("set", {"key": key, "dir": True})
+
+        value = "" if value is None else value
+        if not isinstance(value, basestring):
+            value = str(value)
+        put = {"key": _encode(key), "value": _encode(value), "prev_kv": True}
+        if ttl:
+            response = self._request("lease/grant", {"TTL": ttl})
+            put["lease"] = response["ID"]
+
+        compare = _compare(key, prevExist, prevValue, prevIndex)
+        if not compare:
+            response = self._request("kv/put", put)
+            prev_kv = response.get("prev_kv")
+            return self._result("set", _put_node(key, value, response,
+                                                 prev_kv),
+                                prev_kv=prev_kv, response=response)
+
+        response = self._request("kv/txn", {
+            "compare": compare,
+            "success": [{"request_put": put}],
+            "failure": [{"request_range": {"key": _encode(key)}}]})
+        if not response.get("succeeded"):
+            current = _txn_range(response)
+            _raise_compare_failed(key, current, prevExist)
+        prev_kv = response["responses"][0]["response_put"].get("prev_kv")
+        action = "create" if prevExist is False else "compareAndSwap"
+        return self._result(action, _put_node(key, value, response, prev_kv),
+                            prev_kv=prev_kv, response=response)
+
+    def update(self, obj):
+        """
+        Update the key described by an EtcdResult, as a compare-and-swap on
+        its modifiedIndex.
+
+        :param obj: The EtcdResult (as returned from a read) with an updated
+        value.
+        :return: An EtcdResult.
+        """
+        return self.write(obj.key, obj.value, dir=obj.dir,
+                          prevIndex=None if obj.dir else obj.modifiedIndex)
+
+    def delete(self, key, recursive=None, dir=None, prevValue=None,
+               prevIndex=None, **kwdargs):
+        """
+        Delete a key or directory, optionally as a compare-and-delete.
+
+        :param key: The key to delete.
+        :param recursive: Whether to delete a directory and all its contents.
+        :param dir: Whether the key is a directory.  Without recursive, only
+        empty directories may be deleted.
+        :param prevValue: (optional) The delete only succeeds if the current
+        value of the key matches.
+        :param prevIndex: (optional) The delete only succeeds if the current
+        modifiedIndex of the key matches.
+        :return: An EtcdResult.
+        """
+        key = _normalize(key)
+        prefix = _dir_prefix(key)
+        compare = _compare(key, None, prevValue, prevIndex)
+        if compare:
+            response = self._request("kv/txn", {
+                "compare": compare,
+                "success": [{"request_delete_range": {"key": _encode(key),
+                                                      "prev_kv": True}}],
+                "failure": [{"request_range": {"key": _encode(key)}}]})
+            if not response.get("succeeded"):
+                _raise_compare_failed(key, _txn_range(response), None)
+            deleted = response["responses"][0]["response_delete_range"]
+            return self._deleted_result("compareAndDelete", key, deleted,
+                                        response)
+
+        if recursive:
+            requests = [{"key": _encode(key), "prev_kv": True},
+                        {"key": _encode(prefix),
+                         "range_end": _encode(_prefix_end(prefix))}]
+        else:
+            requests = [{"key": _encode(key), "prev_kv": True}]
+        response = self._request("kv/txn", {
+            "success": [{"request_delete_range": request}
+                        for request in requests]
+                       + [{"request_range": {
+                           "key": _encode(prefix),
+                           "range_end": _encode(_prefix_end(prefix)),
+                           "count_only": True}}]})
+        responses = response["responses"]
+        deleted = responses[0]["response_delete_range"]
+        deleted_dir = int(responses[1]["response_delete_range"]
+                          .get("deleted", 0)) if recursive else 0
+        remaining = int(responses[-1]["response_range"].get("count", 0))
+        if not recursive and remaining:
+            if dir:
+                raise etcd.EtcdDirNotEmpty("Directory not empty",
+                                           {"key": key})
+            raise etcd.EtcdNotFile("Not a file", {"key": key})
+        if not int(deleted.get("deleted", 0)) and not deleted_dir:
+            if dir:
+                # Directories only exist implicitly in etcd v3, so an empty
+                # directory may be deleted even though no key exists.
+                return self._result("delete", {"key": key, "dir": True},
+                                    response=response)
+            raise _key_not_found(key)
+        return self._deleted_result("delete", key, deleted, response)
+
+    def txn(self, compare, success):
+        """
+        Perform an atomic multi-key transaction.  See the module
+        documentation.
+
+        :param compare: List of (key, modifiedIndex) tuples.
+        :param success: List of (operation, key, value) tuples.
+        :return: True if the transaction succeeded, False if a comparison
+        failed.
+        """
+        compares = []
+        for key, index in compare:
+            if index is None:
+                compares.append({"key": _encode(_normalize(key)),
+                                 "target": "VERSION",
+                                 "result": "EQUAL",
+                                 "version": "0"})
+            else:
+                compares.append({"key": _encode(_normalize(key)),
+                                 "target": "MOD",
+                                 "result": "EQUAL",
+                                 "mod_revision": str(index)})
+        requests = []
+        for op, key, value in success:
+            if op == TXN_PUT:
+                requests.append({"request_put": {
+                    "key": _encode(_normalize(key)),
+                    "value": _encode(value)}})
+            elif op == TXN_DELETE:
+                requests.append({"request_delete_range": {
+                    "key": _encode(_normalize(key))}})
+            else:
+                raise ValueError("Unknown transaction operation %s" % op)
+        response = self._request("kv/txn", {"compare": compares,
+                                            "success": requests})
+        return bool(response.get("succeeded"))
+
+    def _request(self, method, body):
+        """
+        Send a request to the gateway, trying each host in turn until one
+        responds.
+
+        :param method: The API method, for example "kv/range".
+        :param body: The JSON serializable request body.
+        :return: The decoded JSON response.
+        """
+        data = json.dumps(body)
+        error = None
+        for index, base_uri in enumerate(self._base_uris):
+            try:
+                response = self.http.urlopen(
+                    "POST", base_uri + self._api_path + method, body=data,
+                    headers={"Content-Type": "application/json"})
+                content = response.data
+            except (HTTPError, HTTPException, socket.error) as e:
+                _log.error("Request to server %s failed: %r", base_uri, e)
+                error = e
+                continue
+            if index:
+                # Try the responding host first from now on.
+                self._base_uris.insert(0, self._base_uris.pop(index))
+            try:
+                result = json.loads(content) if content else {}
+            except ValueError:
+                raise etcd.EtcdException("Bad response from etcd: %s (%s)" %
+                                         (content, response.status))
+            if response.status != 200:
+                message = result.get("error") or result.get("message") or \
+                    content
+                raise etcd.EtcdException("etcd request failed: %s (%s)" %
+                                         (message, response.status))
+            return result
+        raise etcd.EtcdConnectionFailed("Connection to etcd failed due to %r"
+                                        % error, cause=error)
+
+    @staticmethod
+    def _result(action, node, prev_kv=None, response=None):
+        prev_node = _kv_node(prev_kv) if prev_kv else None
+        result = etcd.EtcdResult(action, node, prev_node)
+        if response is not None:
+            revision = int(response.get("header", {}).get("revision", 0))
+            result.etcd_index = revision
+            result.raft_index = revision
+        return result
+
+    def _deleted_result(self, action, key, deleted, response):
+        prev_kvs = deleted.get("prev_kvs") or []
+        prev_kv = prev_kvs[0] if prev_kvs else None
+        revision = int(response.get("header", {}).get("revision", 0))
+        node = {"key": key, "modifiedIndex": revision}
+        if prev_kv is not None:
+            node["createdIndex"] = int(prev_kv.get("create_revision", 0))
+        else:
+            node["dir"] = True
+        return self._result(action, node, prev_kv=prev_kv, response=response)
+
+
+def _normalize(key):
+    return "/" + key.strip("/")
+
+
+def _dir_prefix(key):
+    return key.rstrip("/") + "/"
+
+
+def _prefix_end(prefix):
+    """
+    :return: The end of the v3 key range containing all keys with the prefix.
+    """
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return base64.b64encode(value)
+
+
+def _decode_kv(kv):
+    """
+    Decode the base64 key and value of a v3 key-value.
+    """
+    kv = dict(kv)
+    kv["key"] = base64.b64decode(kv["key"])
+    kv["value"] = base64.b64decode(kv.get("value", ""))
+    return kv
+
+
+def _kv_node(kv):
+    """
+    Convert a (base64 encoded) v3 key-value into a v2 node dictionary.
+    """
+    kv = _decode_kv(kv)
+    return {"key": kv["key"],
+            "value": kv["value"],
+            "modifiedIndex": int(kv.get("mod_revision", 0)),
+            "createdIndex": int(kv.get("create_revision", 0))}
+
+
+def _put_node(key, value, response, prev_kv):
+    revision = int(response.get("header", {}).get("revision", 0))
+    created = int(prev_kv.get("create_revision", 0)) if prev_kv else revision
+    return {"key": key,
+            "value": value,
+            "modifiedIndex": revision,
+            "createdIndex": created}
+
+
+def _dir_node(key, kvs, recursive, depth=0):
+    """
+    Build the v2 node dictionary of a directory from the (decoded) v3
+    key-values within it.
+
+    :param key: The directory key.
+    :param kvs: The key-values with the directory prefix, in key order.
+    :param recursive: Whether to include the full subtree.  When False, only
+    the immediate children are included.
+    :return: The node dictionary.
+    """
+    node = {"key": key, "dir": True}
+    if depth > 0 and not recursive:
+        return node
+
+    prefix = _dir_prefix(key)
+    children = []
+    groups = {}
+    for kv in kvs:
+        name, sep, _ = kv["key"][len(prefix):].partition("/")
+        child_key = prefix + name
+        if not sep:
+            children.append((child_key, {
+                "key": child_key,
+                "value": kv["value"],
+                "modifiedIndex": int(kv.get("mod_revision", 0)),
+                "createdIndex": int(kv.get("create_revision", 0))}))
+        else:
+            if child_key not in groups:
+                groups[child_key] = []
+                children.append((child_key, None))
+            groups[child_key].append(kv)
+    node["nodes"] = [child if child is not None else
+                     _dir_node(child_key, groups[child_key], recursive,
+                               depth + 1)
+                     for child_key, child in sorted(children)]
+    return node
+
+
+def _compare(key, prev_exist, prev_value, prev_index):
+    """
+    :return: The v3 transaction comparisons for v2 compare-and-swap
+    conditions.
+    """
+    compare = []
+    encoded = _encode(key)
+    if prev_exist is False:
+        compare.append({"key": encoded, "target": "VERSION",
+                        "result": "EQUAL", "version": "0"})
+    elif prev_exist:
+        compare.append({"key": encoded, "target": "VERSION",
+                        "result": "GREATER", "version": "0"})
+    if prev_value is not None:
+        compare.append({"key": encoded, "target": "VALUE", "result": "EQUAL",
+                        "value": _encode(prev_value)})
+    if prev_index is not None:
+        compare.append({"key": encoded, "target": "MOD", "result": "EQUAL",
+                        "mod_revision": str(prev_index)})
+    return compare
+
+
+def _txn_range(response):
+    """
+    :return: The key-value read by the failure branch of a transaction, or
+    None if the key does not exist.
+    """
+    kvs = response["responses"][0]["response_range"].get("kvs", [])
+    return kvs[0] if kvs else None
+
+
+def _raise_compare_failed(key, current, prev_exist):
+    """
+    Raise the python-etcd exception for a failed compare-and-swap.
+
+    :param current: The current key-value of the key, or None.
+    """
+    if current is None:
+        if prev_exist is False:
+            # Only reachable if the key was deleted after the compare.
+            raise etcd.EtcdCompareFailed("Compare failed", {"key": key})
+        raise _key_not_found(key)
+    if prev_exist is False:
+        raise etcd.EtcdAlreadyExist("Key already exists", {"key": key})
+    raise etcd.EtcdCompareFailed("Compare failed", {"key": key})
+
+
+def _key_not_found(key):
+    return etcd.EtcdKeyNotFound("Key not found : %s" % key, {"key": key})
@@ -0,0 +1,339 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local mirror (informer) of parts of the Calico datastore.
+
+An Informer loads the chosen subtrees of the datastore, and then follows
+changes to them with etcd watches, so that controllers can serve reads from
+memory rather than polling etcd.  Listeners can be registered to be told about
+each change to the mirrored keys.
+"""
+
+import json
+import logging
+import threading
+
+from pycalico.datastore import (get_etcd_client, HOSTS_PATH, PROFILES_PATH,
+                                TIERS_PATH, IP_POOLS_PATH, BGP_V_PATH,
+                                BGP_HOSTS_PATH, HOSTNAME_IP_DATASTORE_RE)
+from pycalico.datastore_datatypes import Endpoint, IPPool, Policy, Profile, \
+    Rules
+from pycalico.watch import TreeWatcher, WATCH_TIMEOUT, RETRY_DELAY
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+# The subtrees of the datastore that may be mirrored.
+ENDPOINTS = "endpoints"
+PROFILES = "profiles"
+POLICIES = "policies"
+POOLS = "pools"
+BGP = "bgp"
+ALL_SUBTREES = (ENDPOINTS, PROFILES, POLICIES, POOLS, BGP)
+
+# The datastore paths of each subtree.
+SUBTREE_PATHS = {
+    ENDPOINTS: (HOSTS_PATH,),
+    PROFILES: (PROFILES_PATH,),
+    POLICIES: (TIERS_PATH,),
+    POOLS: (IP_POOLS_PATH % {"version": 4}, IP_POOLS_PATH % {"version": 6}),
+    BGP: (BGP_V_PATH,),
+}
+
+# The actions reported to listeners.
+SET = "set"
+DELETE = "delete"
+
+# etcd actions that remove keys.
+_DELETE_ACTIONS = ("delete", "compareAndDelete", "expire")
+
+
+class Informer(object):
+    """
+    A mirror of subtrees of the Calico datastore, kept up to date by watches
+    from background threads.
+
+    All of the read methods are thread safe, and return objects that are
+    decoded afresh for each call, so that callers may modify them.
+    """
+
+    def __init__(self, etcd_client=None, subtrees=ALL_SUBTREES,
+                 watch_timeout=WATCH_TIMEOUT, retry_delay=RETRY_DELAY):
+        """
+        :param etcd_client: (optional) The datastore backend.  Defaults to the
+        etcd client configured by the environment.
+        :param subtrees: (optional) The subtrees to mirror, from ENDPOINTS,
+        PROFILES, POLICIES, POOLS and BGP.  Defaults to all of them.
+        :param watch_timeout: (optional) The time for which each watch request
+        waits for a change.
+        :param retry_delay: (optional) The time to wait before reloading a
+        subtree after a watch fails.
+        """
+        for subtree in subtrees:
+            if subtree not in SUBTREE_PATHS:
+                raise ValueError("Unknown subtree %r" % subtree)
+        self.etcd_client = etcd_client or get_etcd_client()
+        self.subtrees = tuple(subtrees)
+        self._lock = threading.Lock()
+        # Datastore key to value, for each mirrored path.
+        self._trees = {}
+        self._listeners = []
+        self._watchers = []
+        for subtree in self.subtrees:
+            for path in SUBTREE_PATHS[subtree]:
+                self._trees[path] = {}
+                self._watchers.append(TreeWatcher(
+                    self.etcd_client, path,
+                    lambda items, path=path: self._on_load(path, items),
+                    lambda action, key, value, is_dir, path=path:
+                        self._on_change(path, action, key, value, is_dir),
+                    watch_timeout=watch_timeout, retry_delay=retry_delay))
+
+    def add_listener(self, listener):
+        """
+        Register a function to be called for each change to the mirrored
+        keys.  Listeners are called from the watch threads, after the mirror
+        has been updated, with the action (SET or DELETE), the key and the
+        new value (or None when the key is deleted).
+
+        When a subtree is reloaded, for example because its watch fell
+        behind, listeners are called with the differences from the previous
+        contents of the subtree.
+
+        :param listener: The function to call.
+        """
+        with self._lock:
+            self._listeners.append(listener)
+
+    def start(self):
+        """
+        Load the subtrees, and start following changes to them.  The mirror
+        is complete once this returns.
+        """
+        for watcher in self._watchers:
+            watcher.start()
+
+    def stop(self):
+        """
+        Stop following changes.
+        """
+        for watcher in self._watchers:
+            watcher.stop()
+
+    def join(self, timeout=None):
+        """
+        Wait for the watch threads to exit, after stop() has been called.
+
+        :param timeout: (optional) The maximum time to wait for each thread.
+        """
+        for watcher in self._watchers:
+            watcher.join(timeout)
+
+    def get(self, key, default=None):
+        """
+        :param key: A datastore key in one of the mirrored subtrees.
+        :param default: (optional) The value to return if the key does not
+        exist.
+        :return: The raw value of the key.
+        """
+        with self._lock:
+            for path, tree in self._trees.iteritems():
+                if key.startswith(path):
+                    return tree.get(key, default)
+        return default
+
+    def items(self, prefix):
+        """
+        :param prefix: A datastore key prefix in one of the mirrored
+        subtrees.
+        :return: A list, sorted by key, of the (key, raw value) tuples of the
+        keys starting with the prefix.
+        """
+        with self._lock:
+            items = [(key, value)
+                     for path, tree in self._trees.iteritems()
+                     if prefix.startswith(path) or path.startswith(prefix)
+                     for key, value in tree.iteritems()
+                     if key.startswith(prefix)]
+        items.sort()
+        return items
+
+    def get_endpoints(self, hostname=None, orchestrator_id=None,
+                      workload_id=None, endpoint_id=None):
+        """
+        Get the endpoints matching the criteria, as
+        DatastoreClient.get_endpoints().  The ENDPOINTS subtree must be
+        mirrored.
+
+        :return: A list of Endpoint objects, decoded lazily.
+        """
+        prefix = HOSTS_PATH
+        if hostname:
+            prefix += hostname + "/"
+        endpoints = []
+        for key, value in self._subtree_items(ENDPOINTS, prefix):
+            if "/endpoint/" not in key:
+                continue
+            endpoint = Endpoint.from_json(key, value, lazy=True)
+            if endpoint and endpoint.matches(hostname=hostname,
+                                             orchestrator_id=orchestrator_id,
+                                             workload_id=workload_id,
+                                             endpoint_id=endpoint_id):
+                endpoints.append(endpoint)
+        return endpoints
+
+    def get_profile_names(self):
+        """
+        :return: The set of profile names.  The PROFILES subtree must be
+        mirrored.
+        """
+        return set(self.get_profiles())
+
+    def get_profile(self, name):
+        """
+        :param name: The name of the profile.
+        :return: A Profile object.  Raises a KeyError if the profile does not
+        exist.
+        """
+        profiles = self.get_profiles([name])
+        if name not in profiles:
+            raise KeyError("%s is not a configured profile." % name)
+        return profiles[name]
+
+    def get_profiles(self, names=None):
+        """
+        Get the profiles, as DatastoreClient.get_profiles().  The PROFILES
+        subtree must be mirrored.
+
+        :param names: (optional) An iterable of the names of the profiles to
+        get.  Names that are not configured profiles are ignored.
+        :return: A dictionary of profile name to Profile object.
+        """
+        if names is not None:
+            names = set(names)
+        profiles = {}
+        for key, value in self._subtree_items(PROFILES, PROFILES_PATH):
+            name, _, data_name = key[len(PROFILES_PATH):].partition("/")
+            if names is not None and name not in names:
+                continue
+            profile = profiles.get(name)
+            if profile is None:
+                profile = profiles[name] = Profile(name)
+            if data_name == "tags":
+                profile.tags = set(json.loads(value))
+            elif data_name == "rules":
+                profile.rules = Rules.from_json(value)
+        return profiles
+
+    def get_policies(self, tier_name=None):
+        """
+        Get the policies.  The POLICIES subtree must be mirrored.
+
+        :param tier_name: (optional) Only get the policies in this tier.
+        :return: A list of Policy objects, sorted by tier and policy name.
+        """
+        prefix = TIERS_PATH
+        if tier_name:
+            prefix += tier_name + "/"
+        policies = []
+        for key, value in self._subtree_items(POLICIES, prefix):
+            parts = key[len(TIERS_PATH):].split("/")
+            if len(parts) != 3 or parts[1] != "policy":
+                # Tier metadata.
+                continue
+            data = json.loads(value)
+            policy = Policy(parts[0], parts[2])
+            policy.order = data.get("order", policy.order)
+            policy.selector = data.get("selector", policy.selector)
+            policy.rules = Rules.from_json(value)
+            policies.append(policy)
+        return policies
+
+    def get_ip_pools(self, version):
+        """
+        :param version: 4 for IPv4, 6 for IPv6
+        :return: The list of IPPools.  The POOLS subtree must be mirrored.
+        """
+        assert version in (4, 6)
+        return [IPPool.from_json(value) for _, value in
+                self._subtree_items(POOLS,
+                                    IP_POOLS_PATH % {"version": version})
+                if value]
+
+    def get_hostnames_from_ips(self, ip_list):
+        """
+        Get the hostnames that are using the given IPs as their calico node
+        IPs.  The BGP subtree must be mirrored.
+
+        :param ip_list: The list of IPs to get hostnames for.
+        :return: A dictionary of {IP:hostname} the hosts that own the given
+        IPs.
+        """
+        ip_set = set(ip_list)
+        ip_host_dict = {}
+        for key, value in self._subtree_items(BGP, BGP_HOSTS_PATH):
+            match = HOSTNAME_IP_DATASTORE_RE.match(key)
+            if match and value in ip_set:
+                ip_host_dict[value] = match.group(1)
+        return ip_host_dict
+
+    def _subtree_items(self, subtree, prefix):
+        """
+        :return: The items with the key prefix, which must be in a mirrored
+        subtree.
+        """
+        if subtree not in self.subtrees:
+            raise ValueError("The %s subtree is not mirrored" % subtree)
+        return self.items(prefix)
+
+    def _on_load(self, path, items):
+        with self._lock:
+            tree = self._trees[path]
+            new_tree = dict(items or [])
+            changes = [(DELETE, key, None) for key in tree
+                       if key not in new_tree]
+            changes.extend((SET, key, value)
+                           for key, value in new_tree.iteritems()
+                           if tree.get(key) != value)
+            changes.sort(key=lambda change: change[1])
+            self._trees[path] = new_tree
+            listeners = list(self._listeners)
+        self._notify(listeners, changes)
+
+    def _on_change(self, path, action, key, value, is_dir):
+        with self._lock:
+            tree = self._trees[path]
+            if action in _DELETE_ACTIONS:
+                prefix = key.rstrip("/") + "/"
+                removed = sorted(k for k in tree
+                                 if k == key or k.startswith(prefix))
+                for k in removed:
+                    del tree[k]
+                changes = [(DELETE, k, None) for k in removed]
+            elif is_dir or tree.get(key) == value:
+                changes = []
+            else:
+                tree[key] = value
+                changes = [(SET, key, value)]
+            listeners = list(self._listeners)
+        self._notify(listeners, changes)
+
+    def _notify(self, listeners, changes):
+        for action, key, value in changes:
+            for listener in listeners:
+                try:
+                    listener(action, key, value)
+                except Exception:
+                    _log.exception("Informer listener failed for %s", key)
@@ -12,13 +12,19 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 from collections import deque
+from itertools import islice
 
 from etcd import EtcdKeyNotFound, EtcdAlreadyExist, EtcdCompareFailed
 
 from netaddr import IPAddress, IPNetwork
+import json
 import logging
 import random
+import threading
+import time
+import zlib
 
+from pycalico import metrics
 from pycalico.datastore_datatypes import IPPool, IPAMConfig
 from pycalico.datastore import DatastoreClient, handle_errors
 from pycalico.datastore import (IPAM_HOSTS_PATH,
@@ -26,7 +32,11 @@ from pycalico.datastore import (IPAM_HOSTS_PATH,
                                 IPAM_HOST_AFFINITY_PATH,
                                 IPAM_BLOCK_PATH,
                                 IPAM_HANDLE_PATH,
+                                IPAM_HANDLE_SHARD_PATH,
+                                IPAM_HANDLE_SHARDS_PATH,
+                                IPAM_V_PATH,
                                 IPAM_CONFIG_PATH)
+from pycalico.etcdv3 import TXN_PUT, TXN_DELETE
 from pycalico.datastore_errors import (DataStoreError,
                                        PoolNotFound,
                                        InvalidBlockSizeError)
@@ -34,11 +44,12 @@ from pycalico.block import (AllocationBlock,
                             get_block_cidr_for_address,
                             validate_block_size,
                             BLOCK_PREFIXLEN,
+                            BLOCK_SIZE,
                             AddressNotAssignedError,
                             NoHostAffinityError)
 from pycalico.handle import (AllocationHandle,
                              AddressCountTooLow)
-from pycalico.util import get_hostname
+from pycalico.util import get_hostname, map_concurrently, RateLimiter
 
 _log = logging.getLogger(__name__)
 _log.addHandler(logging.NullHandler())
@@ -47,6 +58,49 @@ RETRIES = 100
 
 KEY_ERROR_RETRIES = 3
 
+# The maximum number of blocks that are read or written in parallel when a
+# single operation spans multiple blocks.
+MAX_CONCURRENT_BLOCKS = 10
+
+# Default thresholds used when compacting sparsely used affine blocks.  A block
+# is sparse if it has at least one, but no more than
+# SPARSE_BLOCK_MAX_ALLOCATED addresses allocated.
+SPARSE_BLOCK_MAX_ALLOCATED = 2
+MAX_SPARSE_BLOCKS_PER_HOST = 1
+
+# Time, in seconds, for which a block that failed a compare-and-swap is tried
+# after the host's other affine blocks when auto-assigning.
+CAS_FAILURE_BACKOFF = 1.0
+
+# Per-block results reported by claim_affinity_blocks() and
+# release_affinity_blocks().
+AFFINITY_CLAIMED = "claimed"
+AFFINITY_RELEASED = "released"
+AFFINITY_NOT_CLAIMED = "not-claimed"
+AFFINITY_CLAIMED_BY_OTHER = "claimed-by-other"
+AFFINITY_SKIPPED = "skipped"
+AFFINITY_ERROR = "error"
+
+# Number of directories handles are spread across when handle sharding is
+# enabled.  Changing this moves existing sharded handles.
+HANDLE_SHARDS = 256
+
+# Read consistency levels for read-only queries.  Quorum reads are
+# linearizable, and are served by the etcd leader.  Local reads are served by
+# the etcd member the client is connected to, spreading load across the
+# cluster, but may return stale data.  Writes always use quorum reads, and
+# compare-and-swap to detect conflicting updates.
+READ_QUORUM = "quorum"
+READ_LOCAL = "local"
+READ_CONSISTENCIES = (READ_QUORUM, READ_LOCAL)
+
+# The header line of an IPAM export.
+EXPORT_FORMAT = "calico-ipam"
+EXPORT_VERSION = 1
+
+# The number of exported keys read into memory at a time when restoring.
+RESTORE_BATCH_SIZE = 1000
+
 
 class BlockHandleReaderWriter(DatastoreClient):
     """
@@ -57,10 +111,33 @@ class BlockHandleReaderWriter(DatastoreClient):
     class.
     """
 
-    def _read_block(self, block_cidr):
+    # Whether new handles are written to the sharded handle layout.  Handles
+    # that are not found in the sharded layout are then looked up in the
+    # legacy flat layout.
+    shard_handles = False
+
+    # The default read consistency of read-only queries.
+    read_consistency = READ_QUORUM
+
+    def _quorum(self, consistency):
+        """
+        :param consistency: The read consistency, or None for the client's
+        default read consistency.
+        :return: The etcd quorum read argument for the consistency.
+        """
+        if consistency is None:
+            consistency = self.read_consistency
+        if consistency not in READ_CONSISTENCIES:
+            raise ValueError("Invalid read consistency %r, must be one of %s"
+                             % (consistency, ", ".join(READ_CONSISTENCIES)))
+        return consistency == READ_QUORUM
+
+    def _read_block(self, block_cidr, quorum=True):
         """
         Read the block from the data store.
         :param block_cidr: The IPNetwork identifier for a block.
+        :param quorum: Whether to perform a quorum read.  Only read-only
+        queries should pass False.
         :return: An AllocationBlock object
         """
         key = _block_datastore_key(block_cidr)
@@ -68,7 +145,7 @@ class BlockHandleReaderWriter(DatastoreClient):
             # Use quorum=True to ensure we don't get stale reads.  Without this
             # we allow many subtle race conditions, such as creating a block,
             # then later reading it and finding it doesn't exist.
-            result = self.etcd_client.read(key, quorum=True)
+            result = self.etcd_client.read(key, quorum=quorum)
         except EtcdKeyNotFound:
             raise KeyError(str(block_cidr))
         block = AllocationBlock.from_etcd_result(result)
@@ -85,6 +162,7 @@ class BlockHandleReaderWriter(DatastoreClient):
             try:
                 self.etcd_client.update(block.update_result())
             except EtcdCompareFailed:
+                metrics.CAS_CONFLICTS.inc(object="block")
                 raise CASError(str(block.cidr))
         else:
             _log.debug("CAS Write new block %s", block)
@@ -93,6 +171,7 @@ class BlockHandleReaderWriter(DatastoreClient):
             try:
                 self.etcd_client.write(key, value, prevExist=False)
             except EtcdAlreadyExist:
+                metrics.CAS_CONFLICTS.inc(object="block")
                 raise CASError(str(block.cidr))
 
     def _delete_block(self, block):
@@ -106,6 +185,140 @@ class BlockHandleReaderWriter(DatastoreClient):
                 block.db_result.key,
                 prevIndex=block.db_result.modifiedIndex)
         except EtcdCompareFailed:
+            metrics.CAS_CONFLICTS.inc(object="block")
+            raise CASError(str(block.cidr))
+
+    def _supports_txn(self):
+        """
+        :return: True if the datastore backend supports multi-key
+        transactions.
+        """
+        return callable(getattr(self.etcd_client, "txn", None))
+
+    def _commit_block(self, block, handle_amounts, delete=False):
+        """
+        Write (or delete) a block after assigning or releasing addresses in
+        it, and update the handles of those addresses.
+
+        If the datastore backend supports transactions, the block and the
+        handles are written in a single transaction.  Otherwise, handles
+        gaining addresses are incremented before the block is written (and
+        decremented again if the block write fails), and handles losing
+        addresses are decremented after the block is written.
+
+        Raises CASError if the block has been modified.
+
+        :param block: The AllocationBlock to write.
+        :param handle_amounts: Dictionary of handle ID to the number of
+        addresses assigned (positive) or released (negative) with that handle
+        in the block.  The None handle ID is ignored.
+        :param delete: True to delete the block rather than write it.
+        """
+        handle_amounts = dict((handle_id, amount)
+                              for handle_id, amount in handle_amounts.items()
+                              if handle_id is not None and amount)
+        if self._supports_txn():
+            handles = self._adjust_handles(block.cidr, handle_amounts)
+            self._compare_and_swap_block_and_handles(block, handles, delete)
+            return
+
+        for handle_id, amount in handle_amounts.iteritems():
+            if amount > 0:
+                self._increment_handle(handle_id, block.cidr, amount)
+        try:
+            if delete:
+                self._delete_block(block)
+            else:
+                self._compare_and_swap_block(block)
+        except CASError:
+            for handle_id, amount in handle_amounts.iteritems():
+                if amount > 0:
+                    self._decrement_handle(handle_id, block.cidr, amount)
+            raise
+        for handle_id, amount in handle_amounts.iteritems():
+            if amount < 0:
+                self._decrement_handle(handle_id, block.cidr, -amount)
+
+    def _adjust_handles(self, block_cidr, handle_amounts):
+        """
+        Read the given handles and adjust their address counts for a block,
+        without writing them.
+
+        A handle that does not exist is created.  A handle that is missing
+        or has too few addresses to release indicates a corrupt datastore -
+        it is logged and skipped, so that the addresses are still released.
+
+        :param block_cidr: The block CIDR.
+        :param handle_amounts: Dictionary of handle ID to the change in the
+        number of addresses.
+        :return: List of adjusted AllocationHandles.
+        """
+        handles = []
+        for handle_id, amount in handle_amounts.iteritems():
+            try:
+                handle = self._read_handle(handle_id)
+            except KeyError:
+                if amount < 0:
+                    _log.error("Can't decrement block %s on handle %s; it "
+                               "doesn't exist.", str(block_cidr), handle_id)
+                    continue
+                handle = AllocationHandle(handle_id)
+            if amount > 0:
+                handle.increment_block(block_cidr, amount)
+            else:
+                try:
+                    handle.decrement_block(block_cidr, -amount)
+                except AddressCountTooLow:
+                    _log.error("Can't decrement block %s on handle %s; too "
+                               "few allocated.", str(block_cidr), handle_id)
+                    continue
+            handles.append(handle)
+        return handles
+
+    def _compare_and_swap_block_and_handles(self, block, handles,
+                                            delete=False):
+        """
+        Write a block and handles in a single atomic transaction.  Handles
+        that are empty are deleted.
+
+        Raises CASError if the block or any of the handles has been modified.
+
+        :param block: The AllocationBlock to write.
+        :param handles: List of AllocationHandles to write.
+        :param delete: True to delete the block rather than write it.
+        """
+        compare = []
+        success = []
+        if block.db_result is not None:
+            compare.append((block.db_result.key,
+                            block.db_result.modifiedIndex))
+            if delete:
+                success.append((TXN_DELETE, block.db_result.key, None))
+            else:
+                success.append((TXN_PUT, block.db_result.key,
+                                block.to_json()))
+        else:
+            key = _block_datastore_key(block.cidr)
+            compare.append((key, None))
+            success.append((TXN_PUT, key, block.to_json()))
+
+        for handle in handles:
+            if handle.db_result is not None:
+                key = handle.db_result.key
+                compare.append((key, handle.db_result.modifiedIndex))
+                if handle.is_empty():
+                    success.append((TXN_DELETE, key, None))
+                    continue
+            else:
+                assert not handle.is_empty(), "Don't write empty handle."
+                key = self._new_handle_key(handle.handle_id)
+                compare.append((key, None))
+            success.append((TXN_PUT, key, handle.to_json()))
+
+        _log.debug("Transaction writing block %s and %d handles", block,
+                   len(handles))
+        if not self.etcd_client.txn(compare, success):
+            metrics.CAS_CONFLICTS.inc(object="txn")
             raise CASError(str(block.cidr))
 
     def _get_affine_blocks(self, host, version, pool):
@@ -247,9 +460,10 @@ class BlockHandleReaderWriter(DatastoreClient):
                                            block_cidr, block.host_affinity)
 
         # successfully created the block.  Done.
+        metrics.BLOCKS_CLAIMED.inc()
         return
 
-    def _release_block_affinity(self, host, block_cidr):
+    def _release_block_affinity(self, host, block_cidr, max_allocated=None):
         """
         Release a block we think is owned by the specified host.
 
@@ -259,6 +473,13 @@ class BlockHandleReaderWriter(DatastoreClient):
         Raises HostAffinityClaimedError if the block is claimed by a
         different host.
         Raises KeyError if the block does not exist.
+        Raises BlockNotSparseError if max_allocated is specified and the block
+        has more than that number of addresses allocated.
+
+        :param host: The host ID that we expect to have affinity.
+        :param block_cidr: The block CIDR.
+        :param max_allocated: (optional) Only release the block if it has no
+        more than this number of addresses allocated.
         """
         for _ in xrange(RETRIES):
             block = self._read_block(block_cidr)
@@ -269,6 +490,15 @@ class BlockHandleReaderWriter(DatastoreClient):
                           "Block %s is claimed by %s",
                           block_cidr, block.host_affinity)
 
+            if max_allocated is not None:
+                num_allocated = BLOCK_SIZE - block.count_free_addresses()
+                if num_allocated > max_allocated:
+                    _log.info("Block %s has %d addresses allocated - not "
+                              "releasing", block_cidr, num_allocated)
+                    raise BlockNotSparseError(
+                              "Block %s has %d addresses allocated" %
+                              (block_cidr, num_allocated))
+
             try:
                 if block.is_empty():
                     # The block is empty, so just delete the block.
@@ -284,11 +514,13 @@ class BlockHandleReaderWriter(DatastoreClient):
                     self._compare_and_swap_block(block)
             except CASError:
                 # CAS failed.  Retry.
+                metrics.RETRIES.inc(reason="cas_conflict")
                 continue
 
             # We removed or updated the block successfully, so update the host
             # configuration to remove the CIDR.
             _log.debug("Removed affinity for block - deleting host key.")
+            metrics.BLOCKS_RELEASED.inc()
             key = _block_host_key(host, block_cidr)
             try:
                 self.etcd_client.delete(key)
@@ -343,6 +575,7 @@ class BlockHandleReaderWriter(DatastoreClient):
                 self._compare_and_swap_handle(handle)
             except CASError:
                 # CAS failed.  Retry.
+                metrics.RETRIES.inc(reason="cas_conflict")
                 continue
             else:
                 # success!
@@ -354,48 +587,75 @@ class BlockHandleReaderWriter(DatastoreClient):
         Decrement the allocation count on the given handle for the given block
         by the given amount.
         """
+        self._decrement_handle_blocks(handle_id, {block_cidr: amount})
+
+    def _decrement_handle_blocks(self, handle_id, amounts):
+        """
+        Decrement the allocation counts on the given handle for several blocks
+        using a single compare-and-swap.
+
+        :param handle_id: The handle ID to decrement.
+        :param amounts: Dictionary of block CIDR to the amount to decrement
+        that block by.
+        """
         for _ in xrange(RETRIES):
             try:
                 handle = self._read_handle(handle_id)
             except KeyError:
                 # This is bad.  The handle doesn't exist, which means something
                 # really wrong has happened, like DB corruption.
-                _log.error("Can't decrement block %s on handle %s; it doesn't "
-                           "exist.", str(block_cidr), handle_id)
+                _log.error("Can't decrement blocks %s on handle %s; it "
+                           "doesn't exist.",
+                           [str(cidr) for cidr in amounts], handle_id)
                 raise
 
-            try:
-                handle.decrement_block(block_cidr, amount)
-            except AddressCountTooLow:
-                # This is also bad.  The handle says it has fewer than the
-                # requested amount of addresses allocated on the block.  This
-                # means the DB is corrupted.
-                _log.error("Can't decrement block %s on handle %s; too few "
-                           "allocated.", str(block_cidr), handle_id)
-                raise
+            for block_cidr, amount in amounts.iteritems():
+                try:
+                    handle.decrement_block(block_cidr, amount)
+                except AddressCountTooLow:
+                    # This is also bad.  The handle says it has fewer than the
+                    # requested amount of addresses allocated on the block.
+                    # This means the DB is corrupted.
+                    _log.error("Can't decrement block %s on handle %s; too "
+                               "few allocated.", str(block_cidr), handle_id)
+                    raise
 
             try:
                 self._compare_and_swap_handle(handle)
             except CASError:
+                metrics.RETRIES.inc(reason="cas_conflict")
                 continue
             else:
                 # Success!
                 return
         raise RuntimeError("Max retries hit.")  # pragma: no cover
 
-    def _read_handle(self, handle_id):
+    def _read_handle(self, handle_id, quorum=True):
         """
         Read the handle with the given handle ID from the data store.
         :param handle_id: The handle ID to read.
+        :param quorum: Whether to perform a quorum read.  Only read-only
+        queries should pass False.
         :return: AllocationHandle object.
         """
-        key = _handle_datastore_key(handle_id)
-        try:
-            result = self.etcd_client.read(key, quorum=True)
-        except EtcdKeyNotFound:
-            raise KeyError(handle_id)
-        handle = AllocationHandle.from_etcd_result(result)
-        return handle
+        keys = [_handle_datastore_key(handle_id)]
+        if self.shard_handles:
+            keys.insert(0, _sharded_handle_datastore_key(handle_id))
+        for key in keys:
+            try:
+                result = self.etcd_client.read(key, quorum=quorum)
+            except EtcdKeyNotFound:
+                continue
+            return AllocationHandle.from_etcd_result(result)
+        raise KeyError(handle_id)
+
+    def _new_handle_key(self, handle_id):
+        """
+        :return: The datastore key a new handle is written to.
+        """
+        if self.shard_handles:
+            return _sharded_handle_datastore_key(handle_id)
+        return _handle_datastore_key(handle_id)
 
     def _compare_and_swap_handle(self, handle):
         """
@@ -407,27 +667,31 @@ class BlockHandleReaderWriter(DatastoreClient):
             if handle.is_empty():
                 # Handle is now empty.  Delete it instead of an update.
                 _log.debug("Handle %s is empty.", handle.handle_id)
-                key = _handle_datastore_key(handle.handle_id)
                 try:
                     self.etcd_client.delete(
-                        key,
+                        handle.db_result.key,
                         prevIndex=handle.db_result.modifiedIndex)
-                except EtcdCompareFailed:
+                except (EtcdCompareFailed, EtcdKeyNotFound):
+                    # The handle may also have been moved by a handle
+                    # migration.
+                    metrics.CAS_CONFLICTS.inc(object="handle")
                     raise CASError(handle.handle_id)
             else:
                 _log.debug("Handle %s is not empty.", handle.handle_id)
                 try:
                     self.etcd_client.update(handle.update_result())
-                except EtcdCompareFailed:
+                except (EtcdCompareFailed, EtcdKeyNotFound):
+                    metrics.CAS_CONFLICTS.inc(object="handle")
                     raise CASError(handle.handle_id)
         else:
             _log.debug("CAS Write new handle %s", handle.handle_id)
             assert not handle.is_empty(), "Don't write empty handle."
-            key = _handle_datastore_key(handle.handle_id)
+            key = self._new_handle_key(handle.handle_id)
             value = handle.to_json()
             try:
                 self.etcd_client.write(key, value, prevExist=False)
             except EtcdAlreadyExist:
+                metrics.CAS_CONFLICTS.inc(object="handle")
                 raise CASError(handle.handle_id)
 
     def _read_blocks(self):
@@ -437,23 +701,35 @@ class BlockHandleReaderWriter(DatastoreClient):
                  (List of IPv4 AllocationBlocks,
                   List of IPv6 AllocationBlocks)
         """
-        blocks = {}
-        for version in (4, 6):
-            blocks_path = IPAM_BLOCK_PATH % {"version": version}
-            try:
-                leaves = self.etcd_client.read(blocks_path,
-                                               quorum=True,
-                                               recursive=True).leaves
-            except EtcdKeyNotFound:
-                # Path doesn't exist.
-                blocks[version] = []
-            else:
-                # Convert the leaf values to AllocationBlocks.  We need to
-                # handle an empty leaf value because when no pools are
-                # configured the recursive read returns the parent directory.
-                blocks[version] = [AllocationBlock.from_etcd_result(leaf) for leaf in leaves
-                                                                          if leaf.value]
-        return blocks[4], blocks[6]
+        return list(self._iter_blocks(4)), list(self._iter_blocks(6))
+
+    def _iter_blocks(self, version, quorum=True):
+        """
+        Iterate through all the allocated blocks of the given IP version,
+        using a single recursive read.  Blocks are decoded one at a time as
+        the caller iterates, so the caller need not hold every block in
+        memory.
+
+        :param version: 4 for IPv4, 6 for IPv6.
+        :param quorum: Whether to perform a quorum read.  Only read-only
+        queries should pass False.
+        :return: An iterator of AllocationBlocks.
+        """
+        blocks_path = IPAM_BLOCK_PATH % {"version": version}
+        try:
+            leaves = self.etcd_client.read(blocks_path,
+                                           quorum=quorum,
+                                           recursive=True).leaves
+        except EtcdKeyNotFound:
+            # Path doesn't exist.
+            return
+
+        # Convert the leaf values to AllocationBlocks.  We need to handle an
+        # empty leaf value because when no pools are configured the recursive
+        # read returns the parent directory.
+        for leaf in leaves:
+            if leaf.value:
+                yield AllocationBlock.from_etcd_result(leaf)
 
     @handle_errors
     def get_ipam_config(self):
@@ -528,6 +804,14 @@ class HostAffinityClaimedError(DataStoreError):
     pass
 
 
+class BlockNotSparseError(DataStoreError):
+    """
+    Tried to release the affinity of a sparsely used block, but the block has
+    more addresses allocated than expected.
+    """
+    pass
+
+
 class IPAMConfigConflictError(DataStoreError):
     """
     Attempt to change IPAM configuration that conflict with existing
@@ -536,6 +820,14 @@ class IPAMConfigConflictError(DataStoreError):
     pass
 
 
+class HandleMigrationError(DataStoreError):
+    """
+    A handle could not be moved to the sharded handle layout because it was
+    modified in both layouts while being moved.
+    """
+    pass
+
+
 def _block_datastore_key(block_cidr):
     """
     Translate a block CIDR into a datastore key.
@@ -570,8 +862,113 @@ def _handle_datastore_key(handle_id):
     return IPAM_HANDLE_PATH + handle_id
 
 
+def _sharded_handle_datastore_key(handle_id):
+    """
+    Translate a handle_id into a datastore key in the sharded handle layout.
+    :param handle_id: String key
+    :return: etcd key as string.
+    """
+    shard = (zlib.crc32(handle_id) & 0xffffffff) % HANDLE_SHARDS
+    return IPAM_HANDLE_SHARD_PATH % {"shard": "%02x" % shard} + handle_id
+
+
+def _raise_first_error(report):
+    """
+    Raise the first error in a per-block affinity report, if any.
+    :param report: List of (block CIDR, result, exception) tuples.
+    """
+    for _, result, error in report:
+        if result == AFFINITY_ERROR:
+            raise error
+
+
+def _iter_export_records(f):
+    """
+    Parse an IPAM export written by IPAMClient.export_ipam().  Lines are
+    parsed one at a time as the caller iterates.
+
+    :param f: The file object to read the export from.
+    :return: An iterator of (datastore key, value) tuples.
+    """
+    try:
+        header = json.loads(f.readline())
+    except ValueError:
+        header = None
+    if (not isinstance(header, dict) or
+            header.get("format") != EXPORT_FORMAT):
+        raise ValueError("Not an IPAM export")
+    if header.get("version") != EXPORT_VERSION:
+        raise ValueError("Unsupported IPAM export version %s" %
+                         header.get("version"))
+
+    for line_num, line in enumerate(f, 2):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            key = record["key"]
+            value = record["value"]
+        except (ValueError, TypeError, KeyError):
+            raise ValueError("Invalid IPAM export record on line %d" %
+                             line_num)
+        # Only allow keys within the IPAM tree.
+        if (not isinstance(key, basestring) or not key or
+                key.startswith("/") or ".." in key.split("/")):
+            raise ValueError("Invalid IPAM export key %r on line %d" %
+                             (key, line_num))
+        yield IPAM_V_PATH + key, value
+
+
 class IPAMClient(BlockHandleReaderWriter):
 
+    def __init__(self, etcd_client=None, spare_block_watermark=None,
+                 shard_handles=False, read_consistency=READ_QUORUM):
+        """
+        :param etcd_client: (optional) The datastore backend, see
+        DatastoreClient.
+        :param spare_block_watermark: (optional) Enables proactive claiming of
+        affine blocks.  When set, after each auto-assignment the client checks
+        (in a background thread) the number of free addresses across the
+        host's affine blocks, and if it has dropped below this value, claims
+        a new affine block for the host.  This keeps block creation off the
+        assignment path, and is intended for long-running clients - a process
+        that exits straight after assigning addresses may not complete the
+        background claim.  If the host's blocks are exhausted before a spare
+        block is claimed, assignment still falls back to claiming a block
+        inline.
+        :param shard_handles: (optional) Write new allocation handles to the
+        sharded handle layout, which spreads handles across HANDLE_SHARDS
+        directories rather than keeping them in a single directory.  Handles
+        are still read from the legacy layout if not found in the sharded
+        layout, and can be moved to the sharded layout with migrate_handles().
+        This should be enabled on all clients before migrating handles - a
+        client without it enabled does not see sharded handles.
+        :param read_consistency: (optional) The default read consistency of
+        the read-only queries (get_ip_assignments_by_handle(),
+        get_assignment_attributes() and get_sparse_affine_blocks()), which
+        can also be set on each call.  READ_QUORUM (the default) reads from
+        the etcd leader.  READ_LOCAL reads from any etcd member, spreading
+        the load of queries across the cluster, but may not reflect the most
+        recent updates.  Assignments and releases always use quorum reads.
+        """
+        super(IPAMClient, self).__init__(etcd_client=etcd_client)
+        self.spare_block_watermark = spare_block_watermark
+        self.shard_handles = shard_handles
+        self._quorum(read_consistency)
+        self.read_consistency = read_consistency
+
+        # Background spare block claims, keyed off (host, version, pool).
+        self._spare_block_lock = threading.Lock()
+        self._spare_block_threads = {}
+
+        # What this client has learnt about the affine blocks it assigns from,
+        # used to order blocks when auto-assigning.  Keyed off block CIDR:
+        # - the time of the most recent compare-and-swap failure.
+        # - the number of free addresses when the block was last written.
+        # Blocks are forgotten when they lose their affinity.
+        self._block_cas_failures = {}
+        self._block_free_addresses = {}
+
     @handle_errors
     def auto_assign_ips(self, num_v4, num_v6, handle_id, attributes,
                         pool=(None, None), host=None):
@@ -641,7 +1038,8 @@ class IPAMClient(BlockHandleReaderWriter):
         # globally we have strict_affinity or not.
         _log.info("Looking for %s IPs in already-allocated affine blocks.",
                   num)
-        host_blocks = self._get_affine_blocks(host, ip_version, pool)
+        host_blocks = self._order_affine_blocks(
+            self._get_affine_blocks(host, ip_version, pool), handle_id)
         num_remaining = num
         allocated_ips = self._allocate_ips_explicit_blocks(
             host_blocks,
@@ -693,8 +1091,127 @@ class IPAMClient(BlockHandleReaderWriter):
                     )
                     allocated_ips.extend(ips_from_random_blocks)
         _log.info("Allocated %s of %s requested IPs", len(allocated_ips), num)
+
+        if self.spare_block_watermark is not None and num > 0:
+            self._schedule_spare_block_check(host, ip_version, pool)
         return allocated_ips
 
+    def _order_affine_blocks(self, blocks, handle_id):
+        """
+        Order the host's affine blocks for auto-assignment, to spread
+        concurrent assignments on the host across its blocks.
+
+        The start of the list is rotated based on a hash of the handle, so
+        that concurrent requests start at different blocks.  Blocks are then
+        ordered (keeping that rotation within each group): blocks known to
+        have free addresses, blocks with unknown free space, blocks that
+        recently failed a compare-and-swap, and finally blocks that were full
+        when last written.  Blocks are re-ordered rather than skipped, since
+        this client's knowledge of them may be out of date.
+
+        :param blocks: List of affine block CIDRs.
+        :param handle_id: The handle ID of the request, or None.
+        :return: The ordered list of block CIDRs.
+        """
+        blocks = list(blocks)
+        if len(blocks) <= 1:
+            return blocks
+        if handle_id is not None:
+            start = (zlib.crc32(handle_id) & 0xffffffff) % len(blocks)
+            blocks = blocks[start:] + blocks[:start]
+
+        now = time.time()
+
+        def rank(block_cidr):
+            num_free = self._block_free_addresses.get(block_cidr)
+            failed_at = self._block_cas_failures.get(block_cidr)
+            recent_cas_failure = failed_at is not None and \
+                now - failed_at < CAS_FAILURE_BACKOFF
+            if num_free == 0:
+                return 3
+            elif recent_cas_failure:
+                return 2
+            elif num_free is None:
+                return 1
+            return 0
+
+        return sorted(blocks, key=rank)
+
+    def _schedule_spare_block_check(self, host, ip_version, pool):
+        """
+        Start a background check of the free addresses in the host's affine
+        blocks, unless one is already running for the host, version and pool.
+
+        :param host: The host ID.
+        :param ip_version: 4 or 6, the IP version number.
+        :param pool: The pool to check, or None for any pool.
+        """
+        key = (host, ip_version, str(pool) if pool is not None else None)
+        with self._spare_block_lock:
+            thread = self._spare_block_threads.get(key)
+            if thread is not None and thread.is_alive():
+                _log.debug("Spare block check already running for %s", key)
+                return
+            thread = threading.Thread(target=self._check_spare_blocks,
+                                      args=(host, ip_version, pool))
+            thread.daemon = True
+            self._spare_block_threads[key] = thread
+            thread.start()
+
+    def _wait_for_spare_block_checks(self, timeout=None):
+        """
+        Wait for any in-progress background spare block checks to finish.
+
+        :param timeout: (optional) The maximum time to wait for each check.
+        """
+        with self._spare_block_lock:
+            threads = self._spare_block_threads.values()
+        for thread in threads:
+            thread.join(timeout)
+
+    def _check_spare_blocks(self, host, ip_version, pool):
+        """
+        Claim a new affine block for the host if the number of free addresses
+        across its affine blocks is below the spare block watermark.
+
+        :param host: The host ID.
+        :param ip_version: 4 or 6, the IP version number.
+        :param pool: The pool to check, or None for any pool.
+        :return: The CIDR of the claimed block, or None if no block was
+        claimed.
+        """
+        try:
+            num_free = 0
+            for block_cidr in self._get_affine_blocks(host, ip_version, pool):
+                try:
+                    block = self._read_block(block_cidr)
+                except KeyError:
+                    continue
+                if block.host_affinity == host:
+                    num_free += block.count_free_addresses()
+                if num_free >= self.spare_block_watermark:
+                    _log.debug("Host %s has at least %d free IPv%d addresses",
+                               host, num_free, ip_version)
+                    return None
+
+            ipam_config = self.get_ipam_config()
+            if not ipam_config.auto_allocate_blocks:
+                _log.debug("Block auto-allocation disabled - not claiming "
+                           "spare block")
+                return None
+
+            _log.info("Host %s has %d free IPv%d addresses - claiming spare "
+                      "block", host, num_free, ip_version)
+            block_cidr = self._new_affine_block(host, ip_version, pool,
+                                                ipam_config)
+            _log.info("Claimed spare block %s for host %s", block_cidr, host)
+            return block_cidr
+        except NoFreeBlocksError:
+            _log.info("No free blocks to claim as a spare for host %s", host)
+        except Exception:
+            _log.exception("Failed to claim spare block for host %s", host)
+        return None
+
     def _allocate_ips_explicit_blocks(self, blocks, num, attributes, handle_id,
                                       host):
         """Tries to allocate IPs from the explicitly-listed blocks.
@@ -740,6 +1257,7 @@ class IPAMClient(BlockHandleReaderWriter):
                 key_errors += 1
                 if key_errors <= KEY_ERROR_RETRIES:
                     _log.debug("Queueing block %s for retry.", block_id)
+                    metrics.RETRIES.inc(reason="missing_block")
                     remaining_host_blocks.append(block_id)
                 else:
                     _log.warning("Stopping retry of block %s.", block_id)
@@ -751,6 +1269,7 @@ class IPAMClient(BlockHandleReaderWriter):
                 # simultaneously).  If that happens, just move to the next one.
                 _log.warning("No host affinity on block %s; skipping.",
                              block_id)
+                self._forget_block(block_id)
                 continue
             allocated_ips.extend(ips)
         return allocated_ips
@@ -874,26 +1393,29 @@ class IPAMClient(BlockHandleReaderWriter):
                                                 attributes=attributes,
                                                 host=host,
                                                 affinity_check=affinity_check)
+            # Only the host's affine blocks are ordered by what we learn.
+            affine = block.host_affinity == host
             if len(unconfirmed_ips) == 0:
                 _log.debug("Block %s is full.", block_cidr)
+                if affine:
+                    self._block_free_addresses[block_cidr] = 0
                 return []
 
-            # If using a handle, increment the handle by the number of
-            # confirmed IPs.
-            if handle_id is not None:
-                self._increment_handle(handle_id,
-                                       block_cidr,
-                                       len(unconfirmed_ips))
-
+            # Try to commit.  If using a handle, increment the handle by the
+            # number of confirmed IPs.
             try:
-                self._compare_and_swap_block(block)
+                self._commit_block(block, {handle_id: len(unconfirmed_ips)})
             except CASError:
                 _log.debug("CAS failed on block %s", block_cidr)
-                if handle_id is not None:
-                    self._decrement_handle(handle_id,
-                                           block_cidr,
-                                           len(unconfirmed_ips))
+                metrics.RETRIES.inc(reason="cas_conflict")
+                if affine:
+                    self._block_cas_failures[block_cidr] = time.time()
             else:
+                if affine:
+                    self._block_free_addresses[block_cidr] = \
+                        block.count_free_addresses()
+                metrics.ADDRESSES_ALLOCATED.inc(len(unconfirmed_ips),
+                                                version=block_cidr.version)
                 return unconfirmed_ips
         raise RuntimeError("Hit Max Retries.")
 
@@ -942,6 +1464,7 @@ class IPAMClient(BlockHandleReaderWriter):
                     except HostAffinityClaimedError:
                         _log.debug("Someone else claimed block %s before us.",
                                    block_cidr)
+                        metrics.RETRIES.inc(reason="affinity_conflict")
                         continue
                     # Block exists now, retry writing to it.
                     _log.debug("Claimed block %s", block_cidr)
@@ -955,20 +1478,14 @@ class IPAMClient(BlockHandleReaderWriter):
             # affinity and the host affinity does not match the host.
             block.assign(address, handle_id, attributes, host)
 
-            # If using a handle, increment by one IP
-            if handle_id is not None:
-                self._increment_handle(handle_id, block_cidr, 1)
-
-            # Try to commit.
+            # Try to commit, incrementing the handle (if any) by one IP.
             try:
-                self._compare_and_swap_block(block)
+                self._commit_block(block, {handle_id: 1})
+                metrics.ADDRESSES_ALLOCATED.inc(version=address.version)
                 return  # Success!
             except CASError:
                 _log.debug("CAS failed on block %s", block_cidr)
-                if handle_id is not None:
-                    self._decrement_handle(handle_id,
-                                           block_cidr,
-                                           1)
+                metrics.RETRIES.inc(reason="cas_conflict")
         raise RuntimeError("Hit max retries.")
 
     @handle_errors
@@ -1019,27 +1536,28 @@ class IPAMClient(BlockHandleReaderWriter):
             if len(unallocated) == len(addresses):
                 # All the addresses are already unallocated.
                 return addresses
-            # Try to commit
+            # Try to commit, decrementing the handles.  If the block is now
+            # empty and there is no host affinity to the block then delete the
+            # block, otherwise just update the block configuration.
+            delete = block.is_empty() and not block.host_affinity
+            if delete:
+                _log.debug("Deleting empty non-affine block")
+            else:
+                _log.debug("Updating assignments in block")
             try:
-                # If the block is now empty and there is no host affinity to
-                # the block then delete the block, otherwise just update the
-                # block configuration.
-                if block.is_empty() and not block.host_affinity:
-                    _log.debug("Deleting empty non-affine block")
-                    self._delete_block(block)
-                else:
-                    _log.debug("Updating assignments in block")
-                    self._compare_and_swap_block(block)
+                self._commit_block(block,
+                                   dict((handle_id, -amount) for
+                                        handle_id, amount in
+                                        handles.iteritems()),
+                                   delete=delete)
             except CASError:
+                metrics.RETRIES.inc(reason="cas_conflict")
                 continue
             else:
-                # Success!  Decrement handles.
-                for handle_id, amount in handles.iteritems():
-                    if handle_id is not None:
-                        # Skip the None handle, it's a special value meaning
-                        # the addresses were not allocated with a handle.
-                        self._decrement_handle(handle_id, block_cidr, amount)
-
+                self._block_released(block_cidr, None if delete else block)
+                metrics.ADDRESSES_RELEASED.inc(
+                    len(addresses) - len(unallocated),
+                    version=block_cidr.version)
                 return unallocated
 
         raise RuntimeError("Hit Max retries.")  # pragma: no cover
@@ -1055,27 +1573,45 @@ class IPAMClient(BlockHandleReaderWriter):
         return any([cidr in pool for pool in pools])
 
     @handle_errors
-    def get_ip_assignments_by_handle(self, handle_id):
+    def get_ip_assignments_by_handle(self, handle_id, consistency=None):
         """
         Return a list of IPAddresses assigned to the key.
+
+        The blocks referenced by the handle are read concurrently.
+
         :param handle_id: Key to query e.g. used on assign_ip() or
         auto_assign_ips().
+        :param consistency: (optional) The read consistency, READ_QUORUM or
+        READ_LOCAL.  Defaults to the client's read consistency.
         :return: List of IPAddresses
         """
         assert isinstance(handle_id, str)
-        handle = self._read_handle(handle_id)  # Can throw KeyError, let it.
+        quorum = self._quorum(consistency)
+        # Can throw KeyError, let it.
+        handle = self._read_handle(handle_id, quorum=quorum)
+
+        block_cidrs = [IPNetwork(block_str) for block_str in handle.block]
+        results = map_concurrently(
+            lambda block_cidr: self._read_block(block_cidr, quorum=quorum),
+            block_cidrs, MAX_CONCURRENT_BLOCKS)
 
         ip_assignments = []
-        for block_str in handle.block:
-            block_cidr = IPNetwork(block_str)
-            try:
-                block = self._read_block(block_cidr)
-            except KeyError:
+        errors = []
+        for block_cidr, (block, error) in zip(block_cidrs, results):
+            if isinstance(error, KeyError):
                 _log.warning("Couldn't read block %s referenced in handle %s.",
-                             block_str, handle_id)
+                             block_cidr, handle_id)
+                continue
+            elif error is not None:
+                errors.append(error)
                 continue
             ips = block.get_ip_assignments_by_handle(handle_id)
             ip_assignments.extend(ips)
+
+        if errors:
+            _log.error("Failed to read %d of %d blocks referenced in handle "
+                       "%s", len(errors), len(block_cidrs), handle_id)
+            raise errors[0]
         return ip_assignments
 
     @handle_errors
@@ -1083,6 +1619,11 @@ class IPAMClient(BlockHandleReaderWriter):
         """
         Release all addresses assigned to the key.
 
+        The blocks referenced by the handle are released concurrently, and the
+        handle is then updated once for all of the released addresses.  If
+        releasing from any block fails, the handle is still updated for the
+        blocks that were released before the first error is raised.
+
         :param handle_id: Key to query, e.g. used on assign_ip() or
         auto_assign_ips().
         :return: None.
@@ -1090,17 +1631,40 @@ class IPAMClient(BlockHandleReaderWriter):
         assert isinstance(handle_id, str)
         handle = self._read_handle(handle_id)  # Can throw KeyError, let it.
 
-        # Loop through blocks, releasing.
-        for block_str in handle.block:
-            block_cidr = IPNetwork(block_str)
-            self._release_ip_by_handle_block(handle_id, block_cidr)
+        block_cidrs = [IPNetwork(block_str) for block_str in handle.block]
+        results = map_concurrently(
+            lambda block_cidr: self._release_ip_by_handle_block(handle_id,
+                                                                block_cidr),
+            block_cidrs,
+            MAX_CONCURRENT_BLOCKS)
+
+        released = {}
+        errors = []
+        for block_cidr, (num_released, error) in zip(block_cidrs, results):
+            if error is not None:
+                errors.append(error)
+            elif num_released:
+                released[block_cidr] = num_released
+
+        # Update the handle for everything we managed to release.
+        if released:
+            self._decrement_handle_blocks(handle_id, released)
+
+        if errors:
+            _log.error("Failed to release %d of %d blocks referenced in "
+                       "handle %s", len(errors), len(block_cidrs), handle_id)
+            raise errors[0]
 
     def _release_ip_by_handle_block(self, handle_id, block_cidr):
         """
         Release all address in a block with the given handle ID.
+
+        This does not update the handle; the caller is responsible for
+        decrementing the handle by the number of released addresses.
+
         :param handle_id: The handle ID to find addresses with.
         :param block_cidr: The block to release addresses on.
-        :return: None
+        :return: The number of addresses released.
         """
         for _ in xrange(RETRIES):
             try:
@@ -1110,7 +1674,7 @@ class IPAMClient(BlockHandleReaderWriter):
                 # unallocated.  This can happen if the handle is overestimating
                 # the number of assigned addresses, which is a transient, but
                 # expected condition.
-                return
+                return 0
 
             num_release = block.release_by_handle(handle_id)
             if num_release == 0:
@@ -1118,36 +1682,74 @@ class IPAMClient(BlockHandleReaderWriter):
                 # so all addresses are already unallocated.  This can happen if
                 # the handle is overestimating the number of assigned
                 # addresses, which is a transient, but expected condition.
-                return
+                return 0
 
             try:
                 self._compare_and_swap_block(block)
             except CASError:
                 # Failed to update, retry.
+                metrics.RETRIES.inc(reason="cas_conflict")
                 continue
 
-            # Successfully updated block, update the handle if necessary.
-            if handle_id is not None:
-                # Skip the None handle, it's a special value meaning
-                # the addresses were not allocated with a handle.
-                self._decrement_handle(handle_id, block_cidr, num_release)
-                return
+            # Successfully updated block.
+            self._block_released(block_cidr, block)
+            metrics.ADDRESSES_RELEASED.inc(num_release,
+                                           version=block_cidr.version)
+            return num_release
         raise RuntimeError("Hit Max retries.")  # pragma: no cover
 
+    def _block_released(self, block_cidr, block):
+        """
+        Update what this client knows about a block after releasing addresses
+        from it.
+
+        :param block_cidr: The block CIDR.
+        :param block: The AllocationBlock as written, or None if the block
+        was deleted.
+        """
+        if block is None or not block.host_affinity:
+            self._forget_block(block_cidr)
+        elif block_cidr in self._block_free_addresses:
+            self._block_free_addresses[block_cidr] = \
+                block.count_free_addresses()
+
+    def _forget_block(self, block_cidr):
+        """
+        Forget what this client knows about a block, for example when it is
+        no longer affine to the host.
+
+        :param block_cidr: The block CIDR.
+        """
+        self._block_free_addresses.pop(block_cidr, None)
+        self._block_cas_failures.pop(block_cidr, None)
+
+    def _release_block_affinity(self, host, block_cidr, *args, **kwargs):
+        """
+        Release a block's affinity, as
+        BlockHandleReaderWriter._release_block_affinity(), and forget what
+        this client knows about the block.
+        """
+        super(IPAMClient, self)._release_block_affinity(host, block_cidr,
+                                                        *args, **kwargs)
+        self._forget_block(block_cidr)
+
     @handle_errors
-    def get_assignment_attributes(self, address):
+    def get_assignment_attributes(self, address, consistency=None):
         """
         Return the attributes of a given address.
 
         :param address: IPAddress to query.
+        :param consistency: (optional) The read consistency, READ_QUORUM or
+        READ_LOCAL.  Defaults to the client's read consistency.
         :return: The attributes for the address as passed to auto_assign() or
         assign().
         """
         assert isinstance(address, IPAddress)
         block_cidr = get_block_cidr_for_address(address)
+        quorum = self._quorum(consistency)
 
         try:
-            block = self._read_block(block_cidr)
+            block = self._read_block(block_cidr, quorum=quorum)
         except KeyError:
             _log.warning("Couldn't read block %s for requested address %s",
                          block_cidr, address)
@@ -1157,7 +1759,8 @@ class IPAMClient(BlockHandleReaderWriter):
             return attributes
 
     @handle_errors
-    def claim_affinity(self, cidr, host=None):
+    def claim_affinity(self, cidr, host=None, continue_on_conflict=False,
+                       max_concurrent=MAX_CONCURRENT_BLOCKS):
         """
         Claim affinity for the blocks covered by the requested CIDR.
 
@@ -1166,11 +1769,53 @@ class IPAMClient(BlockHandleReaderWriter):
         block size.
         :param host: (optional) The host ID to use for affinity in assigning IP
         addresses.  Defaults to the hostname returned by get_hostname().
+        :param continue_on_conflict: (optional) See claim_affinity_blocks().
+        :param max_concurrent: (optional) See claim_affinity_blocks().
 
         :return: A tuple of:
                  ([IPNetwork<blocks claimed>],
                   [IPNetwork<blocks that were claimed by another host>])
         """
+        report = self.claim_affinity_blocks(
+            cidr, host=host, continue_on_conflict=continue_on_conflict,
+            max_concurrent=max_concurrent)
+        _raise_first_error(report)
+        claimed = [block_cidr for block_cidr, result, _ in report
+                   if result == AFFINITY_CLAIMED]
+        unclaimed = [block_cidr for block_cidr, result, _ in report
+                     if result == AFFINITY_CLAIMED_BY_OTHER]
+        return claimed, unclaimed
+
+    @handle_errors
+    def claim_affinity_blocks(self, cidr, host=None,
+                              continue_on_conflict=False,
+                              max_concurrent=MAX_CONCURRENT_BLOCKS):
+        """
+        Claim affinity for the blocks covered by the requested CIDR, reporting
+        the result for each block.
+
+        Blocks are claimed in parallel, up to max_concurrent at a time.  By
+        default, the remaining blocks are skipped once a block is found to be
+        claimed by another host - blocks that were already being claimed at
+        the time are still claimed.
+
+        :param cidr: The CIDR covering the blocks to be claimed.  Raises a
+        InvalidBlockSizeError if the CIDR is smaller than the minimum allowable
+        block size.
+        :param host: (optional) The host ID to use for affinity in assigning IP
+        addresses.  Defaults to the hostname returned by get_hostname().
+        :param continue_on_conflict: (optional) If True, carry on claiming the
+        remaining blocks when a block is claimed by another host.
+        :param max_concurrent: (optional) The maximum number of blocks to
+        claim in parallel.
+
+        :return: A list, in block order, of tuples of
+                 (IPNetwork<block>, <result>, <exception>), where result is one
+                 of AFFINITY_CLAIMED, AFFINITY_CLAIMED_BY_OTHER,
+                 AFFINITY_SKIPPED or AFFINITY_ERROR.  The exception is the
+                 error hit claiming the block, or None if the result is not
+                 AFFINITY_ERROR.
+        """
         assert isinstance(cidr, IPNetwork)
         if not validate_block_size(cidr):
             _log.info("Requested CIDR %s is too small", cidr)
@@ -1184,38 +1829,70 @@ class IPAMClient(BlockHandleReaderWriter):
             raise PoolNotFound("Requested CIDR is not in a configured IP "
                                "Pool.")
 
-        claimed = []
-        unclaimed = []
-
         # Get the IPAM configuration.  We need this when claiming block
         # affinities.
         ipam_config = self.get_ipam_config()
 
-        for block_cidr in cidr.subnet(BLOCK_PREFIXLEN[cidr.version]):
-            try:
-                self._claim_block_affinity(host, block_cidr, ipam_config)
-            except HostAffinityClaimedError:
-                unclaimed.append(block_cidr)
-                break
-            else:
-                claimed.append(block_cidr)
-
-        return claimed, unclaimed
+        return self._batch_block_affinities(
+            list(cidr.subnet(BLOCK_PREFIXLEN[cidr.version])),
+            lambda block_cidr: self._claim_block_affinity(host, block_cidr,
+                                                          ipam_config),
+            AFFINITY_CLAIMED,
+            [(HostAffinityClaimedError, AFFINITY_CLAIMED_BY_OTHER,
+              not continue_on_conflict)],
+            max_concurrent)
 
     @handle_errors
-    def release_affinity(self, cidr, host=None):
+    def release_affinity(self, cidr, host=None,
+                         max_concurrent=MAX_CONCURRENT_BLOCKS):
         """
         :param cidr: The CIDR covering the blocks to be released.  Raises a
         InvalidBlockSizeError if the CIDR is smaller than the minimum allowable
         block size.
         :param host: (optional) The host ID to compare against the affinity of
         each block that is being released.
+        :param max_concurrent: (optional) See release_affinity_blocks().
 
         :return: A tuple of:
                  ([IPNetwork<blocks released>],
                   [IPNetwork<blocks that were not claimed>],
                   [IPNetwork<blocks that were claimed by another host>])
         """
+        report = self.release_affinity_blocks(cidr, host=host,
+                                              max_concurrent=max_concurrent)
+        _raise_first_error(report)
+        results = dict((result, []) for result in (AFFINITY_RELEASED,
+                                                   AFFINITY_NOT_CLAIMED,
+                                                   AFFINITY_CLAIMED_BY_OTHER))
+        for block_cidr, result, _ in report:
+            results[result].append(block_cidr)
+        return (results[AFFINITY_RELEASED],
+                results[AFFINITY_NOT_CLAIMED],
+                results[AFFINITY_CLAIMED_BY_OTHER])
+
+    @handle_errors
+    def release_affinity_blocks(self, cidr, host=None,
+                                max_concurrent=MAX_CONCURRENT_BLOCKS):
+        """
+        Release affinity for the blocks covered by the requested CIDR,
+        reporting the result for each block.  Blocks are released in
+        parallel, up to max_concurrent at a time.
+
+        :param cidr: The CIDR covering the blocks to be released.  Raises a
+        InvalidBlockSizeError if the CIDR is smaller than the minimum allowable
+        block size.
+        :param host: (optional) The host ID to compare against the affinity of
+        each block that is being released.
+        :param max_concurrent: (optional) The maximum number of blocks to
+        release in parallel.
+
+        :return: A list, in block order, of tuples of
+                 (IPNetwork<block>, <result>, <exception>), where result is one
+                 of AFFINITY_RELEASED, AFFINITY_NOT_CLAIMED,
+                 AFFINITY_CLAIMED_BY_OTHER or AFFINITY_ERROR.  The exception is
+                 the error hit releasing the block, or None if the result is
+                 not AFFINITY_ERROR.
+        """
         assert isinstance(cidr, IPNetwork)
         if not validate_block_size(cidr):
             _log.info("Requested CIDR %s is too small", cidr)
@@ -1223,29 +1900,71 @@ class IPAMClient(BlockHandleReaderWriter):
                                         "the minimum block size.")
         host = host or get_hostname()
 
-        released = []
-        not_claimed = []
-        claimed_by_other = []
-
-        for block_cidr in cidr.subnet(BLOCK_PREFIXLEN[cidr.version]):
+        return self._batch_block_affinities(
+            list(cidr.subnet(BLOCK_PREFIXLEN[cidr.version])),
+            lambda block_cidr: self._release_block_affinity(host, block_cidr),
+            AFFINITY_RELEASED,
+            [(HostAffinityClaimedError, AFFINITY_CLAIMED_BY_OTHER, False),
+             (KeyError, AFFINITY_NOT_CLAIMED, False)],
+            max_concurrent)
+
+    def _batch_block_affinities(self, block_cidrs, fn, success, failures,
+                                max_concurrent):
+        """
+        Claim or release the affinity of a list of blocks in parallel.
+
+        :param block_cidrs: The list of block CIDRs.
+        :param fn: Called with each block CIDR to claim or release it.
+        :param success: The result reported when fn returns.
+        :param failures: A list of tuples of (exception class, result, stop)
+        for the expected failures of fn.  When fn raises the exception, the
+        result is reported for the block, and if stop is True the remaining
+        blocks are skipped.
+        :param max_concurrent: The maximum number of blocks to process in
+        parallel.
+        :return: A list, in block order, of tuples of
+                 (block CIDR, result, exception).  Unexpected exceptions
+                 raised by fn are reported with a result of AFFINITY_ERROR,
+                 and cause the remaining blocks to be skipped.
+        """
+        stop = threading.Event()
+
+        def process(block_cidr):
+            if stop.is_set():
+                return AFFINITY_SKIPPED
             try:
-                self._release_block_affinity(host, block_cidr)
-            except HostAffinityClaimedError:
-                claimed_by_other.append(block_cidr)
-            except KeyError:
-                not_claimed.append(block_cidr)
+                fn(block_cidr)
+            except Exception as e:
+                for exc_type, result, stop_on_failure in failures:
+                    if isinstance(e, exc_type):
+                        if stop_on_failure:
+                            stop.set()
+                        return result
+                stop.set()
+                raise
+            return success
+
+        report = []
+        results = map_concurrently(process, block_cidrs, max_concurrent)
+        for block_cidr, (result, error) in zip(block_cidrs, results):
+            if error is not None:
+                _log.warning("Error processing affinity of block %s: %r",
+                             block_cidr, error)
+                report.append((block_cidr, AFFINITY_ERROR, error))
             else:
-                released.append(block_cidr)
-
-        return released, not_claimed, claimed_by_other
+                report.append((block_cidr, result, None))
+        return report
 
     @handle_errors
-    def release_host_affinities(self, host):
+    def release_host_affinities(self, host,
+                                max_concurrent=MAX_CONCURRENT_BLOCKS):
         """
         Release affinities for all blocks owned by the host.
 
         :param host: (optional) The host ID to compare against the affinity of
         each block that is being released.
+        :param max_concurrent: (optional) The maximum number of blocks to
+        release in parallel.
         """
         host = host or get_hostname()
 
@@ -1255,14 +1974,128 @@ class IPAMClient(BlockHandleReaderWriter):
         # the block is owned by another host - we simply won't release that
         # block.
         _log.debug("Releasing affinities for %s", host)
-        for version in (4, 6):
-            cidrs = self._get_affine_blocks(host, version, None)
-            for cidr in cidrs:
-                try:
-                    self._release_block_affinity(host, cidr)
-                except HostAffinityClaimedError:
-                    _log.info("Affine block %s is not owned by host %s - skip",
-                              cidr, host)
+        host_blocks = [(host, cidr)
+                       for cidr in self._get_all_affine_blocks(host)]
+        results = self._release_block_affinities(host_blocks, max_concurrent)
+        first_error = None
+        for (_, cidr), (_, error) in zip(host_blocks, results):
+            if isinstance(error, HostAffinityClaimedError):
+                _log.info("Affine block %s is not owned by host %s - skip",
+                          cidr, host)
+            elif error is not None and first_error is None:
+                first_error = error
+        if first_error is not None:
+            raise first_error
+
+    @handle_errors
+    def decommission_hosts(self, hosts, max_concurrent=MAX_CONCURRENT_BLOCKS,
+                           max_blocks_per_sec=None):
+        """
+        Remove multiple IPAM hosts.  For each host this releases the affinity
+        of all of its blocks and, if that succeeds, removes the host specific
+        IPAM data - as remove_ipam_host() does for a single host.
+
+        The blocks of all of the hosts are released in parallel, and the rate
+        at which blocks are released may be limited to reduce the load on the
+        datastore.
+
+        This method does not release individual IP address assigned by the
+        hosts - the IP addresses need to be released separately.
+
+        :param hosts: List of host IDs.
+        :param max_concurrent: (optional) The maximum number of blocks (or
+        hosts, when listing blocks and removing hosts) to process in parallel.
+        :param max_blocks_per_sec: (optional) The maximum number of blocks to
+        release per second across all hosts.  If None, the rate is not
+        limited.
+        :return: Dictionary of host ID to a summary dictionary, containing:
+        - "released": list of block CIDRs released.
+        - "claimed_by_other": list of block CIDRs listed for the host but
+          claimed by another host.  These are left untouched.
+        - "not_found": list of block CIDRs listed for the host that do not
+          exist.
+        - "errors": list of tuples of (block CIDR, exception) for errors hit.
+          The block CIDR is None for errors not specific to a block.
+        - "removed": whether the host IPAM data was removed.  This is only
+          done if there were no errors.
+        """
+        hosts = list(hosts)
+        summary = dict((host, {"released": [],
+                               "claimed_by_other": [],
+                               "not_found": [],
+                               "errors": [],
+                               "removed": False}) for host in hosts)
+
+        _log.info("Decommissioning %d hosts", len(hosts))
+        host_blocks = []
+        listed = map_concurrently(self._get_all_affine_blocks, hosts,
+                                  max_concurrent)
+        for host, (cidrs, error) in zip(hosts, listed):
+            if error is not None:
+                summary[host]["errors"].append((None, error))
+            else:
+                host_blocks.extend((host, cidr) for cidr in cidrs)
+
+        rate_limiter = None
+        if max_blocks_per_sec:
+            rate_limiter = RateLimiter(max_blocks_per_sec)
+        results = self._release_block_affinities(host_blocks, max_concurrent,
+                                                 rate_limiter)
+        for (host, cidr), (_, error) in zip(host_blocks, results):
+            if error is None:
+                summary[host]["released"].append(cidr)
+            elif isinstance(error, HostAffinityClaimedError):
+                summary[host]["claimed_by_other"].append(cidr)
+            elif isinstance(error, KeyError):
+                summary[host]["not_found"].append(cidr)
+            else:
+                summary[host]["errors"].append((cidr, error))
+
+        # Remove the host trees for the hosts that had no errors.
+        removable = [host for host in hosts if not summary[host]["errors"]]
+        removed = map_concurrently(self._remove_ipam_host_tree, removable,
+                                   max_concurrent)
+        for host, (_, error) in zip(removable, removed):
+            if error is not None:
+                summary[host]["errors"].append((None, error))
+            else:
+                summary[host]["removed"] = True
+
+        _log.info("Decommissioned %d of %d hosts",
+                  len([host for host in hosts if summary[host]["removed"]]),
+                  len(hosts))
+        return summary
+
+    def _get_all_affine_blocks(self, host):
+        """
+        Get the IPv4 and IPv6 blocks for which this host has affinity.
+
+        :param host: The host ID.
+        :return: List of block CIDRs.
+        """
+        return [cidr for version in (4, 6)
+                for cidr in self._get_affine_blocks(host, version, None)]
+
+    def _release_block_affinities(self, host_blocks, max_concurrent,
+                                  rate_limiter=None):
+        """
+        Release the affinity of blocks in parallel.
+
+        :param host_blocks: List of tuples of (host ID, block CIDR).
+        :param max_concurrent: The maximum number of blocks to release in
+        parallel.
+        :param rate_limiter: (optional) RateLimiter limiting the rate blocks
+        are released.
+        :return: List of (None, exception) tuples in the same order as
+        host_blocks, the exception being that raised by
+        _release_block_affinity() or None.
+        """
+        def release(host_block):
+            if rate_limiter is not None:
+                rate_limiter.acquire()
+            self._release_block_affinity(*host_block)
+
+        return map_concurrently(release, host_blocks, max_concurrent)
 
     @handle_errors
     def release_pool_affinities(self, pool):
@@ -1289,6 +2122,108 @@ class IPAMClient(BlockHandleReaderWriter):
         # Too may retries - re-raise the last exception.
         raise
 
+    @handle_errors
+    def get_sparse_affine_blocks(self,
+                                 max_allocated=SPARSE_BLOCK_MAX_ALLOCATED,
+                                 consistency=None):
+        """
+        Find affine blocks that are only sparsely used.  A block is considered
+        sparse if it has at least one, but no more than max_allocated
+        addresses allocated.  Empty affine blocks are not sparse - they are
+        the host's spare capacity.
+
+        This makes a single streamed pass over the IPv4 and IPv6 allocation
+        blocks.
+
+        :param max_allocated: The maximum number of allocated addresses for
+        a block to be considered sparse.
+        :param consistency: (optional) The read consistency, READ_QUORUM or
+        READ_LOCAL.  Defaults to the client's read consistency.
+        :return: Dictionary of host ID to a list of tuples
+        (block CIDR, number of allocated addresses) for each of the host's
+        sparse blocks, ordered from least to most allocated.
+        """
+        quorum = self._quorum(consistency)
+        sparse_blocks = {}
+        for version in (4, 6):
+            for block in self._iter_blocks(version, quorum=quorum):
+                if not block.host_affinity:
+                    continue
+                num_allocated = BLOCK_SIZE - block.count_free_addresses()
+                if 0 < num_allocated <= max_allocated:
+                    sparse_blocks.setdefault(block.host_affinity, []).append(
+                        (block.cidr, num_allocated))
+
+        for blocks in sparse_blocks.itervalues():
+            blocks.sort(key=lambda block: block[1])
+        return sparse_blocks
+
+    @handle_errors
+    def compact_affine_blocks(self, max_allocated=SPARSE_BLOCK_MAX_ALLOCATED,
+                              max_sparse_blocks=MAX_SPARSE_BLOCKS_PER_HOST,
+                              dry_run=False):
+        """
+        Release the affinity of sparsely used blocks from hosts holding more
+        than max_sparse_blocks sparse blocks, so that the address space
+        becomes dense again.
+
+        Each host keeps its max_sparse_blocks most used sparse blocks, and
+        the affinity of the remaining sparse blocks is released.  A released
+        block keeps its existing allocations, and is deleted once they have
+        all been released.  A block is skipped if it is no longer sparse (or
+        no longer affine to the host) when it is released.
+
+        If the IPAM configuration does not allow blocks to be automatically
+        allocated, hosts may not be able to replace the released blocks, so
+        nothing is released.
+
+        :param max_allocated: The maximum number of allocated addresses for
+        a block to be considered sparse.
+        :param max_sparse_blocks: The number of sparse blocks that a host may
+        keep.
+        :param dry_run: If True, only report the blocks, don't release them.
+        :return: A tuple of:
+                 ({host: [(IPNetwork<sparse block>, num_allocated)]},
+                  [(host, IPNetwork<block released>)])
+        """
+        assert max_sparse_blocks >= 0
+        # Blocks are released with compare-and-swap, but a stale read could
+        # miss sparse blocks, so use a quorum read.
+        sparse_blocks = self.get_sparse_affine_blocks(
+            max_allocated, consistency=READ_QUORUM)
+
+        # Work out which blocks should have their affinity released.
+        candidates = []
+        for host, blocks in sparse_blocks.iteritems():
+            num_excess = len(blocks) - max_sparse_blocks
+            if num_excess > 0:
+                _log.info("Host %s has %d sparse blocks", host, len(blocks))
+                candidates.extend((host, cidr) for cidr, _ in
+                                  blocks[:num_excess])
+
+        if dry_run or not candidates:
+            return sparse_blocks, []
+
+        if not self.get_ipam_config().auto_allocate_blocks:
+            _log.info("Block auto-allocation is disabled - not releasing "
+                      "sparse blocks")
+            return sparse_blocks, []
+
+        released = []
+        for host, block_cidr in candidates:
+            try:
+                self._release_block_affinity(host, block_cidr,
+                                             max_allocated=max_allocated)
+            except (KeyError, HostAffinityClaimedError, BlockNotSparseError):
+                # The block has changed since we scanned it - skip it.
+                _log.info("Block %s changed since scan - skipping",
+                          block_cidr)
+            else:
+                _log.info("Released affinity of sparse block %s from host %s",
+                          block_cidr, host)
+                released.append((host, block_cidr))
+        return sparse_blocks, released
+
     @handle_errors
     def remove_ipam_host(self, host):
         """
@@ -1308,12 +2243,209 @@ class IPAMClient(BlockHandleReaderWriter):
         self.release_host_affinities(host)
 
         # Remove the host ipam tree.
+        self._remove_ipam_host_tree(host)
+
+    def _remove_ipam_host_tree(self, host):
+        """
+        Remove the host specific IPAM data.
+
+        :param host: The host ID.
+        """
         host_path = IPAM_HOST_PATH % {"host": host}
         try:
             self.etcd_client.delete(host_path, dir=True, recursive=True)
         except EtcdKeyNotFound:
             pass
 
+    @handle_errors
+    def migrate_handles(self, max_concurrent=MAX_CONCURRENT_BLOCKS):
+        """
+        Move all allocation handles from the legacy flat handle layout to the
+        sharded handle layout.  Handles are moved in parallel, and each handle
+        is moved atomically with respect to clients that have handle sharding
+        enabled, so this may be run while those clients are assigning and
+        releasing addresses.
+
+        :param max_concurrent: (optional) The maximum number of handles to
+        move in parallel.
+        :return: Tuple of (list of handle IDs moved, list of tuples of
+        (handle ID, exception) for handles that could not be moved).
+        """
+        try:
+            results = self.etcd_client.read(IPAM_HANDLE_PATH,
+                                            quorum=True).leaves
+        except EtcdKeyNotFound:
+            return [], []
+        handle_results = [result for result in results if not result.dir]
+
+        _log.info("Migrating %d handles", len(handle_results))
+        moved = map_concurrently(self._migrate_handle, handle_results,
+                                 max_concurrent)
+        migrated = []
+        failed = []
+        for result, (handle_id, error) in zip(handle_results, moved):
+            if error is not None:
+                failed.append((result.key[len(IPAM_HANDLE_PATH):], error))
+            elif handle_id is not None:
+                migrated.append(handle_id)
+        _log.info("Migrated %d handles, %d failed", len(migrated),
+                  len(failed))
+        return migrated, failed
+
+    def _migrate_handle(self, result):
+        """
+        Move a handle from the legacy handle layout to the sharded layout.
+
+        The handle is copied to the sharded layout, and the legacy handle is
+        then deleted if it is unchanged.  If the legacy handle was changed,
+        the copy is deleted and the move is retried.
+
+        :param result: The EtcdResult for the legacy handle.
+        :return: The handle ID, or None if the handle was deleted before it
+        was moved.
+        """
+        for _ in xrange(RETRIES):
+            handle = AllocationHandle.from_etcd_result(result)
+            sharded_key = _sharded_handle_datastore_key(handle.handle_id)
+            try:
+                sharded = self.etcd_client.write(sharded_key, result.value,
+                                                 prevExist=False)
+            except EtcdAlreadyExist:
+                raise HandleMigrationError("Handle %s exists in both handle "
+                                           "layouts" % handle.handle_id)
+
+            try:
+                self.etcd_client.delete(result.key,
+                                        prevIndex=result.modifiedIndex)
+                return handle.handle_id
+            except (EtcdCompareFailed, EtcdKeyNotFound):
+                _log.debug("Handle %s changed while migrating",
+                           handle.handle_id)
+
+            # The legacy handle was changed or deleted.  Remove the copy, as
+            # long as it is unchanged, and retry from the legacy handle.
+            try:
+                self.etcd_client.delete(sharded_key,
+                                        prevIndex=sharded.modifiedIndex)
+            except (EtcdCompareFailed, EtcdKeyNotFound):
+                raise HandleMigrationError("Handle %s changed in both handle "
+                                           "layouts" % handle.handle_id)
+            metrics.RETRIES.inc(reason="cas_conflict")
+            try:
+                result = self.etcd_client.read(result.key, quorum=True)
+            except EtcdKeyNotFound:
+                return None
+        raise RuntimeError("Max retries hit.")  # pragma: no cover
+
+    @handle_errors
+    def export_ipam(self, f, consistency=None):
+        """
+        Export all of the IPAM data - the IPAM configuration, allocation
+        blocks, allocation handles (in both handle layouts) and host
+        affinities - in JSON Lines format, which can be restored with
+        restore_ipam().
+
+        The first line is a header, and each following line is a JSON object
+        with the key (relative to the IPAM tree) and value of one datastore
+        key.  Each datastore directory is read and written out in turn,
+        without decoding the blocks or handles, so memory use is bounded by
+        the largest directory rather than the total size of the IPAM data.
+        Pass a gzip.GzipFile to write a compressed export.
+
+        The export is not a consistent snapshot if addresses are assigned or
+        released while it is running.
+
+        :param f: The file object to write the export to.
+        :param consistency: (optional) The read consistency, READ_QUORUM or
+        READ_LOCAL.  Defaults to the client's read consistency.
+        :return: The number of keys exported.
+        """
+        quorum = self._quorum(consistency)
+        f.write(json.dumps({"format": EXPORT_FORMAT,
+                            "version": EXPORT_VERSION}) + "\n")
+        count = 0
+        for leaf in self._iter_ipam_leaves(quorum):
+            f.write(json.dumps({"key": leaf.key[len(IPAM_V_PATH):],
+                                "value": leaf.value}, sort_keys=True) + "\n")
+            count += 1
+        _log.info("Exported %d IPAM keys", count)
+        return count
+
+    def _iter_ipam_leaves(self, quorum):
+        """
+        Iterate through all of the IPAM keys, reading one directory at a
+        time.
+
+        :param quorum: Whether to perform quorum reads.
+        :return: An iterator of EtcdResults.
+        """
+        paths = [IPAM_CONFIG_PATH,
+                 IPAM_BLOCK_PATH % {"version": 4},
+                 IPAM_BLOCK_PATH % {"version": 6},
+                 IPAM_HANDLE_PATH]
+        try:
+            shards = self.etcd_client.read(IPAM_HANDLE_SHARDS_PATH,
+                                           quorum=quorum).children
+            paths.extend(shard.key for shard in shards if shard.dir)
+        except EtcdKeyNotFound:
+            pass
+        paths.append(IPAM_HOSTS_PATH)
+
+        for path in paths:
+            try:
+                leaves = self.etcd_client.read(path, quorum=quorum,
+                                               recursive=True).leaves
+            except EtcdKeyNotFound:
+                continue
+            for leaf in leaves:
+                if not leaf.dir:
+                    yield leaf
+
+    @handle_errors
+    def restore_ipam(self, f, max_concurrent=MAX_CONCURRENT_BLOCKS,
+                     overwrite=False):
+        """
+        Restore IPAM data exported by export_ipam().  This is intended for
+        restoring into a datastore with no IPAM data, while no addresses are
+        being assigned or released.
+
+        The export is read in batches of RESTORE_BATCH_SIZE keys, and the
+        keys in each batch are written in parallel, so memory use is bounded
+        regardless of the size of the export.  Pass a gzip.GzipFile to read a
+        compressed export.
+
+        :param f: The file object to read the export from.
+        :param max_concurrent: (optional) The maximum number of keys to write
+        in parallel.
+        :param overwrite: (optional) If True, existing keys are overwritten.
+        Otherwise keys that already exist are not written, and are reported
+        as failures.
+        :return: Tuple of (number of keys restored, list of tuples of
+        (key, exception) for keys that could not be written).
+        """
+        def write(record):
+            key, value = record
+            if overwrite:
+                self.etcd_client.write(key, value)
+            else:
+                self.etcd_client.write(key, value, prevExist=False)
+
+        records = _iter_export_records(f)
+        restored = 0
+        failed = []
+        while True:
+            batch = list(islice(records, RESTORE_BATCH_SIZE))
+            if not batch:
+                break
+            results = map_concurrently(write, batch, max_concurrent)
+            for (key, _), (_, error) in zip(batch, results):
+                if error is None:
+                    restored += 1
+                else:
+                    failed.append((key, error))
+        _log.info("Restored %d IPAM keys, %d failed", restored, len(failed))
+        return restored, failed
+
 
 # Choice of steps to take when iterating over the subnets.  Must all be
 # coprime to powers of 2.  Since we choose a random start point and a random
@@ -0,0 +1,575 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+In-memory stand-in for the python-etcd Client.
+
+The DatastoreClient (and therefore the IPAMClient) accesses etcd exclusively
+through the read, write, update and delete methods of its etcd_client.  Any
+object providing those methods with etcd v2 semantics may be passed in as the
+datastore backend.  MemoryEtcdClient is such a backend, holding the key space
+in process memory.  It is intended for benchmarking and regression testing
+without a live etcd cluster.
+
+MemoryEtcdTxnClient additionally supports multi-key transactions, as a
+stand-in for the etcd v3 backend (see pycalico.etcdv3).
+"""
+
+import logging
+import threading
+import time
+from collections import Counter, deque
+
+import etcd
+
+from pycalico.etcdv3 import TXN_PUT, TXN_DELETE
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+# Number of events retained for watches.  This matches the etcd v2 server,
+# which raises EtcdEventIndexCleared for watches older than its history.
+EVENT_HISTORY_SIZE = 1000
+
+
+class _Node(object):
+    """
+    A single key (or directory) in the in-memory key space.
+    """
+    def __init__(self, key, value=None, dir=False, index=0, ttl=None):
+        self.key = key
+        self.value = value
+        self.dir = dir
+        self.created_index = index
+        self.modified_index = index
+        self.expiration = time.time() + ttl if ttl else None
+        self.children = {} if dir else None
+
+    def is_expired(self, now):
+        return self.expiration is not None and self.expiration <= now
+
+    def to_dict(self, recursive=False, sorted_keys=False, depth=0, now=None):
+        """
+        Convert to the node dictionary format returned by the etcd v2 API.
+
+        :param recursive: Whether to include the full subtree.  When False,
+        the immediate children of a directory are listed (without their own
+        children), as etcd does.
+        :param sorted_keys: Whether to sort child nodes by key.
+        :param depth: Internal - the depth below the requested node.
+        :param now: The time used for TTL calculations.
+        :return: The node dictionary.
+        """
+        node = {"key": self.key,
+                "modifiedIndex": self.modified_index,
+                "createdIndex": self.created_index}
+        if self.dir:
+            node["dir"] = True
+        else:
+            node["value"] = self.value
+        if self.expiration is not None:
+            now = now if now is not None else time.time()
+            node["ttl"] = max(int(round(self.expiration - now)), 0)
+            node["expiration"] = time.strftime("%Y-%m-%dT%H:%M:%SZ",
+                                               time.gmtime(self.expiration))
+        if self.dir and (depth == 0 or recursive):
+            children = self.children.values()
+            if sorted_keys:
+                children = sorted(children, key=lambda child: child.key)
+            node["nodes"] = [child.to_dict(recursive=recursive,
+                                           sorted_keys=sorted_keys,
+                                           depth=depth + 1,
+                                           now=now)
+                             for child in children]
+        return node
+
+
+class MemoryEtcdClient(object):
+    """
+    An in-memory implementation of the subset of the python-etcd Client API
+    used by pycalico.
+
+    Writes, compare-and-swap (prevExist, prevValue and prevIndex), recursive
+    reads and watches follow etcd v2 semantics, including the etcd index
+    (createdIndex / modifiedIndex) and the etcd exception types raised on
+    failure.  The client is thread safe.
+
+    The client records the number of operations of each type in stats, along
+    with the number of failed compare-and-swap operations ("cas_failures"),
+    so that callers can measure the datastore load of an operation.
+    """
+
+    def __init__(self, latency=None):
+        """
+        :param latency: (optional) Delay, in seconds, added to every
+        operation to simulate the round trip to an etcd cluster.  This may
+        be a number, or a callable returning a number (for example to
+        simulate jitter).
+        """
+        self.latency = latency
+        self.stats = Counter()
+        self._index = 0
+        self._root = _Node("/", dir=True)
+        self._events = deque(maxlen=EVENT_HISTORY_SIZE)
+        # The index of the most recent event dropped from the history.
+        self._cleared_index = 0
+        self._cond = threading.Condition(threading.Lock())
+
+    def read(self, key, recursive=False, sorted=False, wait=False,
+             waitIndex=None, timeout=None, **kwdargs):
+        """
+        Read a key or directory.
+
+        Additional python-etcd arguments (such as quorum) are accepted and
+        ignored - the in-memory store is always consistent.
+
+        :param key: The key to read.
+        :param recursive: Whether to return the full subtree of a directory.
+        :param sorted: Whether to sort the child nodes by key.
+        :param wait: Wait for a change to the key (or, if recursive, the
+        subtree) rather than returning the current value.
+        :param waitIndex: When waiting, the etcd index to wait from.
+        :param timeout: When waiting, the maximum time to wait in seconds.
+        :return: An EtcdResult.
+        """
+        self._simulate_latency()
+        key = self._normalize(key)
+        if wait:
+            return self._watch(key, recursive, waitIndex, timeout)
+
+        with self._cond:
+            self.stats["read"] += 1
+            now = time.time()
+            node = self._get(key, now)
+            if node is None:
+                raise self._key_not_found(key)
+            return self._result("get", node.to_dict(recursive=recursive,
+                                                    sorted_keys=sorted,
+                                                    now=now))
+
+    def get(self, key):
+        """
+        Read a key.
+
+        :param key: The key to read.
+        :return: An EtcdResult.
+        """
+        return self.read(key)
+
+    def write(self, key, value, ttl=None, dir=False, append=False,
+              prevExist=None, prevValue=None, prevIndex=None, **kwdargs):
+        """
+        Write a key or directory, optionally as a compare-and-swap.
+
+        :param key: The key to write.
+        :param value: The value to write.  Values are stored as strings, as
+        in etcd.
+        :param ttl: (optional) Time to live of the key, in seconds.
+        :param dir: Whether to create a directory.
+        :param append: Whether to create a new, uniquely named, key within
+        the directory key.
+        :param prevExist: (optional) If False, the write only succeeds if the
+        key does not exist.  If True, it only succeeds if the key exists.
+        :param prevValue: (optional) The write only succeeds if the current
+        value of the key matches.
+        :param prevIndex: (optional) The write only succeeds if the current
+        modifiedIndex of the key matches.
+        :return: An EtcdResult.
+        """
+        self._simulate_latency()
+        key = self._normalize(key)
+        if not dir:
+            value = "" if value is None else value
+            if not isinstance(value, basestring):
+                value = str(value)
+
+        with self._cond:
+            self.stats["write"] += 1
+            now = time.time()
+            if append:
+                dir_node = self._get(key, now)
+                if dir_node is None:
+                    self._make_dirs(key, now)
+                elif not dir_node.dir:
+                    raise etcd.EtcdNotDir("Not a directory", {"key": key})
+                key = "%s/%020d" % (key.rstrip("/"), self._index + 1)
+            if key == "/":
+                raise etcd.EtcdRootReadOnly("Root is read only", {"key": key})
+
+            parent, existing = self._walk(key, now)
+            compare = prevValue is not None or prevIndex is not None
+            try:
+                self._check_prev(key, existing, prevExist, prevValue,
+                                 prevIndex)
+            except etcd.EtcdException:
+                if compare or prevExist is not None:
+                    self.stats["cas_failures"] += 1
+                raise
+            if existing is not None and existing.dir and \
+                    not (dir and prevExist):
+                raise etcd.EtcdNotFile("Not a file", {"key": key})
+
+            if append or prevExist is False:
+                action = "create"
+            elif compare:
+                action = "compareAndSwap"
+            elif prevExist:
+                action = "update"
+            else:
+                action = "set"
+
+            if parent is None:
+                parent = self._make_dirs(key.rsplit("/", 1)[0], now)
+            self._index += 1
+            node = _Node(key, value=None if dir else value, dir=dir,
+                         index=self._index, ttl=ttl)
+            prev_node = None
+            if existing is not None:
+                prev_node = existing.to_dict(now=now)
+                if action != "set":
+                    node.created_index = existing.created_index
+                if existing.dir and dir:
+                    node.children = existing.children
+            parent.children[key] = node
+
+            result = self._result(action, node.to_dict(now=now), prev_node)
+            result.newKey = existing is None
+            self._record_event(action, node.to_dict(now=now), prev_node)
+            return result
+
+    def update(self, obj):
+        """
+        Update the key described by an EtcdResult, as a compare-and-swap on
+        its modifiedIndex.
+
+        :param obj: The EtcdResult (as returned from a read) with an updated
+        value.
+        :return: An EtcdResult.
+        """
+        kwdargs = {"dir": obj.dir,
+                   "ttl": obj.ttl,
+                   "prevExist": True}
+        if not obj.dir:
+            # prevIndex is not supported on directories.
+            kwdargs["prevIndex"] = obj.modifiedIndex
+        return self.write(obj.key, obj.value, **kwdargs)
+
+    def delete(self, key, recursive=None, dir=None, prevValue=None,
+               prevIndex=None, **kwdargs):
+        """
+        Delete a key or directory, optionally as a compare-and-delete.
+
+        :param key: The key to delete.
+        :param recursive: Whether to delete a directory and all its contents.
+        :param dir: Whether the key is a directory.  Without recursive, only
+        empty directories may be deleted.
+        :param prevValue: (optional) The delete only succeeds if the current
+        value of the key matches.
+        :param prevIndex: (optional) The delete only succeeds if the current
+        modifiedIndex of the key matches.
+        :return: An EtcdResult.
+        """
+        self._simulate_latency()
+        key = self._normalize(key)
+
+        with self._cond:
+            self.stats["delete"] += 1
+            if key == "/":
+                raise etcd.EtcdRootReadOnly("Root is read only", {"key": key})
+            now = time.time()
+            parent, node = self._walk(key, now)
+            compare = prevValue is not None or prevIndex is not None
+            try:
+                self._check_prev(key, node, True, prevValue, prevIndex)
+            except etcd.EtcdException:
+                if compare:
+                    self.stats["cas_failures"] += 1
+                raise
+            if node.dir:
+                if not (dir or recursive):
+                    raise etcd.EtcdNotFile("Not a file", {"key": key})
+                if node.children and not recursive:
+                    raise etcd.EtcdDirNotEmpty("Directory not empty",
+                                               {"key": key})
+
+            del parent.children[key]
+            self._index += 1
+            prev_node = node.to_dict(now=now)
+            deleted = {"key": key,
+                       "modifiedIndex": self._index,
+                       "createdIndex": node.created_index}
+            if node.dir:
+                deleted["dir"] = True
+            action = "compareAndDelete" if compare else "delete"
+            self._record_event(action, deleted, prev_node)
+            return self._result(action, deleted, prev_node)
+
+    @property
+    def etcd_index(self):
+        """
+        The current etcd index (the index of the most recent modification).
+        """
+        with self._cond:
+            return self._index
+
+    def _simulate_latency(self):
+        """
+        Sleep for the configured latency, if any.
+        """
+        if self.latency:
+            delay = self.latency() if callable(self.latency) else \
+                self.latency
+            if delay > 0:
+                time.sleep(delay)
+
+    def _watch(self, key, recursive, wait_index, timeout):
+        """
+        Wait for the first event on the key (or its subtree) with an index of
+        at least wait_index.
+
+        :return: An EtcdResult for the event.
+        """
+        deadline = time.time() + timeout if timeout else None
+        with self._cond:
+            self.stats["watch"] += 1
+            if wait_index is None:
+                wait_index = self._index + 1
+            while True:
+                if wait_index <= self._cleared_index:
+                    raise etcd.EtcdEventIndexCleared(
+                        "The event in requested index is outdated and "
+                        "cleared", {"index": wait_index})
+                for index, action, node, prev_node in self._events:
+                    if index >= wait_index and \
+                            self._key_matches(key, node["key"], recursive):
+                        return self._result(action, node, prev_node)
+
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise etcd.EtcdWatchTimedOut(
+                            "Watch timed out: %s" % key)
+                    self._cond.wait(remaining)
+
+    @staticmethod
+    def _key_matches(watched, key, recursive):
+        if key == watched:
+            return True
+        if recursive:
+            prefix = watched if watched.endswith("/") else watched + "/"
+            return key.startswith(prefix)
+        return False
+
+    def _record_event(self, action, node, prev_node):
+        if len(self._events) == self._events.maxlen:
+            self._cleared_index = self._events[0][0]
+        self._events.append((self._index, action, node, prev_node))
+        self._cond.notify_all()
+
+    def _result(self, action, node, prev_node=None):
+        result = etcd.EtcdResult(action, node, prev_node)
+        result.etcd_index = self._index
+        result.raft_index = self._index
+        return result
+
+    def _check_prev(self, key, node, prev_exist, prev_value, prev_index):
+        """
+        Check the compare-and-swap conditions of a write or delete.
+
+        :param node: The existing node, or None if the key does not exist.
+        """
+        if prev_exist is False:
+            if node is not None:
+                raise etcd.EtcdAlreadyExist("Key already exists",
+                                            {"key": key})
+            return
+
+        compare = prev_value is not None or prev_index is not None
+        if node is None:
+            if prev_exist or compare:
+                raise self._key_not_found(key)
+            return
+
+        if compare:
+            if node.dir:
+                raise etcd.EtcdNotFile("Not a file", {"key": key})
+            if prev_value is not None and node.value != prev_value:
+                raise etcd.EtcdCompareFailed(
+                    "Compare failed: [%s != %s]" % (prev_value, node.value),
+                    {"key": key})
+            if prev_index is not None and \
+                    node.modified_index != int(prev_index):
+                raise etcd.EtcdCompareFailed(
+                    "Compare failed: [%s != %s]" % (prev_index,
+                                                    node.modified_index),
+                    {"key": key})
+
+    @staticmethod
+    def _normalize(key):
+        key = "/" + key.strip("/")
+        return key
+
+    def _key_not_found(self, key):
+        # As with etcd, include the current etcd index, so that the caller
+        # can watch for the key being created.
+        return etcd.EtcdKeyNotFound("Key not found : %s" % key,
+                                    {"key": key, "index": self._index})
+
+    def _expire(self, parent, node):
+        """
+        Remove an expired node, recording the expire event.
+        """
+        del parent.children[node.key]
+        self._index += 1
+        self._record_event("expire",
+                           {"key": node.key,
+                            "modifiedIndex": self._index,
+                            "createdIndex": node.created_index},
+                           node.to_dict())
+
+    def _walk(self, key, now):
+        """
+        Walk the path to key.
+
+        :return: A tuple of (parent, node), where parent is the directory
+        containing key and node is the node for key.  Either may be None if
+        the path does not exist.
+        """
+        if key == "/":
+            return None, self._root
+        parts = key.strip("/").split("/")
+        node = self._root
+        path = ""
+        for ii, part in enumerate(parts):
+            if not node.dir:
+                raise etcd.EtcdNotDir("Not a directory", {"key": node.key})
+            path += "/" + part
+            child = node.children.get(path)
+            if child is not None and child.is_expired(now):
+                self._expire(node, child)
+                child = None
+            if child is None:
+                if ii == len(parts) - 1:
+                    return node, None
+                return None, None
+            if ii == len(parts) - 1:
+                return node, child
+            node = child
+
+    def _get(self, key, now):
+        return self._walk(key, now)[1]
+
+    def _make_dirs(self, key, now):
+        """
+        Create the directory key and any missing parent directories.
+
+        :return: The directory node.
+        """
+        node = self._root
+        path = ""
+        for part in key.strip("/").split("/"):
+            if not part:
+                continue
+            path += "/" + part
+            child = node.children.get(path)
+            if child is not None and child.is_expired(now):
+                self._expire(node, child)
+                child = None
+            if child is None:
+                self._index += 1
+                child = _Node(path, dir=True, index=self._index)
+                node.children[path] = child
+            elif not child.dir:
+                raise etcd.EtcdNotDir("Not a directory", {"key": path})
+            node = child
+        return node
+
+
+class MemoryEtcdTxnClient(MemoryEtcdClient):
+    """
+    A MemoryEtcdClient that also supports multi-key transactions with the
+    txn() method of pycalico.etcdv3.EtcdV3Client.
+
+    As in etcd v3, all of the keys written by a transaction share a single
+    modifiedIndex.  Transactions are counted in stats as "txn", and failed
+    transactions as "cas_failures".
+    """
+
+    def txn(self, compare, success):
+        """
+        Perform an atomic multi-key transaction.
+
+        :param compare: List of (key, modifiedIndex) tuples.  The
+        transaction only succeeds if each key currently has the given
+        modifiedIndex, or, if the modifiedIndex is None, if the key does not
+        exist.
+        :param success: List of (TXN_PUT, key, value) and (TXN_DELETE, key,
+        None) tuples, applied atomically if the comparisons succeed.
+        :return: True if the transaction succeeded, False if a comparison
+        failed.
+        """
+        self._simulate_latency()
+        with self._cond:
+            self.stats["txn"] += 1
+            now = time.time()
+            for key, index in compare:
+                node = self._get(self._normalize(key), now)
+                current = None
+                if node is not None and not node.dir:
+                    current = node.modified_index
+                if current != (int(index) if index is not None else None):
+                    self.stats["cas_failures"] += 1
+                    return False
+
+            # Check all of the operations can be applied before applying any,
+            # so that the transaction is atomic.
+            ops = []
+            for op, key, value in success:
+                key = self._normalize(key)
+                parent, node = self._walk(key, now)
+                if node is not None and node.dir:
+                    raise etcd.EtcdNotFile("Not a file", {"key": key})
+                if op == TXN_PUT:
+                    ops.append((op, key, value, node))
+                elif op == TXN_DELETE:
+                    if node is not None:
+                        ops.append((op, key, value, node))
+                else:
+                    raise ValueError("Unknown transaction operation %s" % op)
+
+            for op, key, value, node in ops:
+                if op == TXN_PUT:
+                    self._make_dirs(key.rsplit("/", 1)[0], now)
+            self._index += 1
+            for op, key, value, node in ops:
+                parent = self._walk(key, now)[0]
+                prev_node = node.to_dict(now=now) if node is not None \
+                    else None
+                if op == TXN_PUT:
+                    new_node = _Node(key, value=value, index=self._index)
+                    if node is not None:
+                        new_node.created_index = node.created_index
+                    parent.children[key] = new_node
+                    self._record_event("set", new_node.to_dict(now=now),
+                                       prev_node)
+                else:
+                    del parent.children[key]
+                    self._record_event("delete",
+                                       {"key": key,
+                                        "modifiedIndex": self._index,
+                                        "createdIndex": node.created_index},
+                                       prev_node)
+            return True
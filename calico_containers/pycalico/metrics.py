@@ -0,0 +1,383 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Optional Prometheus-style metrics for pycalico operations.
+
+Metrics are collected in REGISTRY once enabled with enable().  They can then
+be exported in the Prometheus text format, either by writing them to a file
+(for example for the node exporter textfile collector) with write_to_file(),
+or by serving them over HTTP with start_http_server().
+
+Every DatastoreClient and IPAMClient API method records its duration and any
+errors.  The IPAM counters are labelled with the API method that was called,
+so that (for example) CAS conflicts hit while auto-assigning can be told apart
+from those hit while releasing.
+"""
+
+import bisect
+import logging
+import os
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from contextlib import contextmanager
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+# Content type of the Prometheus text exposition format.
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+
+# The label filled in with the API method of the current thread, if not
+# explicitly specified.
+METHOD_LABEL = "method"
+
+# The API method being called in each thread.
+_context = threading.local()
+
+
+class _Metric(object):
+    """
+    Base class for a metric, which has one value for each combination of
+    label values.
+    """
+    metric_type = None
+
+    def __init__(self, registry, name, documentation, labelnames):
+        self.registry = registry
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if METHOD_LABEL in self.labelnames and METHOD_LABEL not in labels:
+            labels[METHOD_LABEL] = current_method()
+        return tuple(str(labels.get(name, "")) for name in self.labelnames)
+
+    def _format_labels(self, key, extra=()):
+        pairs = zip(self.labelnames, key) + list(extra)
+        if not pairs:
+            return ""
+        return "{%s}" % ",".join('%s="%s"' % (name, _escape(value))
+                                 for name, value in pairs)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        """
+        :return: List of lines for the metric in the Prometheus text format.
+        """
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.metric_type)]
+        with self._lock:
+            items = sorted(self._values.items())
+            lines.extend(self._render_samples(items))
+        return lines
+
+    def _render_samples(self, items):
+        raise NotImplementedError()  # pragma: no cover
+
+
+class Counter(_Metric):
+    """
+    A monotonically increasing count.
+    """
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        """
+        Increment the counter.
+
+        :param amount: The amount to increment by.
+        :param labels: The label values.
+        """
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """
+        :return: The current value of the counter for the label values.
+        """
+        key = self._key(labels)
+        with self._lock:
+            return self._values.get(key, 0)
+
+    def _render_samples(self, items):
+        return ["%s%s %s" % (self.name, self._format_labels(key),
+                             _format_value(value))
+                for key, value in items]
+
+
+class Histogram(_Metric):
+    """
+    A distribution of observed values, counted in buckets.
+    """
+    metric_type = "histogram"
+
+    def __init__(self, registry, name, documentation, labelnames,
+                 buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(registry, name, documentation,
+                                        labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        """
+        Record an observation.
+
+        :param value: The observed value.
+        :param labels: The label values.
+        """
+        if not self.registry.enabled:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (the last for values above all buckets),
+                # the sum and the count of observations.
+                state = [[0] * (len(self.buckets) + 1), 0.0, 0]
+                self._values[key] = state
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def count(self, **labels):
+        """
+        :return: The number of observations for the label values.
+        """
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            return state[2] if state is not None else 0
+
+    def _render_samples(self, items):
+        lines = []
+        for key, (bucket_counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),),
+                                           bucket_counts):
+                cumulative += bucket_count
+                lines.append("%s_bucket%s %s" % (
+                    self.name,
+                    self._format_labels(key, [("le", _format_value(bound))]),
+                    cumulative))
+            lines.append("%s_sum%s %s" % (self.name, self._format_labels(key),
+                                          _format_value(total)))
+            lines.append("%s_count%s %s" % (self.name,
+                                            self._format_labels(key), count))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    A collection of metrics.  Metrics are not recorded until the registry is
+    enabled.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self._metrics = []
+
+    def counter(self, name, documentation, labelnames=()):
+        """
+        Create and register a Counter.
+        """
+        metric = Counter(self, name, documentation, labelnames)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, name, documentation, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        """
+        Create and register a Histogram.
+        """
+        metric = Histogram(self, name, documentation, labelnames, buckets)
+        self._metrics.append(metric)
+        return metric
+
+    def clear(self):
+        """
+        Reset all metrics.
+        """
+        for metric in self._metrics:
+            metric.clear()
+
+    def render(self):
+        """
+        :return: The metrics in the Prometheus text format.
+        """
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+
+API_DURATION = REGISTRY.histogram(
+    "pycalico_api_duration_seconds",
+    "Duration of pycalico API calls.",
+    (METHOD_LABEL,))
+API_ERRORS = REGISTRY.counter(
+    "pycalico_api_errors_total",
+    "pycalico API calls that raised an exception.",
+    (METHOD_LABEL, "error"))
+CAS_CONFLICTS = REGISTRY.counter(
+    "pycalico_ipam_cas_conflicts_total",
+    "Compare-and-swap writes of IPAM data that failed due to a conflicting "
+    "update.",
+    (METHOD_LABEL, "object"))
+RETRIES = REGISTRY.counter(
+    "pycalico_ipam_retries_total",
+    "IPAM operations retried.",
+    (METHOD_LABEL, "reason"))
+BLOCKS_CLAIMED = REGISTRY.counter(
+    "pycalico_ipam_blocks_claimed_total",
+    "Allocation blocks claimed.",
+    (METHOD_LABEL,))
+BLOCKS_RELEASED = REGISTRY.counter(
+    "pycalico_ipam_blocks_released_total",
+    "Allocation block affinities released.",
+    (METHOD_LABEL,))
+ADDRESSES_ALLOCATED = REGISTRY.counter(
+    "pycalico_ipam_addresses_allocated_total",
+    "IP addresses allocated.",
+    (METHOD_LABEL, "version"))
+ADDRESSES_RELEASED = REGISTRY.counter(
+    "pycalico_ipam_addresses_released_total",
+    "IP addresses released.",
+    (METHOD_LABEL, "version"))
+
+
+def enable(registry=REGISTRY):
+    """
+    Start recording metrics.
+    """
+    registry.enabled = True
+
+
+def disable(registry=REGISTRY):
+    """
+    Stop recording metrics.
+    """
+    registry.enabled = False
+
+
+def current_method():
+    """
+    :return: The (outermost) API method being called in this thread, or an
+    empty string.
+    """
+    return getattr(_context, "method", None) or ""
+
+
+def set_current_method(method):
+    """
+    Set the API method being called in this thread.  This is used to
+    propagate the method to worker threads.
+    """
+    _context.method = method
+
+
+@contextmanager
+def api_call(method):
+    """
+    Context manager recording the duration and any error of an API call.
+    The method is also recorded as the current method for the thread, unless
+    this call is nested within another API call.
+
+    :param method: The API method name.
+    """
+    if not REGISTRY.enabled:
+        yield
+        return
+
+    outer_method = current_method()
+    if not outer_method:
+        _context.method = method
+    start = time.time()
+    try:
+        yield
+    except Exception as e:
+        API_ERRORS.inc(method=method, error=type(e).__name__)
+        raise
+    finally:
+        API_DURATION.observe(time.time() - start, method=method)
+        _context.method = outer_method
+
+
+def write_to_file(path, registry=REGISTRY):
+    """
+    Write the metrics, in the Prometheus text format, to a file.  The file is
+    replaced atomically, so that it is never read part written.
+
+    :param path: The file path.
+    """
+    tmp_path = "%s.%s.tmp" % (path, os.getpid())
+    with open(tmp_path, "w") as f:
+        f.write(registry.render())
+    os.rename(tmp_path, path)
+
+
+def start_http_server(port, addr="127.0.0.1", registry=REGISTRY):
+    """
+    Serve the metrics, in the Prometheus text format, over HTTP from a
+    background thread.
+
+    :param port: The port to listen on.  Pass 0 to pick a free port.
+    :param addr: The address to listen on.
+    :return: The HTTPServer.  Call shutdown() to stop it.
+    """
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            output = registry.render()
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPE)
+            self.send_header("Content-Length", str(len(output)))
+            self.end_headers()
+            self.wfile.write(output)
+
+        def log_message(self, format, *args):
+            _log.debug("Metrics request: " + format, *args)
+
+    server = HTTPServer((addr, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    _log.info("Serving metrics on %s:%s", addr, server.server_address[1])
+    return server
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n") \
+        .replace('"', '\\"')
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
@@ -0,0 +1,496 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Parsing and evaluation of Calico label selectors, as used by Policy.selector
+to select endpoints by their labels.
+
+The selector syntax is the one understood by Felix, for example:
+    role == "db" && (env in {"prod", "staging"} || !has(test))
+
+A SelectorIndex keeps an inverted index of the labels of a set of endpoints,
+and of the selectors of a set of policies, so that the endpoints matching a
+selector, and the policies matching an endpoint, can be found without
+evaluating every selector against every endpoint.
+"""
+
+import re
+import threading
+
+# Tokens of the selector syntax.
+_TOKEN_RE = re.compile(r"""\s*(?:
+    (?P<op>&&|\|\||==|!=|!|\(|\)|\{|\}|,) |
+    (?P<string>"[^"]*"|'[^']*') |
+    (?P<word>[a-zA-Z0-9_./-]+)
+)""", re.VERBOSE)
+
+
+def parse_selector(selector):
+    """
+    Parse a selector.  An empty selector selects everything.
+
+    :param selector: The selector string.
+    :return: A Selector.  Raises a ValueError if the selector is invalid.
+    """
+    return _Parser(selector).parse()
+
+
+class Selector(object):
+    """
+    Base class for a parsed selector expression.
+    """
+
+    def evaluate(self, labels):
+        """
+        :param labels: A dictionary of labels.
+        :return: True if the selector matches the labels.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def _select(self, index):
+        """
+        :param index: A SelectorIndex.  The caller holds its lock.
+        :return: The set of endpoint IDs in the index that match the
+        selector.  This may be one of the index's own sets, so must not be
+        modified.
+        """
+        raise NotImplementedError()  # pragma: no cover
+
+    def _index_terms(self):
+        """
+        :return: A list of index terms, at least one of which is in the
+        labels of any endpoint that the selector matches, or None if there is
+        no such list.  Terms are ("label", key, value) or ("key", key).
+        """
+        return None
+
+    def __eq__(self, other):
+        return type(self) == type(other) and str(self) == str(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __repr__(self):
+        return "Selector(%r)" % str(self)
+
+
+class _All(Selector):
+    def evaluate(self, labels):
+        return True
+
+    def _select(self, index):
+        return index._endpoint_ids
+
+    def __str__(self):
+        return "all()"
+
+
+class _Has(Selector):
+    def __init__(self, key):
+        self.key = key
+
+    def evaluate(self, labels):
+        return self.key in labels
+
+    def _select(self, index):
+        return index._key_index.get(self.key, frozenset())
+
+    def _index_terms(self):
+        return [("key", self.key)]
+
+    def __str__(self):
+        return "has(%s)" % self.key
+
+
+class _In(Selector):
+    def __init__(self, key, values):
+        self.key = key
+        self.values = frozenset(values)
+
+    def evaluate(self, labels):
+        return self.key in labels and labels[self.key] in self.values
+
+    def _select(self, index):
+        selected = set()
+        for value in self.values:
+            selected.update(index._label_index.get((self.key, value), ()))
+        return selected
+
+    def _index_terms(self):
+        return [("label", self.key, value) for value in self.values]
+
+    def __str__(self):
+        if len(self.values) == 1:
+            value, = self.values
+            return "%s == %s" % (self.key, _quote(value))
+        return "%s in {%s}" % (self.key, ", ".join(
+            _quote(value) for value in sorted(self.values)))
+
+
+class _Not(Selector):
+    def __init__(self, child):
+        self.child = child
+
+    def evaluate(self, labels):
+        return not self.child.evaluate(labels)
+
+    def _select(self, index):
+        return index._endpoint_ids - self.child._select(index)
+
+    def __str__(self):
+        if isinstance(self.child, _In):
+            # Render the equivalent != and "not in" operators.
+            values = self.child.values
+            if len(values) == 1:
+                value, = values
+                return "%s != %s" % (self.child.key, _quote(value))
+            return "%s not in {%s}" % (self.child.key, ", ".join(
+                _quote(value) for value in sorted(values)))
+        return "!%s" % _wrap(self.child)
+
+
+class _And(Selector):
+    def __init__(self, children):
+        self.children = children
+
+    def evaluate(self, labels):
+        return all(child.evaluate(labels) for child in self.children)
+
+    def _select(self, index):
+        # Start from the most selective operand.
+        sets = sorted((child._select(index) for child in self.children),
+                      key=len)
+        selected = set(sets[0])
+        for other in sets[1:]:
+            if not selected:
+                break
+            selected &= other
+        return selected
+
+    def _index_terms(self):
+        best = None
+        for child in self.children:
+            terms = child._index_terms()
+            if terms is not None and (best is None or len(terms) < len(best)):
+                best = terms
+        return best
+
+    def __str__(self):
+        return " && ".join(_wrap(child) for child in self.children)
+
+
+class _Or(Selector):
+    def __init__(self, children):
+        self.children = children
+
+    def evaluate(self, labels):
+        return any(child.evaluate(labels) for child in self.children)
+
+    def _select(self, index):
+        selected = set()
+        for child in self.children:
+            selected.update(child._select(index))
+        return selected
+
+    def _index_terms(self):
+        terms = []
+        for child in self.children:
+            child_terms = child._index_terms()
+            if child_terms is None:
+                return None
+            terms.extend(child_terms)
+        return terms
+
+    def __str__(self):
+        return " || ".join(_wrap(child) for child in self.children)
+
+
+def _quote(value):
+    return "'%s'" % value if '"' in value else '"%s"' % value
+
+
+def _wrap(selector):
+    if isinstance(selector, (_And, _Or)):
+        return "(%s)" % selector
+    return str(selector)
+
+
+class _Parser(object):
+    """
+    Recursive descent parser for the selector syntax.
+    """
+
+    def __init__(self, selector):
+        self.selector = selector
+        self.tokens = self._tokenize(selector)
+        self.pos = 0
+
+    def _tokenize(self, selector):
+        tokens = []
+        pos = 0
+        while selector[pos:].strip():
+            match = _TOKEN_RE.match(selector, pos)
+            if not match:
+                self._error("unexpected character at position %d" % pos)
+            if match.group("string") is not None:
+                tokens.append(("string", match.group("string")[1:-1]))
+            elif match.group("word") is not None:
+                tokens.append(("word", match.group("word")))
+            else:
+                tokens.append(("op", match.group("op")))
+            pos = match.end()
+        return tokens
+
+    def _error(self, message):
+        raise ValueError("Invalid selector %r: %s" % (self.selector, message))
+
+    def _peek(self, offset=0):
+        if self.pos + offset < len(self.tokens):
+            return self.tokens[self.pos + offset]
+        return (None, None)
+
+    def _next(self):
+        token = self._peek()
+        if token[0] is None:
+            self._error("unexpected end of selector")
+        self.pos += 1
+        return token
+
+    def _expect(self, op):
+        token = self._next()
+        if token != ("op", op):
+            self._error("expected %r, found %r" % (op, token[1]))
+
+    def parse(self):
+        if not self.tokens:
+            return _All()
+        selector = self._parse_or()
+        if self.pos != len(self.tokens):
+            self._error("unexpected %r" % self._peek()[1])
+        return selector
+
+    def _parse_or(self):
+        children = [self._parse_and()]
+        while self._peek() == ("op", "||"):
+            self.pos += 1
+            children.append(self._parse_and())
+        return children[0] if len(children) == 1 else _Or(children)
+
+    def _parse_and(self):
+        children = [self._parse_unary()]
+        while self._peek() == ("op", "&&"):
+            self.pos += 1
+            children.append(self._parse_unary())
+        return children[0] if len(children) == 1 else _And(children)
+
+    def _parse_unary(self):
+        kind, value = self._next()
+        if (kind, value) == ("op", "!"):
+            return _Not(self._parse_unary())
+        if (kind, value) == ("op", "("):
+            selector = self._parse_or()
+            self._expect(")")
+            return selector
+        if kind != "word":
+            self._error("unexpected %r" % value)
+        if value in ("has", "all") and self._peek() == ("op", "("):
+            self.pos += 1
+            if value == "all":
+                self._expect(")")
+                return _All()
+            kind, key = self._next()
+            if kind != "word":
+                self._error("expected a label key, found %r" % key)
+            self._expect(")")
+            return _Has(key)
+        return self._parse_operator(value)
+
+    def _parse_operator(self, key):
+        kind, op = self._next()
+        if (kind, op) == ("op", "=="):
+            return _In(key, [self._parse_string()])
+        if (kind, op) == ("op", "!="):
+            return _Not(_In(key, [self._parse_string()]))
+        if (kind, op) == ("word", "in"):
+            return _In(key, self._parse_set())
+        if (kind, op) == ("word", "not") and self._peek() == ("word", "in"):
+            self.pos += 1
+            return _Not(_In(key, self._parse_set()))
+        self._error("expected an operator after %r, found %r" % (key, op))
+
+    def _parse_string(self):
+        kind, value = self._next()
+        if kind != "string":
+            self._error("expected a quoted string, found %r" % value)
+        return value
+
+    def _parse_set(self):
+        self._expect("{")
+        values = []
+        if self._peek() == ("op", "}"):
+            self.pos += 1
+            return values
+        values.append(self._parse_string())
+        while self._peek() == ("op", ","):
+            self.pos += 1
+            values.append(self._parse_string())
+        self._expect("}")
+        return values
+
+
+class SelectorIndex(object):
+    """
+    An index of endpoint labels and policy selectors, kept up to date
+    incrementally as endpoints and policies change.
+
+    Endpoints and policies are identified by IDs chosen by the caller, for
+    example the endpoint keys, or (tier name, policy name) tuples.  All
+    methods are thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # Endpoint ID to labels, (label key, value) to endpoint IDs and label
+        # key to endpoint IDs.
+        self._endpoint_labels = {}
+        self._endpoint_ids = set()
+        self._label_index = {}
+        self._key_index = {}
+        # Policy ID to selector, index term to policy IDs, and the policies
+        # whose selectors have no index terms.
+        self._policy_selectors = {}
+        self._policy_terms = {}
+        self._unindexed_policies = set()
+
+    def set_endpoint(self, endpoint_id, labels):
+        """
+        Add an endpoint, or update its labels.
+
+        :param endpoint_id: The endpoint ID.
+        :param labels: The dictionary of endpoint labels.
+        """
+        with self._lock:
+            self._remove_endpoint(endpoint_id)
+            labels = dict(labels or {})
+            self._endpoint_labels[endpoint_id] = labels
+            self._endpoint_ids.add(endpoint_id)
+            for key, value in labels.iteritems():
+                self._label_index.setdefault((key, value),
+                                             set()).add(endpoint_id)
+                self._key_index.setdefault(key, set()).add(endpoint_id)
+
+    def remove_endpoint(self, endpoint_id):
+        """
+        Remove an endpoint, if it is in the index.
+
+        :param endpoint_id: The endpoint ID.
+        """
+        with self._lock:
+            self._remove_endpoint(endpoint_id)
+
+    def set_policy(self, policy_id, selector):
+        """
+        Add a policy, or update its selector.
+
+        :param policy_id: The policy ID.
+        :param selector: The policy selector, as a string or a Selector.
+        Raises a ValueError if the selector is invalid.
+        """
+        if not isinstance(selector, Selector):
+            selector = parse_selector(selector)
+        with self._lock:
+            self._remove_policy(policy_id)
+            self._policy_selectors[policy_id] = selector
+            terms = selector._index_terms()
+            if terms is None:
+                self._unindexed_policies.add(policy_id)
+            else:
+                for term in terms:
+                    self._policy_terms.setdefault(term, set()).add(policy_id)
+
+    def remove_policy(self, policy_id):
+        """
+        Remove a policy, if it is in the index.
+
+        :param policy_id: The policy ID.
+        """
+        with self._lock:
+            self._remove_policy(policy_id)
+
+    def select_endpoints(self, selector):
+        """
+        :param selector: A selector, as a string or a Selector.
+        :return: The set of IDs of the endpoints that the selector matches.
+        """
+        if not isinstance(selector, Selector):
+            selector = parse_selector(selector)
+        with self._lock:
+            return set(selector._select(self))
+
+    def select_policies(self, labels):
+        """
+        :param labels: A dictionary of endpoint labels.
+        :return: The set of IDs of the policies whose selectors match the
+        labels.
+        """
+        with self._lock:
+            candidates = set(self._unindexed_policies)
+            for key, value in labels.iteritems():
+                candidates.update(self._policy_terms.get(("label", key,
+                                                          value), ()))
+                candidates.update(self._policy_terms.get(("key", key), ()))
+            return set(policy_id for policy_id in candidates
+                       if self._policy_selectors[policy_id].evaluate(labels))
+
+    def policies_for_endpoint(self, endpoint_id):
+        """
+        :param endpoint_id: The ID of an endpoint in the index.
+        :return: The set of IDs of the policies whose selectors match the
+        endpoint.  Raises a KeyError if the endpoint is not in the index.
+        """
+        with self._lock:
+            labels = self._endpoint_labels[endpoint_id]
+        return self.select_policies(labels)
+
+    def _remove_endpoint(self, endpoint_id):
+        labels = self._endpoint_labels.pop(endpoint_id, None)
+        if labels is None:
+            return
+        self._endpoint_ids.discard(endpoint_id)
+        for key, value in labels.iteritems():
+            _discard(self._label_index, (key, value), endpoint_id)
+            _discard(self._key_index, key, endpoint_id)
+
+    def _remove_policy(self, policy_id):
+        selector = self._policy_selectors.pop(policy_id, None)
+        if selector is None:
+            return
+        self._unindexed_policies.discard(policy_id)
+        for term in selector._index_terms() or ():
+            _discard(self._policy_terms, term, policy_id)
+
+
+def _discard(index, key, item):
+    """
+    Remove an item from a set in an index dictionary, removing the set once
+    it is empty.
+    """
+    items = index.get(key)
+    if items is not None:
+        items.discard(item)
+        if not items:
+            del index[key]
@@ -20,12 +20,17 @@ import sys
 import os
 import re
 import logging
+import threading
+import time
+from collections import deque
 from subprocess import check_output, CalledProcessError
 
 import netaddr
 from netaddr import IPNetwork, IPAddress
 from netaddr.core import AddrFormatError
 
+from pycalico import metrics
+
 
 _log = logging.getLogger(__name__)  # pylint: disable=invalid-name
 _log.addHandler(logging.NullHandler())
@@ -700,3 +705,77 @@ def get_ipv6_link_local(interface_name):
         except AttributeError:
             _log.warning("No nexthop found for interface %s", interface_name)
             return None
+
+
+def map_concurrently(fn, items, max_workers):
+    """
+    Call fn once for each of the supplied items, using a bounded pool of
+    worker threads.
+
+    Exceptions raised by fn are caught and returned alongside the results
+    rather than raised, so the caller can decide how to aggregate failures.
+
+    :param fn: Function taking a single argument.
+    :param items: Iterable of arguments to pass to fn.
+    :param max_workers: The maximum number of concurrent calls to fn.  If this
+    is 1 (or there is only a single item), fn is called in the current thread.
+    :return: List of (result, exception) tuples in the same order as items.
+    The exception is None if the call succeeded, and the result is None if it
+    failed.
+    """
+    items = list(items)
+    results = [None] * len(items)
+    pending = deque(enumerate(items))
+    method = metrics.current_method()
+
+    def worker():
+        metrics.set_current_method(method)
+        while True:
+            try:
+                index, item = pending.popleft()
+            except IndexError:
+                return
+            try:
+                results[index] = (fn(item), None)
+            except Exception as e:
+                _log.debug("Concurrent call failed for %s: %r", item, e)
+                results[index] = (None, e)
+
+    num_workers = min(max_workers, len(items))
+    if num_workers <= 1:
+        worker()
+        return results
+
+    threads = [threading.Thread(target=worker) for _ in xrange(num_workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+class RateLimiter(object):
+    """
+    Limits the rate of an operation, shared across threads.
+    """
+
+    def __init__(self, rate):
+        """
+        :param rate: The maximum number of operations per second.
+        """
+        assert rate > 0
+        self.interval = 1.0 / rate
+        self._lock = threading.Lock()
+        self._next_time = 0.0
+
+    def acquire(self):
+        """
+        Wait until the next operation is allowed to proceed.
+        """
+        with self._lock:
+            now = time.time()
+            delay = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if delay > 0:
+            time.sleep(delay)
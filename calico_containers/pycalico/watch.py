@@ -0,0 +1,148 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Following the keys of an etcd subtree, so that state derived from them can be
+kept in memory rather than read from etcd on every query.
+"""
+
+import logging
+import threading
+
+import etcd
+
+_log = logging.getLogger(__name__)
+_log.addHandler(logging.NullHandler())
+
+# The time, in seconds, for which each watch request waits for a change
+# before it is reissued.
+WATCH_TIMEOUT = 60
+
+# The time, in seconds, to wait before reloading the subtree after a watch
+# fails.
+RETRY_DELAY = 1.0
+
+
+class TreeWatcher(object):
+    """
+    Loads the keys of an etcd subtree with a single recursive read, and then
+    follows changes to the subtree with etcd watches from a background
+    thread.
+
+    If the watch falls too far behind etcd's event history, or fails for any
+    other reason, the subtree is reloaded.  A datastore backend without
+    watches is therefore polled, once every retry_delay seconds.
+    """
+
+    def __init__(self, etcd_client, path, on_load, on_change,
+                 watch_timeout=WATCH_TIMEOUT, retry_delay=RETRY_DELAY):
+        """
+        :param etcd_client: The datastore backend.
+        :param path: The subtree to watch.
+        :param on_load: Called with the list of (key, value) tuples of all
+        the keys in the subtree when the subtree is (re)loaded, or None if
+        the subtree does not exist.
+        :param on_change: Called with the action, key, value and whether the
+        key is a directory, for each change to the subtree.  Deleting a
+        directory is reported as a single change for the directory.
+        :param watch_timeout: (optional) The time for which each watch request
+        waits for a change.
+        :param retry_delay: (optional) The time to wait before reloading the
+        subtree after a watch fails.
+        """
+        self.etcd_client = etcd_client
+        self.path = path
+        self.on_load = on_load
+        self.on_change = on_change
+        self.watch_timeout = watch_timeout
+        self.retry_delay = retry_delay
+        self._index = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def load(self):
+        """
+        Load the subtree, and record the etcd index to watch from.
+        """
+        try:
+            result = self.etcd_client.read(self.path, recursive=True)
+        except etcd.EtcdKeyNotFound as e:
+            payload = e.payload if isinstance(e.payload, dict) else {}
+            self._index = payload.get("index")
+            self.on_load(None)
+        else:
+            self._index = result.etcd_index
+            self.on_load([(leaf.key, leaf.value) for leaf in result.leaves
+                          if not leaf.dir])
+
+    def start(self):
+        """
+        Load the subtree, and start following changes in a background thread.
+        """
+        self.load()
+        self._thread = threading.Thread(target=self._run,
+                                        name="watch %s" % self.path)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop following changes.  A watch request in progress is abandoned
+        rather than waited for.
+        """
+        self._stopped.set()
+
+    def join(self, timeout=None):
+        """
+        Wait for the background thread to exit, after stop() has been called.
+        This takes up to the watch timeout.
+
+        :param timeout: (optional) The maximum time to wait.
+        """
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stopped.is_set():
+            try:
+                self._watch_once()
+            except Exception:
+                if self._stopped.is_set():
+                    return
+                _log.exception("Watch of %s failed, reloading", self.path)
+                self._stopped.wait(self.retry_delay)
+                try:
+                    self.load()
+                except Exception:
+                    _log.exception("Failed to reload %s", self.path)
+
+    def _watch_once(self):
+        """
+        Wait for and apply the next change to the subtree.
+        """
+        wait_index = self._index + 1 if self._index is not None else None
+        try:
+            result = self.etcd_client.read(self.path, recursive=True,
+                                           wait=True, waitIndex=wait_index,
+                                           timeout=self.watch_timeout)
+        except etcd.EtcdWatchTimedOut:
+            return
+        except etcd.EtcdEventIndexCleared:
+            _log.info("Watch of %s fell behind, reloading", self.path)
+            self.load()
+            return
+        if self._stopped.is_set():
+            return
+        self._index = result.modifiedIndex
+        self.on_change(result.action, result.key, result.value, result.dir)
@@ -13,10 +13,13 @@
 # limitations under the License.
 
 from etcd import Client as EtcdClient
-from etcd import EtcdKeyNotFound, EtcdResult, EtcdException, EtcdNotFile
+from etcd import EtcdKeyNotFound, EtcdResult, EtcdException, EtcdNotFile, \
+    EtcdAlreadyExist
 import json
+import threading
+import time
 import unittest
-from pycalico import netns
+from pycalico import datastore, netns
 
 from mock import ANY, DEFAULT
 from netaddr import IPNetwork, IPAddress, AddrFormatError
@@ -28,9 +31,17 @@ from pycalico.datastore import (DatastoreClient, CALICO_V_PATH,
                                 ETCD_SCHEME_ENV, ETCD_SCHEME_DEFAULT,
                                 ETCD_ENDPOINTS_ENV,
                                 ETCD_AUTHORITY_ENV, ETCD_CA_CERT_FILE_ENV,
-                                ETCD_CERT_FILE_ENV, ETCD_KEY_FILE_ENV)
+                                ETCD_CERT_FILE_ENV, ETCD_KEY_FILE_ENV,
+                                ETCD_API_ENV, ETCD_API_DEFAULT, ETCD_API_V3,
+                                ETCD_POOL_SIZE_ENV, ETCD_POOL_SIZE_DEFAULT,
+                                clear_etcd_clients, get_etcd_client,
+                                ENDPOINT_INDEX_PATH, ENDPOINT_INDEX_GRACE,
+                                ENDPOINT_INDEX_READY_PATH, ENDPOINT_OK,
+                                ENDPOINT_CONFLICT, ENDPOINT_NOT_FOUND,
+                                ENDPOINT_ERROR)
 from pycalico.datastore_errors import DataStoreError, ProfileNotInEndpoint, ProfileAlreadyInEndpoint, \
     MultipleEndpointsMatch, InvalidBlockSizeError
+from pycalico.memory_etcd import MemoryEtcdClient
 from pycalico.datastore_datatypes import Rules, BGPPeer, IPPool, \
     Endpoint, Profile, Rule
 
@@ -97,7 +108,9 @@ ETCD_ENV_DICT = {
     ETCD_ENDPOINTS_ENV   : "",
     ETCD_KEY_FILE_ENV    : "",
     ETCD_CERT_FILE_ENV   : "",
-    ETCD_CA_CERT_FILE_ENV: ""
+    ETCD_CA_CERT_FILE_ENV: "",
+    ETCD_API_ENV         : ETCD_API_DEFAULT,
+    ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
 }
 
 ETCD_ENV_DICT_ENDPOINTS = {
@@ -106,7 +119,9 @@ ETCD_ENV_DICT_ENDPOINTS = {
     ETCD_ENDPOINTS_ENV   : "http://1.2.3.4:5, http://6.7.8.9:10",
     ETCD_KEY_FILE_ENV    : "",
     ETCD_CERT_FILE_ENV   : "",
-    ETCD_CA_CERT_FILE_ENV: ""
+    ETCD_CA_CERT_FILE_ENV: "",
+    ETCD_API_ENV         : ETCD_API_DEFAULT,
+    ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
 }
 
 # A complicated set of Rules JSON for testing serialization / deserialization.
@@ -356,6 +371,53 @@ class TestEndpoint(unittest.TestCase):
         assert_set_equal(endpoint.ipv4_nets, endpoint2.ipv4_nets)
         assert_set_equal(endpoint.ipv6_nets, endpoint2.ipv6_nets)
 
+    def test_from_json_lazy(self):
+        """
+        Test from_json() only parses the networks of a lazily decoded
+        Endpoint when they are accessed, and that keys which are not endpoint
+        keys are rejected.
+        """
+        data = {"state": "active",
+                "name": "caliaabbccddeef",
+                "mac": "11-22-33-44-55-66",
+                "profile_ids": ["TEST23"],
+                "ipv4_nets": ["192.168.3.2/32"],
+                "ipv6_nets": ["invalid"]}
+        with patch("pycalico.datastore_datatypes.IPNetwork",
+                   side_effect=IPNetwork) as m_IPNetwork:
+            endpoint = Endpoint.from_json(TEST_ENDPOINT_PATH,
+                                          json.dumps(data), lazy=True)
+            assert_false(m_IPNetwork.called)
+            assert_equal(endpoint.hostname, TEST_HOST)
+            assert_equal(endpoint.workload_id, TEST_CONT_ID)
+            assert_equal(endpoint.endpoint_id, TEST_ENDPOINT_ID)
+            assert_equal(endpoint.profile_ids, ["TEST23"])
+            assert_set_equal(endpoint.ipv4_nets,
+                             {IPNetwork("192.168.3.2/32")})
+            assert_equal(m_IPNetwork.call_count, 1)
+        assert_raises(AddrFormatError, getattr, endpoint, "ipv6_nets")
+
+        endpoint.ipv6_nets = {IPNetwork("fd20::4:2:1/128")}
+        endpoint2 = Endpoint.from_json(TEST_ENDPOINT_PATH,
+                                       endpoint.to_json(), lazy=True)
+        assert_equal(endpoint, endpoint2)
+
+        assert_is_none(Endpoint.from_json("/calico/v1/host/" + TEST_HOST,
+                                          json.dumps(data)))
+
+    def test_slots(self):
+        """
+        Test Endpoints store their attributes in slots, but still accept
+        other attributes.
+        """
+        endpoint = Endpoint(TEST_HOST, "docker", TEST_CONT_ID,
+                            "aabbccddeeff112233",
+                            "active", "11-22-33-44-55-66")
+        assert_true("labels" in Endpoint.__slots__)
+        endpoint.extra = "value"
+        assert_equal(endpoint.copy().extra, "value")
+        assert_equal(endpoint.copy(), endpoint)
+
     def test_operators(self):
         """
         Test Endpoint operators __eq__, __ne__ and copy.
@@ -550,10 +612,12 @@ class TestDatastoreClient(unittest.TestCase):
         m_getenv.side_effect = m_getenv_return
         self.etcd_client = Mock(spec=EtcdClient)
         m_etcd_client.return_value = self.etcd_client
+        clear_etcd_clients()
         self.datastore = DatastoreClient()
         m_etcd_client.assert_called_once_with(host="127.0.0.2", port=4002,
                                               protocol="http", cert=None,
-                                              ca_cert=None)
+                                              ca_cert=None,
+                                              per_host_pool_size=ETCD_POOL_SIZE_DEFAULT)
 
     @patch('pycalico.datastore.get_hostname', autospec=True)
     def test_ensure_global_config(self, m_gethostname):
@@ -576,34 +640,34 @@ class TestDatastoreClient(unittest.TestCase):
         # etcd database.  Note it is not sufficient to just check for the
         # existence of the config directory to determine whether we write
         # the interface prefix since the config directory may contain other
-        # global configuration.
+        # global configuration.  The other config values are created with
+        # conditional writes, without reading them first.
         self.datastore.ensure_global_config()
-        expected_reads = [call(int_prefix_path),
-                          call(BGP_NODE_DEF_AS_PATH),
-                          call(BGP_NODE_MESH_PATH),
-                          call(log_file_path),
-                          call(log_screen_path),
-                          call(log_file_path_path),
-                          call(ipip_path),
-                          call(reporting_int_path),
-                          call(cluster_guid_path)]
-        self.etcd_client.read.assert_has_calls(expected_reads)
+        assert_equal(self.etcd_client.read.call_args_list,
+                     [call(int_prefix_path)])
 
         expected_writes = [call(int_prefix_path, "cali"),
                            call(IPV4_POOLS_PATH, None, dir=True),
                            call(IPV6_POOLS_PATH, None, dir=True),
                            call(BGP_CUSTOM_FILTERS_IPV4_PATH, None, dir=True),
                            call(BGP_CUSTOM_FILTERS_IPV6_PATH, None, dir=True),
-                           call(BGP_NODE_DEF_AS_PATH, "64511"),
-                           call(BGP_NODE_MESH_PATH, json.dumps({"enabled": True})),
-                           call(log_file_path, "none"),
-                           call(log_screen_path, "info"),
-                           call(log_file_path_path, "none"),
-                           call(ipip_path, "false"),
-                           call(reporting_int_path, "0"),
-                           call(cluster_guid_path, ANY, prevExist=False),
-                           call(CALICO_V_PATH + "/Ready", "true")]
-        self.etcd_client.write.assert_has_calls(expected_writes)
+                           call(BGP_NODE_DEF_AS_PATH, "64511",
+                                prevExist=False),
+                           call(BGP_NODE_MESH_PATH,
+                                json.dumps({"enabled": True}),
+                                prevExist=False),
+                           call(log_file_path, "none", prevExist=False),
+                           call(log_screen_path, "info", prevExist=False),
+                           call(log_file_path_path, "none", prevExist=False),
+                           call(ipip_path, "false", prevExist=False),
+                           call(reporting_int_path, "0", prevExist=False),
+                           call(cluster_guid_path, ANY, prevExist=False)]
+        self.etcd_client.write.assert_has_calls(expected_writes,
+                                                any_order=True)
+        # The ready flag is only written once the config is in place.
+        assert_equal(self.etcd_client.write.call_args_list[-1],
+                     call(CALICO_V_PATH + "/Ready", "true"))
+        assert_equal(len(self.etcd_client.write.call_args_list), 14)
 
     @patch('pycalico.datastore.get_hostname', autospec=True)
     def test_ensure_global_config_exists_dir(self, m_gethostname):
@@ -614,37 +678,22 @@ class TestDatastoreClient(unittest.TestCase):
         m_gethostname.return_value = "THIS_HOST"
 
         def explode(path, value, **kwargs):
-            if path == IPAM_V4_PATH:
+            if path == IPV4_POOLS_PATH:
                 raise EtcdNotFile()
 
         self.etcd_client.write.side_effect = explode
-
-        int_prefix_path = CONFIG_PATH + "InterfacePrefix"
-        log_file_path = CONFIG_PATH + "LogSeverityFile"
-        log_screen_path = CONFIG_PATH + "LogSeverityScreen"
-        log_file_path_path = CONFIG_PATH + "LogFilePath"
-        ipip_path = CONFIG_PATH + "IpInIpEnabled"
-        reporting_int_path = CONFIG_PATH + "ReportingIntervalSecs"
-        cluster_guid_path = CONFIG_PATH + "ClusterGUID"
         self.etcd_client.read.side_effect = EtcdKeyNotFound
 
         self.datastore.ensure_global_config()
 
-        expected_writes = [call(int_prefix_path, "cali"),
-                           call(IPV4_POOLS_PATH, None, dir=True),
+        expected_writes = [call(IPV4_POOLS_PATH, None, dir=True),
                            call(IPV6_POOLS_PATH, None, dir=True),
                            call(BGP_CUSTOM_FILTERS_IPV4_PATH, None, dir=True),
-                           call(BGP_CUSTOM_FILTERS_IPV6_PATH, None, dir=True),
-                           call(BGP_NODE_DEF_AS_PATH, "64511"),
-                           call(BGP_NODE_MESH_PATH, json.dumps({"enabled": True})),
-                           call(log_file_path, "none"),
-                           call(log_screen_path, "info"),
-                           call(log_file_path_path, "none"),
-                           call(ipip_path, "false"),
-                           call(reporting_int_path, "0"),
-                           call(cluster_guid_path, ANY, prevExist=False),
-                           call(CALICO_V_PATH + "/Ready", "true")]
-        self.etcd_client.write.assert_has_calls(expected_writes)
+                           call(BGP_CUSTOM_FILTERS_IPV6_PATH, None, dir=True)]
+        self.etcd_client.write.assert_has_calls(expected_writes,
+                                                any_order=True)
+        assert_equal(self.etcd_client.write.call_args_list[-1],
+                     call(CALICO_V_PATH + "/Ready", "true"))
 
     @staticmethod
     def read_defaults(defaults):
@@ -661,25 +710,27 @@ class TestDatastoreClient(unittest.TestCase):
         Test ensure_global_config() when it already exists.
         """
         int_prefix_path = CONFIG_PATH + "InterfacePrefix"
-        log_file_path = CONFIG_PATH + "LogSeverityFile"
-        log_screen_path = CONFIG_PATH + "LogSeverityScreen"
-        log_file_path_path = CONFIG_PATH + "LogFilePath"
-        ipip_path = CONFIG_PATH + "IpInIpEnabled"
+
+        def write(path, value, prevExist=None, **kwargs):
+            if prevExist is False:
+                raise EtcdAlreadyExist()
 
         self.etcd_client.read.side_effect = self.read_defaults({
             int_prefix_path: 'cali'
         })
+        self.etcd_client.write.side_effect = write
 
         self.datastore.ensure_global_config()
 
-        expected_reads = [call(int_prefix_path),
-                          call(BGP_NODE_DEF_AS_PATH),
-                          call(BGP_NODE_MESH_PATH),
-                          call(log_file_path),
-                          call(log_screen_path),
-                          call(log_file_path_path),
-                          call(ipip_path)]
-        self.etcd_client.read.assert_has_calls(expected_reads)
+        assert_equal(self.etcd_client.read.call_args_list,
+                     [call(int_prefix_path)])
+        # Only the directories and the ready flag are written
+        # unconditionally.
+        unconditional = [c for c in self.etcd_client.write.call_args_list
+                         if "prevExist" not in c[1]]
+        assert_equal(len(unconditional), 5)
+        assert_equal(unconditional[-1],
+                     call(CALICO_V_PATH + "/Ready", "true"))
 
     def test_ensure_global_config_exists_etcd_exc(self):
         """
@@ -708,18 +759,20 @@ class TestDatastoreClient(unittest.TestCase):
 
     def test_get_profile(self):
         """
-        Test getting a named profile that exists.
+        Test getting a named profile that exists, with a single read.
         Test getting a named profile that doesn't exist raises a KeyError.
         """
-        def mock_read(path):
+        def mock_read(path, recursive=False):
+            assert_true(recursive)
+            if path != TEST_PROFILE_PATH:
+                raise EtcdKeyNotFound()
             result = Mock(spec=EtcdResult)
-            if path == TEST_PROFILE_PATH:
-                return result
-            elif path == TEST_PROFILE_PATH + "tags":
-                result.value = '["TAG1", "TAG2", "TAG3"]'
-                return result
-            elif path == TEST_PROFILE_PATH + "rules":
-                result.value = """
+            tags = Mock(spec=EtcdResult, dir=False)
+            tags.key = TEST_PROFILE_PATH + "tags"
+            tags.value = '["TAG1", "TAG2", "TAG3"]'
+            rules = Mock(spec=EtcdResult, dir=False)
+            rules.key = TEST_PROFILE_PATH + "rules"
+            rules.value = """
 {
   "id": "TEST",
   "inbound_rules": [
@@ -730,12 +783,12 @@ class TestDatastoreClient(unittest.TestCase):
   ]
 }
 """
-                return result
-            else:
-                raise EtcdKeyNotFound()
+            result.leaves = [rules, tags]
+            return result
         self.etcd_client.read.side_effect = mock_read
 
         profile = self.datastore.get_profile("TEST")
+        assert_equal(self.etcd_client.read.call_count, 1)
         assert_equal(profile.name, "TEST")
         assert_set_equal({"TAG1", "TAG2", "TAG3"}, profile.tags)
         assert_equal(Rule(action="allow",
@@ -754,9 +807,12 @@ class TestDatastoreClient(unittest.TestCase):
         Test getting a named profile that exists, but has no tags or rules.
         """
 
-        def mock_read(path):
-            result = Mock(spec=EtcdResult)
+        def mock_read(path, recursive=False):
             if path == TEST_PROFILE_PATH:
+                # An empty directory is its own leaf.
+                result = Mock(spec=EtcdResult, dir=True)
+                result.key = TEST_PROFILE_PATH.rstrip("/")
+                result.leaves = [result]
                 return result
             else:
                 raise EtcdKeyNotFound()
@@ -768,6 +824,39 @@ class TestDatastoreClient(unittest.TestCase):
         assert_equal([], profile.rules.inbound_rules)
         assert_equal([], profile.rules.outbound_rules)
 
+    def test_get_profiles(self):
+        """
+        Test getting all profiles, or the named profiles, with a single read,
+        and that the rules are parsed lazily.
+        """
+        self.datastore.etcd_client = MemoryEtcdClient()
+        assert_equal(self.datastore.get_profiles(), {})
+        self.datastore.etcd_client.write(ALL_PROFILES_PATH, None, dir=True)
+        assert_equal(self.datastore.get_profiles(), {})
+
+        rules = Rules(inbound_rules=[Rule(action="allow", src_tag="TEST")],
+                      outbound_rules=[Rule(action="deny")])
+        self.datastore.create_profile("TEST", rules)
+        self.datastore.create_profile("TEST2")
+        self.datastore.etcd_client.write(
+            ALL_PROFILES_PATH + "TEST3/rules", "invalid")
+        self.datastore.etcd_client.write(ALL_PROFILES_PATH + "TEST4", None,
+                                         dir=True)
+
+        self.datastore.etcd_client.stats.clear()
+        profiles = self.datastore.get_profiles()
+        assert_equal(self.datastore.etcd_client.stats["read"], 1)
+        assert_equal(sorted(profiles), ["TEST", "TEST2", "TEST3", "TEST4"])
+        assert_equal(profiles["TEST"].tags, {"TEST"})
+        assert_equal(profiles["TEST"].rules, rules)
+        assert_equal(profiles["TEST4"].rules, Rules([], []))
+        assert_raises(ValueError, getattr, profiles["TEST3"], "rules")
+
+        profiles = self.datastore.get_profiles(["TEST2", "MISSING"])
+        assert_equal(profiles.keys(), ["TEST2"])
+        assert_equal(profiles["TEST2"].tags,
+                     self.datastore.get_profile("TEST2").tags)
+
     @raises(KeyError)
     def test_remove_profile_doesnt_exist(self):
         """
@@ -945,17 +1034,15 @@ class TestDatastoreClient(unittest.TestCase):
         Test create_host() when the .../workload key already exists.
         :return: None
         """
-        def mock_read_success(path):
-            result = Mock(spec=EtcdResult)
+        def mock_write(path, value, dir=False, prevExist=None):
             if path == TEST_HOST_PATH + "/workload":
-                return result
+                assert_true(dir)
+                raise EtcdNotFile()
             elif path == TEST_HOST_PATH + "/config/DefaultEndpointToHostAction":
-                result.value = "RETURN"
-                return result
-            else:
-                assert False
+                assert_false(prevExist)
+                raise EtcdAlreadyExist()
 
-        self.etcd_client.read.side_effect = mock_read_success
+        self.etcd_client.write.side_effect = mock_write
 
         ipv4 = "192.168.2.4"
         ipv6 = "fd80::4"
@@ -966,28 +1053,19 @@ class TestDatastoreClient(unittest.TestCase):
                            call(TEST_BGP_HOST_IPV6_PATH, ipv6),
                            call(TEST_BGP_HOST_AS_PATH, bgp_as),
                            call(IPAM_V4_PATH, None, dir=True),
-                           call(IPAM_V6_PATH, None, dir=True),
-                           call(TEST_HOST_PATH + "/config/marker",
-                                "created")]
+                           call(IPAM_V6_PATH, None, dir=True)]
         self.etcd_client.write.assert_has_calls(expected_writes,
                                                 any_order=True)
-        assert_equal(self.etcd_client.write.call_count, 7)
+        assert_equal(len(self.etcd_client.write.call_args_list), 9)
+        assert_equal(self.etcd_client.write.call_args_list[-1],
+                     call(TEST_HOST_PATH + "/config/marker", "created"))
+        assert_false(self.etcd_client.read.called)
 
     def test_create_host_mainline(self):
         """
-        Test create_host() when none of the keys exists (specifically,
-        .../workload is checked and doesn't exist).
+        Test create_host() when none of the keys exists.
         :return: None
         """
-        def mock_read(path):
-            if path == CALICO_V_PATH + "/host/TEST_HOST/workload":
-                raise EtcdKeyNotFound()
-            elif path == TEST_HOST_PATH + "/config/DefaultEndpointToHostAction":
-                raise EtcdKeyNotFound()
-            else:
-                assert False
-
-        self.etcd_client.read.side_effect = mock_read
         self.etcd_client.delete.side_effect = EtcdKeyNotFound()
 
         ipv4 = "192.168.2.4"
@@ -1001,14 +1079,32 @@ class TestDatastoreClient(unittest.TestCase):
                            call(IPAM_V6_PATH, None, dir=True),
                            call(TEST_HOST_PATH +
                                 "/config/DefaultEndpointToHostAction",
-                                "RETURN"),
-                           call(TEST_HOST_PATH + "/config/marker",
-                                "created"),
+                                "RETURN", prevExist=False),
                            call(TEST_HOST_PATH + "/workload",
                                 None, dir=True)]
         self.etcd_client.write.assert_has_calls(expected_writes,
                                                 any_order=True)
-        assert_equal(self.etcd_client.write.call_count, 8)
+        assert_equal(len(self.etcd_client.write.call_args_list), 8)
+        assert_equal(self.etcd_client.write.call_args_list[-1],
+                     call(TEST_HOST_PATH + "/config/marker", "created"))
+        self.etcd_client.delete.assert_called_once_with(TEST_BGP_HOST_AS_PATH)
+
+    def test_create_host_error(self):
+        """
+        Test create_host() does not flag the host as created if a write
+        fails.
+        :return: None
+        """
+        def mock_write(path, value, **kwargs):
+            if path == TEST_BGP_HOST_IPV6_PATH:
+                raise EtcdException("Failed")
+
+        self.etcd_client.write.side_effect = mock_write
+        assert_raises(DataStoreError, self.datastore.create_host, TEST_HOST,
+                      "192.168.2.4", "fd80::4", None)
+        assert_equal(len(self.etcd_client.write.call_args_list), 7)
+        assert_not_in(call(TEST_HOST_PATH + "/config/marker", "created"),
+                      self.etcd_client.write.call_args_list)
 
     def test_get_per_host_config_mainline(self):
         value = self.datastore.get_per_host_config("hostname", "SomeConfig")
@@ -1783,7 +1879,7 @@ class TestDatastoreClient(unittest.TestCase):
                                                "as_num": "65111"}]}}
         assert_equal(self.datastore.get_hosts_data_dict(), expected)
 
-    def test_get_hosts_data(self):
+    def test_get_hosts_data_empty(self):
         """
         Test get_hosts_data_dict returns an empty dict if no hosts exist
         :return: None.
@@ -1797,6 +1893,54 @@ class TestDatastoreClient(unittest.TestCase):
         self.etcd_client.read = mock_read
         assert_equal(self.datastore.get_hosts_data_dict(), {})
 
+    def test_iter_hosts_data(self):
+        """
+        Test iter_hosts_data yields each host in turn, filtered by prefix,
+        and decodes the BGP peers only when they are accessed.
+        :return: None.
+        """
+        def leaf(key, value):
+            obj = Mock(spec=EtcdResult)
+            obj.key = datastore.BGP_HOSTS_PATH + key
+            obj.value = value
+            return obj
+
+        def mock_read(path, *args, **kwargs):
+            assert_equal(path, BGP_HOSTS_PATH+"/")
+            assert_true(kwargs["sorted"])
+            result = Mock(spec=EtcdResult)
+            result.leaves = [
+                leaf("host1/ip_addr_v4", "1.2.3.4"),
+                leaf("host1/peer_v4/10.0.0.1",
+                     '{"ip": "10.0.0.1", "as_num": "65111"}'),
+                leaf("host1/peer_v4/10.0.0.2", "not json"),
+                leaf("host2/ip_addr_v4", "1.2.3.5"),
+                leaf("other/ip_addr_v4", "1.2.3.6"),
+            ]
+            return result
+        self.etcd_client.read = mock_read
+
+        hosts = self.datastore.iter_hosts_data()
+        hostname, data = next(hosts)
+        assert_equal(hostname, "host1")
+        assert_equal(data["ip_addr_v4"], "1.2.3.4")
+        assert_equal(len(data["peer_v4"]), 2)
+        assert_raises(ValueError, list, data["peer_v4"])
+        assert_equal(list(data["peer_v6"]), [])
+        assert_equal([hostname for hostname, _ in hosts], ["host2", "other"])
+
+        hosts = self.datastore.iter_hosts_data(hostname_prefix="host")
+        assert_equal([hostname for hostname, _ in hosts], ["host1", "host2"])
+
+    def test_iter_hosts_data_error(self):
+        """
+        Test iter_hosts_data reads the hosts when called, so that a failed
+        read raises a DataStoreError.
+        :return: None.
+        """
+        self.etcd_client.read.side_effect = EtcdException("Failed")
+        assert_raises(DataStoreError, self.datastore.iter_hosts_data)
+
     def test_get_hostnames_from_ips(self):
         """
         Test get_hostnames_from_ips returns correct dict when matches found
@@ -1871,6 +2015,12 @@ class TestDatastoreClient(unittest.TestCase):
 
 class TestDatastoreClientEndpoints(unittest.TestCase):
 
+    def setUp(self):
+        clear_etcd_clients()
+
+    def tearDown(self):
+        clear_etcd_clients()
+
     @patch("pycalico.datastore.os.getenv", autospec=True)
     @patch("pycalico.datastore.etcd.Client", autospec=True)
     def test_endpoints_single_override(self, m_etcd_client, m_getenv):
@@ -1881,7 +2031,9 @@ class TestDatastoreClientEndpoints(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "http://127.0.0.1:2379",
             ETCD_KEY_FILE_ENV    : "",
             ETCD_CERT_FILE_ENV   : "",
-            ETCD_CA_CERT_FILE_ENV: ""
+            ETCD_CA_CERT_FILE_ENV: "",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -1894,7 +2046,8 @@ class TestDatastoreClientEndpoints(unittest.TestCase):
                                               port=2379,
                                               protocol="http",
                                               cert=None,
-                                              ca_cert=None)
+                                              ca_cert=None,
+                                              per_host_pool_size=ETCD_POOL_SIZE_DEFAULT)
 
     @patch("pycalico.datastore.os.getenv", autospec=True)
     @patch("pycalico.datastore.etcd.Client", autospec=True)
@@ -1906,7 +2059,9 @@ class TestDatastoreClientEndpoints(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "http://127.0.0.1:2379, http://127.0.1.1:2381",
             ETCD_KEY_FILE_ENV    : "",
             ETCD_CERT_FILE_ENV   : "",
-            ETCD_CA_CERT_FILE_ENV: ""
+            ETCD_CA_CERT_FILE_ENV: "",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -1920,7 +2075,39 @@ class TestDatastoreClientEndpoints(unittest.TestCase):
                                               protocol="http",
                                               cert=None,
                                               ca_cert=None,
-                                              allow_reconnect=True)
+                                              allow_reconnect=True,
+                                              per_host_pool_size=ETCD_POOL_SIZE_DEFAULT)
+
+    @patch("pycalico.datastore.os.getenv", autospec=True)
+    @patch("pycalico.datastore.EtcdV3Client", autospec=True)
+    def test_endpoints_etcd_v3(self, m_etcd_client, m_getenv):
+        """ Test selecting the etcd v3 backend."""
+        etcd_env_dict = {
+            ETCD_AUTHORITY_ENV   : "127.0.1.1:2380",
+            ETCD_SCHEME_ENV      : "https",
+            ETCD_ENDPOINTS_ENV   : "http://127.0.0.1:2379, http://127.0.1.1:2381",
+            ETCD_KEY_FILE_ENV    : "",
+            ETCD_CERT_FILE_ENV   : "",
+            ETCD_CA_CERT_FILE_ENV: "",
+            ETCD_API_ENV         : ETCD_API_V3,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
+        }
+
+        def m_getenv_return(key, *args):
+            return etcd_env_dict[key]
+        m_getenv.side_effect = m_getenv_return
+        self.datastore = DatastoreClient()
+        m_etcd_client.assert_called_once_with(host=(("127.0.0.1", 2379),
+                                                    ("127.0.1.1", 2381)),
+                                              protocol="http",
+                                              cert=None,
+                                              ca_cert=None,
+                                              per_host_pool_size=ETCD_POOL_SIZE_DEFAULT)
+        self.assertEqual(self.datastore.etcd_client,
+                         m_etcd_client.return_value)
+
+        etcd_env_dict[ETCD_API_ENV] = "v4"
+        self.assertRaises(DataStoreError, DatastoreClient)
 
     @patch("pycalico.datastore.os.getenv", autospec=True)
     @patch("pycalico.datastore.etcd.Client", autospec=True)
@@ -1932,7 +2119,9 @@ class TestDatastoreClientEndpoints(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "http://127.0.0.1:2379, https://127.0.1.1:2381",
             ETCD_KEY_FILE_ENV    : "",
             ETCD_CERT_FILE_ENV   : "",
-            ETCD_CA_CERT_FILE_ENV: ""
+            ETCD_CA_CERT_FILE_ENV: "",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -1953,7 +2142,9 @@ class TestDatastoreClientEndpoints(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "http:/ /127.0.0.1:2379\, https://127.0.1.1:2381",
             ETCD_KEY_FILE_ENV    : "",
             ETCD_CERT_FILE_ENV   : "",
-            ETCD_CA_CERT_FILE_ENV: ""
+            ETCD_CA_CERT_FILE_ENV: "",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -1974,7 +2165,9 @@ class TestDatastoreClientEndpoints(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "ftp://127.0.0.1:2379",
             ETCD_KEY_FILE_ENV    : "",
             ETCD_CERT_FILE_ENV   : "",
-            ETCD_CA_CERT_FILE_ENV: ""
+            ETCD_CA_CERT_FILE_ENV: "",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -1985,9 +2178,59 @@ class TestDatastoreClientEndpoints(unittest.TestCase):
         self.assertRaises(DataStoreError, DatastoreClient)
         self.assertFalse(m_etcd_client.called)
 
+    @patch("pycalico.datastore.os.getenv", autospec=True)
+    @patch("pycalico.datastore.etcd.Client", autospec=True)
+    def test_shared_client(self, m_etcd_client, m_getenv):
+        """ Test etcd clients are shared for the same etcd configuration."""
+        etcd_env_dict = ETCD_ENV_DICT.copy()
+
+        def m_getenv_return(key, *args):
+            return etcd_env_dict[key]
+        m_getenv.side_effect = m_getenv_return
+        m_etcd_client.side_effect = lambda **kwargs: Mock(spec=EtcdClient)
+
+        client1 = DatastoreClient()
+        client2 = DatastoreClient()
+        self.assertIs(client1.etcd_client, client2.etcd_client)
+        self.assertEqual(m_etcd_client.call_count, 1)
+
+        etcd_env_dict[ETCD_AUTHORITY_ENV] = "127.0.0.3:4002"
+        client3 = DatastoreClient()
+        self.assertIsNot(client3.etcd_client, client1.etcd_client)
+        self.assertIs(get_etcd_client(), client3.etcd_client)
+
+        clear_etcd_clients()
+        client4 = DatastoreClient()
+        self.assertIsNot(client4.etcd_client, client3.etcd_client)
+        self.assertEqual(m_etcd_client.call_count, 3)
+
+        etcd_client = Mock(spec=EtcdClient)
+        self.assertIs(DatastoreClient(etcd_client).etcd_client, etcd_client)
+        self.assertEqual(m_etcd_client.call_count, 3)
+
+    @parameterized.expand(["0", "-1", "ten"])
+    @patch("pycalico.datastore.os.getenv", autospec=True)
+    @patch("pycalico.datastore.etcd.Client", autospec=True)
+    def test_pool_size_invalid(self, pool_size, m_etcd_client, m_getenv):
+        """ Test invalid etcd connection pool sizes."""
+        etcd_env_dict = ETCD_ENV_DICT.copy()
+        etcd_env_dict[ETCD_POOL_SIZE_ENV] = pool_size
+
+        def m_getenv_return(key, *args):
+            return etcd_env_dict[key]
+        m_getenv.side_effect = m_getenv_return
+        self.assertRaises(DataStoreError, DatastoreClient)
+        self.assertFalse(m_etcd_client.called)
+
 
 class TestSecureDatastoreClient(unittest.TestCase):
 
+    def setUp(self):
+        clear_etcd_clients()
+
+    def tearDown(self):
+        clear_etcd_clients()
+
     @patch("pycalico.datastore.os.getenv", autospec=True)
     @patch("pycalico.datastore.etcd.Client", autospec=True)
     @patch("pycalico.datastore.os.access", autospec=True)
@@ -2004,7 +2247,9 @@ class TestSecureDatastoreClient(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "",
             ETCD_KEY_FILE_ENV    : "",
             ETCD_CERT_FILE_ENV   : "",
-            ETCD_CA_CERT_FILE_ENV: ca_file
+            ETCD_CA_CERT_FILE_ENV: ca_file,
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -2017,7 +2262,8 @@ class TestSecureDatastoreClient(unittest.TestCase):
                                               port=2380,
                                               protocol="https",
                                               cert=None,
-                                              ca_cert=ca_file)
+                                              ca_cert=ca_file,
+                                              per_host_pool_size=ETCD_POOL_SIZE_DEFAULT)
 
     @patch("pycalico.datastore.os.getenv", autospec=True)
     @patch("pycalico.datastore.etcd.Client", autospec=True)
@@ -2036,7 +2282,9 @@ class TestSecureDatastoreClient(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "",
             ETCD_KEY_FILE_ENV    : key_file,
             ETCD_CERT_FILE_ENV   : cert_file,
-            ETCD_CA_CERT_FILE_ENV: ca_file
+            ETCD_CA_CERT_FILE_ENV: ca_file,
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -2049,7 +2297,8 @@ class TestSecureDatastoreClient(unittest.TestCase):
                                               port=2380,
                                               protocol="https",
                                               cert=(cert_file, key_file),
-                                              ca_cert=ca_file)
+                                              ca_cert=ca_file,
+                                              per_host_pool_size=ETCD_POOL_SIZE_DEFAULT)
 
     @patch("pycalico.datastore.os.getenv", autospec=True)
     @patch("pycalico.datastore.etcd.Client", autospec=True)
@@ -2068,7 +2317,9 @@ class TestSecureDatastoreClient(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "",
             ETCD_KEY_FILE_ENV    : "",
             ETCD_CERT_FILE_ENV   : "",
-            ETCD_CA_CERT_FILE_ENV: ""
+            ETCD_CA_CERT_FILE_ENV: "",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -2097,7 +2348,9 @@ class TestSecureDatastoreClient(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "",
             ETCD_KEY_FILE_ENV    : "/path/to/key_file",
             ETCD_CERT_FILE_ENV   : "",
-            ETCD_CA_CERT_FILE_ENV: ""
+            ETCD_CA_CERT_FILE_ENV: "",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -2126,7 +2379,9 @@ class TestSecureDatastoreClient(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "",
             ETCD_KEY_FILE_ENV    : "",
             ETCD_CERT_FILE_ENV   : "/path/to/cert_file",
-            ETCD_CA_CERT_FILE_ENV: ""
+            ETCD_CA_CERT_FILE_ENV: "",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -2154,7 +2409,9 @@ class TestSecureDatastoreClient(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "",
             ETCD_KEY_FILE_ENV    : "/path/to/key_dir/",
             ETCD_CERT_FILE_ENV   : "/path/to/cert_file",
-            ETCD_CA_CERT_FILE_ENV: "/path/to/ca_file"
+            ETCD_CA_CERT_FILE_ENV: "/path/to/ca_file",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -2183,7 +2440,9 @@ class TestSecureDatastoreClient(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "",
             ETCD_KEY_FILE_ENV    : "/path/to/key_file",
             ETCD_CERT_FILE_ENV   : "/path/to/bad_cert",
-            ETCD_CA_CERT_FILE_ENV: "/path/to/ca_file"
+            ETCD_CA_CERT_FILE_ENV: "/path/to/ca_file",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -2212,7 +2471,9 @@ class TestSecureDatastoreClient(unittest.TestCase):
             ETCD_ENDPOINTS_ENV   : "",
             ETCD_KEY_FILE_ENV    : "/path/to/key_file",
             ETCD_CERT_FILE_ENV   : "/path/to/cert_file",
-            ETCD_CA_CERT_FILE_ENV: "/path/to/not_readable"
+            ETCD_CA_CERT_FILE_ENV: "/path/to/not_readable",
+            ETCD_API_ENV         : ETCD_API_DEFAULT,
+            ETCD_POOL_SIZE_ENV   : ETCD_POOL_SIZE_DEFAULT
         }
 
         def m_getenv_return(key, *args):
@@ -2420,3 +2681,403 @@ def mock_read_0_ep_for_cont(path):
     result = Mock(spec=EtcdResult)
     result.leaves = iter(leaves)
     return result
+
+
+class TestDatastoreClientEndpointIndex(unittest.TestCase):
+    """
+    Tests of the endpoint indexes, against the in-memory datastore backend.
+    """
+
+    def setUp(self):
+        self.etcd_client = MemoryEtcdClient()
+        self.datastore = DatastoreClient(etcd_client=self.etcd_client,
+                                         index_endpoints=True)
+
+    def _create_endpoint(self, hostname, workload_id, ips, labels):
+        endpoint = self.datastore.create_endpoint(hostname, "docker",
+                                                  workload_id, ips)
+        endpoint.labels = labels
+        self.datastore.set_endpoint(endpoint)
+        return endpoint
+
+    def test_index_lookups(self):
+        """
+        Test looking up endpoints using the indexes.
+        """
+        ep1 = self._create_endpoint("host1", "wl1", ["10.0.0.1/32"],
+                                    {"app": "web", "k8s.io/name": "a b"})
+        ep2 = self._create_endpoint("host2", "wl2", ["10.0.0.2/32",
+                                                     "fd00::2/128"],
+                                    {"app": "web"})
+        assert_equal(self.datastore.build_endpoint_index(), 2)
+
+        self.etcd_client.stats.clear()
+        assert_equal(self.datastore.get_endpoints(workload_id="wl1"), [ep1])
+        # One read of the index, and one of the endpoint.
+        assert_equal(self.etcd_client.stats["read"], 2)
+
+        assert_equal(self.datastore.get_endpoints_by_ip("fd00::2"), [ep2])
+        assert_equal(self.datastore.get_endpoints_by_ip(
+            IPAddress("10.0.0.1")), [ep1])
+        assert_equal(self.datastore.get_endpoints_by_ip("10.0.0.3"), [])
+        assert_equal(
+            sorted(ep.workload_id for ep in
+                   self.datastore.get_endpoints_by_label("app", "web")),
+            ["wl1", "wl2"])
+        assert_equal(self.datastore.get_endpoints_by_label("k8s.io/name",
+                                                           "a b"), [ep1])
+        assert_equal(self.datastore.get_endpoint(workload_id="wl2",
+                                                 orchestrator_id="docker"),
+                     ep2)
+
+    def test_index_maintenance(self):
+        """
+        Test the indexes are updated when endpoints are updated and removed.
+        """
+        ep1 = self._create_endpoint("host1", "wl1", ["10.0.0.1/32"],
+                                    {"app": "web"})
+        self.datastore.build_endpoint_index()
+
+        ep1.labels = {"app": "db"}
+        ep1.ipv4_nets = {IPNetwork("10.0.0.5/32")}
+        self.datastore.update_endpoint(ep1)
+        assert_equal(self.datastore.get_endpoints_by_label("app", "web"), [])
+        assert_equal(self.datastore.get_endpoints_by_label("app", "db"),
+                     [ep1])
+        assert_equal(self.datastore.get_endpoints_by_ip("10.0.0.1"), [])
+        assert_equal(self.datastore.get_endpoints_by_ip("10.0.0.5"), [ep1])
+
+        self.datastore.remove_endpoint(ep1)
+        assert_equal(self.datastore.get_endpoints(workload_id="wl1"), [])
+        index_keys = [leaf.key for leaf in self.etcd_client.read(
+            ENDPOINT_INDEX_PATH, recursive=True).leaves if not leaf.dir]
+        assert_equal(index_keys, [ENDPOINT_INDEX_READY_PATH])
+
+    def test_compact_endpoints(self):
+        """
+        Test compact endpoints are updated atomically using their etcd index,
+        and the indexes are maintained.
+        """
+        self._create_endpoint("host1", "wl1", ["10.0.0.1/32"],
+                              {"app": "web"})
+        self.datastore.build_endpoint_index()
+
+        ep1, = self.datastore.get_endpoints(workload_id="wl1", compact=True)
+        assert_is_none(ep1._original_json)
+        ep2, = self.datastore.get_endpoints(hostname="host1", compact=True)
+        assert_true(ep1.hostname is ep2.hostname)
+
+        ep1.labels = {"app": "db"}
+        self.datastore.update_endpoint(ep1)
+        assert_equal(self.datastore.get_endpoints_by_label("app", "web"), [])
+        assert_equal(self.datastore.get_endpoints_by_label("app", "db"),
+                     [ep1])
+
+        # The second copy is now out of date.
+        ep2.state = "inactive"
+        assert_raises(DataStoreError, self.datastore.update_endpoint, ep2)
+        ep1.state = "inactive"
+        self.datastore.update_endpoint(ep1)
+
+        self.datastore.remove_endpoint(ep2)
+        index_keys = [leaf.key for leaf in self.etcd_client.read(
+            ENDPOINT_INDEX_PATH, recursive=True).leaves if not leaf.dir]
+        assert_equal(index_keys, [ENDPOINT_INDEX_READY_PATH])
+
+    def test_batch_endpoints(self):
+        """
+        Test writing, updating and removing batches of endpoints, with a
+        result reported for each endpoint.
+        """
+        endpoints = [self.datastore.create_endpoint("host1", "docker",
+                                                    "wl%d" % i,
+                                                    ["10.0.0.%d/32" % i])
+                     for i in range(5)]
+        report = self.datastore.set_endpoints(endpoints, max_concurrent=3)
+        assert_equal(report, [(ep, ENDPOINT_OK, None) for ep in endpoints])
+        assert_equal(len(self.datastore.get_endpoints(hostname="host1")), 5)
+
+        # Update one endpoint from a stale copy, and one endpoint that has
+        # been removed.
+        stale = self.datastore.get_endpoint(workload_id="wl0",
+                                            orchestrator_id="docker")
+        endpoints[0].state = "inactive"
+        self.datastore.update_endpoint(endpoints[0])
+        self.datastore.remove_endpoint(endpoints[1])
+        for endpoint in endpoints:
+            endpoint.labels = {"app": "web"}
+        report = self.datastore.update_endpoints([stale] + endpoints[1:])
+        assert_equal([result for _, result, _ in report],
+                     [ENDPOINT_CONFLICT, ENDPOINT_CONFLICT, ENDPOINT_OK,
+                      ENDPOINT_OK, ENDPOINT_OK])
+        assert_equal(
+            sorted(ep.workload_id for ep in
+                   self.datastore.get_endpoints_by_label("app", "web")),
+            ["wl2", "wl3", "wl4"])
+
+        delete = self.etcd_client.delete
+
+        def failing_delete(key, **kwargs):
+            if "/wl3/" in key:
+                raise EtcdException("Failed")
+            return delete(key, **kwargs)
+        self.etcd_client.delete = failing_delete
+        report = self.datastore.remove_endpoints(endpoints[2:4])
+        assert_equal([result for _, result, _ in report],
+                     [ENDPOINT_OK, ENDPOINT_ERROR])
+        assert_is_instance(report[1][2], DataStoreError)
+        assert_in("(Failed)", report[1][2].message)
+
+        self.etcd_client.delete = delete
+        report = self.datastore.remove_endpoints(endpoints)
+        assert_equal([result for _, result, _ in report],
+                     [ENDPOINT_OK, ENDPOINT_NOT_FOUND, ENDPOINT_NOT_FOUND,
+                      ENDPOINT_OK, ENDPOINT_OK])
+        assert_equal(self.datastore.get_endpoints(hostname="host1"), [])
+
+    def test_stale_entries(self):
+        """
+        Test index entries for endpoints removed without the index being
+        updated are ignored and deleted.
+        """
+        self._create_endpoint("host1", "wl1", ["10.0.0.1/32"], {})
+        self.datastore.build_endpoint_index()
+        self.datastore.remove_workload("host1", "docker", "wl1")
+
+        # The endpoint may be about to be written, so the entries are kept
+        # until they are older than the grace period.
+        assert_equal(self.datastore.get_endpoints(workload_id="wl1"), [])
+        assert_equal(len(self._index_keys()), 3)
+        with patch("pycalico.datastore.time.time",
+                   return_value=time.time() + ENDPOINT_INDEX_GRACE + 1):
+            assert_equal(self.datastore.get_endpoints(workload_id="wl1"), [])
+            assert_equal(self.datastore.get_endpoints_by_ip("10.0.0.1"), [])
+        assert_equal(self._index_keys(), [ENDPOINT_INDEX_READY_PATH])
+
+    def test_lookup_during_write(self):
+        """
+        Test entries added for an endpoint write are not deleted by a lookup
+        made before the endpoint is written.
+        """
+        ep1 = self._create_endpoint("host1", "wl1", ["10.0.0.1/32"], {})
+        self.datastore.build_endpoint_index()
+        ep2 = self.datastore.create_endpoint("host1", "docker", "wl2",
+                                             ["10.0.0.2/32"])
+        write = self.etcd_client.write
+        looked_up = []
+
+        def interleaved_write(key, value, **kwargs):
+            if "/endpoint/" in key and "/index/" not in key:
+                # The index entries have been added, but the endpoint has
+                # not been written yet.
+                looked_up.append(
+                    (self.datastore.get_endpoints_by_label("app", "web"),
+                     self.datastore.get_endpoints_by_ip("10.0.0.2"),
+                     self.datastore.get_profile_members("prof1")))
+            return write(key, value, **kwargs)
+
+        ep1.labels = {"app": "web"}
+        ep1.profile_ids = ["prof1"]
+        ep2.profile_ids = ["prof1"]
+        with patch.object(self.etcd_client, "write",
+                          side_effect=interleaved_write):
+            self.datastore.update_endpoint(ep1)
+            self.datastore.set_endpoint(ep2)
+        assert_equal(looked_up, [([], [], []), ([ep1], [], [ep1])])
+
+        assert_equal(self.datastore.get_endpoints_by_label("app", "web"),
+                     [ep1])
+        assert_equal(self.datastore.get_endpoints_by_ip("10.0.0.2"), [ep2])
+        assert_equal(
+            sorted(ep.workload_id for ep in
+                   self.datastore.get_profile_members("prof1")),
+            ["wl1", "wl2"])
+
+    def test_failed_write(self):
+        """
+        Test the entries added for an endpoint write are removed if the write
+        fails, but not entries that already existed.
+        """
+        ep1 = self._create_endpoint("host1", "wl1", ["10.0.0.1/32"],
+                                    {"app": "web"})
+        self.datastore.build_endpoint_index()
+        index_keys = self._index_keys()
+        stale = self.datastore.get_endpoint(workload_id="wl1",
+                                            orchestrator_id="docker")
+        ep1.state = "inactive"
+        self.datastore.update_endpoint(ep1)
+
+        stale.labels = {"app": "db"}
+        assert_raises(DataStoreError, self.datastore.update_endpoint, stale)
+        report = self.datastore.update_endpoints([stale])
+        assert_equal(report[0][1], ENDPOINT_CONFLICT)
+        assert_equal(self._index_keys(), index_keys)
+        assert_equal(self.datastore.get_endpoints_by_label("app", "web"),
+                     [ep1])
+
+    def _index_keys(self):
+        return sorted(leaf.key for leaf in self.etcd_client.read(
+            ENDPOINT_INDEX_PATH, recursive=True).leaves if not leaf.dir)
+
+    def test_profile_members(self):
+        """
+        Test looking up profile members, with and without the indexes.
+        """
+        ep1 = self._create_endpoint("host1", "wl1", ["10.0.0.1/32"], {})
+        ep2 = self._create_endpoint("host2", "wl2", ["10.0.0.2/32"], {})
+        self.datastore.set_profiles_on_endpoint(["prof1", "prof2"],
+                                                workload_id="wl1")
+        self.datastore.set_profiles_on_endpoint(["prof2"], workload_id="wl2")
+        ep1.profile_ids = ["prof1", "prof2"]
+        ep2.profile_ids = ["prof2"]
+        expected = {"prof1": [ep1], "prof2": [ep1, ep2], "prof3": []}
+
+        def members():
+            members = self.datastore.get_profiles_members(
+                ["prof1", "prof2", "prof3"])
+            for endpoints in members.values():
+                endpoints.sort(key=lambda ep: ep.workload_id)
+            return members
+
+        # Without the indexes, every endpoint is read in a single read.
+        self.etcd_client.stats.clear()
+        assert_equal(members(), expected)
+        assert_equal(self.etcd_client.stats["read"], 2)
+
+        # With the indexes, each endpoint is read once.
+        self.datastore.build_endpoint_index()
+        self.etcd_client.stats.clear()
+        assert_equal(members(), expected)
+        assert_equal(self.etcd_client.stats["read"], 5)
+        assert_equal(self.datastore.get_profile_members("prof1"), [ep1])
+
+        self.datastore.remove_profiles_from_endpoint(["prof2"],
+                                                     workload_id="wl2")
+        assert_equal(self.datastore.get_profile_members("prof2"), [ep1])
+
+    def test_concurrent_endpoint_reads(self):
+        """
+        Test the endpoints in an index directory are read in parallel, each
+        once, and read errors are reported.
+        """
+        endpoints = [self._create_endpoint("host1", "wl%d" % i,
+                                           ["10.0.0.%d/32" % i],
+                                           {"app": "web"})
+                     for i in range(6)]
+        self.datastore.build_endpoint_index()
+        read = self.etcd_client.read
+        lock = threading.Lock()
+        reads = []
+        in_flight = [0, 0]
+
+        def slow_read(key, **kwargs):
+            if "/index/" not in key:
+                with lock:
+                    reads.append(key)
+                    in_flight[0] += 1
+                    in_flight[1] = max(in_flight)
+                time.sleep(0.01)
+                with lock:
+                    in_flight[0] -= 1
+            return read(key, **kwargs)
+
+        with patch.object(self.etcd_client, "read", side_effect=slow_read):
+            matches = self.datastore.get_endpoints_by_label("app", "web")
+        assert_equal(sorted(ep.workload_id for ep in matches),
+                     sorted(ep.workload_id for ep in endpoints))
+        assert_equal(len(reads), 6)
+        assert_true(in_flight[1] > 1)
+
+        def failing_read(key, **kwargs):
+            if "/wl3/" in key:
+                raise EtcdException("Failed")
+            return read(key, **kwargs)
+
+        with patch.object(self.etcd_client, "read",
+                          side_effect=failing_read):
+            assert_raises(DataStoreError,
+                          self.datastore.get_endpoints_by_label, "app", "web")
+
+    def test_index_not_ready(self):
+        """
+        Test the indexes are not used until they have been built.
+        """
+        other = DatastoreClient(etcd_client=self.etcd_client)
+        endpoint = other.create_endpoint("host1", "docker", "wl1",
+                                         ["10.0.0.1/32"])
+        other.set_endpoint(endpoint)
+
+        assert_equal(self.datastore.get_endpoints(workload_id="wl1"),
+                     [endpoint])
+        assert_equal(self.datastore.get_endpoints_by_ip("10.0.0.1"),
+                     [endpoint])
+        assert_raises(EtcdKeyNotFound, self.etcd_client.read,
+                      ENDPOINT_INDEX_PATH)
+
+        self.datastore.build_endpoint_index()
+        assert_equal(self.datastore.get_endpoints_by_ip("10.0.0.1"),
+                     [endpoint])
+
+
+class TestDatastoreClientHostIPCache(unittest.TestCase):
+    """
+    Tests of the host IP cache, against the in-memory datastore backend.
+    """
+
+    def setUp(self):
+        self.etcd_client = MemoryEtcdClient()
+        self.datastore = DatastoreClient(etcd_client=self.etcd_client,
+                                         cache_host_ips=True)
+
+    def tearDown(self):
+        self.datastore.close()
+
+    def _wait_for_hostnames(self, ip_list, expected):
+        """
+        Wait for the cache to reflect the datastore.
+        :param expected: The expected hostnames, or None to wait for there to
+        be no BGP hosts.
+        """
+        deadline = time.time() + 5
+        while True:
+            try:
+                hostnames = self.datastore.get_hostnames_from_ips(ip_list)
+            except KeyError:
+                hostnames = None
+            if hostnames == expected:
+                return
+            assert_true(time.time() < deadline, "Timed out")
+            time.sleep(0.01)
+
+    def test_cache(self):
+        """
+        Test looking up hostnames from the cache as hosts change.
+        """
+        assert_raises(KeyError, self.datastore.get_hostnames_from_ips,
+                      ["10.0.0.1"])
+
+        self.etcd_client.write(datastore.BGP_HOST_IPV4_PATH % {"hostname": "host1"},
+                               "10.0.0.1")
+        self.etcd_client.write(datastore.BGP_HOST_IPV6_PATH % {"hostname": "host1"},
+                               "fd00::1")
+        self.etcd_client.write(datastore.BGP_HOST_IPV4_PATH % {"hostname": "host2"},
+                               "10.0.0.2")
+        self._wait_for_hostnames(["10.0.0.1", "fd00::1", "10.0.0.2",
+                                  "10.0.0.3"],
+                                 {"10.0.0.1": "host1", "fd00::1": "host1",
+                                  "10.0.0.2": "host2"})
+        self.etcd_client.stats.clear()
+        self.datastore.get_hostnames_from_ips(["10.0.0.1"])
+        assert_equal(self.etcd_client.stats["read"], 0)
+
+        # Change an IP, and remove a host.
+        self.etcd_client.write(datastore.BGP_HOST_IPV4_PATH % {"hostname": "host2"},
+                               "10.0.0.3")
+        self.etcd_client.delete(datastore.BGP_HOST_PATH % {"hostname": "host1"},
+                                recursive=True)
+        self._wait_for_hostnames(["10.0.0.1", "fd00::1", "10.0.0.2",
+                                  "10.0.0.3"],
+                                 {"10.0.0.3": "host2"})
+
+        self.etcd_client.delete(datastore.BGP_HOSTS_PATH, recursive=True)
+        self._wait_for_hostnames(["10.0.0.3"], None)
@@ -0,0 +1,315 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import base64
+import json
+import unittest
+
+from etcd import (EtcdKeyNotFound, EtcdAlreadyExist, EtcdCompareFailed,
+                  EtcdDirNotEmpty, EtcdConnectionFailed, EtcdException)
+from mock import Mock
+from netaddr import IPNetwork
+from nose.tools import assert_equal, assert_raises, assert_true, \
+    assert_false
+from urllib3.exceptions import MaxRetryError
+
+from pycalico.datastore_datatypes import IPPool
+from pycalico.etcdv3 import EtcdV3Client, TXN_PUT, TXN_DELETE
+from pycalico.ipam import IPAMClient
+
+
+class FakeGateway(object):
+    """
+    A minimal in-memory etcd v3 JSON gateway, replacing the urllib3
+    PoolManager of an EtcdV3Client.
+    """
+    def __init__(self):
+        self.revision = 1
+        self.kvs = {}
+        self.requests = []
+
+    def urlopen(self, method, url, body=None, headers=None):
+        api_method = url.split("/v3/", 1)[1]
+        request = json.loads(body)
+        self.requests.append((api_method, request))
+        handler = getattr(self, "_" + api_method.replace("/", "_"))
+        response = handler(request)
+        response["header"] = {"revision": str(self.revision)}
+        return Mock(status=200, data=json.dumps(response))
+
+    def _kv_range(self, request):
+        kvs = self._range(request)
+        if request.get("count_only"):
+            return {"count": str(len(kvs))}
+        return {"kvs": [self._kv(key) for key in kvs], "count": str(len(kvs))}
+
+    def _kv_put(self, request):
+        key = base64.b64decode(request["key"])
+        prev = self._kv(key) if key in self.kvs else None
+        self.revision += 1
+        self._put(key, base64.b64decode(request["value"]))
+        return {"prev_kv": prev} if prev and request.get("prev_kv") else {}
+
+    def _kv_deleterange(self, request):
+        keys = self._range(request)
+        prev = [self._kv(key) for key in keys]
+        if keys:
+            self.revision += 1
+        for key in keys:
+            del self.kvs[key]
+        response = {"deleted": str(len(keys))}
+        if request.get("prev_kv"):
+            response["prev_kvs"] = prev
+        return response
+
+    def _kv_txn(self, request):
+        succeeded = all(self._compare(compare)
+                        for compare in request.get("compare", []))
+        ops = request.get("success" if succeeded else "failure", [])
+        revision = self.revision
+        responses = []
+        for op in ops:
+            (name, body), = op.items()
+            # All writes in a transaction share one revision.
+            self.revision = revision
+            responses.append({name.replace("request", "response"):
+                              getattr(self, "_kv_" + {
+                                  "request_range": "range",
+                                  "request_put": "put",
+                                  "request_delete_range": "deleterange",
+                              }[name])(body)})
+            revision = max(revision, self.revision)
+        self.revision = revision
+        return {"succeeded": succeeded, "responses": responses}
+
+    def _lease_grant(self, request):
+        return {"ID": "7", "TTL": str(request["TTL"])}
+
+    def _range(self, request):
+        key = base64.b64decode(request["key"])
+        if "range_end" not in request:
+            return [key] if key in self.kvs else []
+        end = base64.b64decode(request["range_end"])
+        return sorted(k for k in self.kvs if key <= k < end)
+
+    def _compare(self, compare):
+        key = base64.b64decode(compare["key"])
+        kv = self.kvs.get(key)
+        target = compare["target"]
+        if target == "VERSION":
+            actual = kv["version"] if kv else 0
+            expected = int(compare["version"])
+        elif target == "MOD":
+            actual = kv["mod_revision"] if kv else 0
+            expected = int(compare["mod_revision"])
+        else:
+            actual = kv["value"] if kv else None
+            expected = base64.b64decode(compare["value"])
+        if compare["result"] == "EQUAL":
+            return actual == expected
+        return actual > expected
+
+    def _put(self, key, value):
+        kv = self.kvs.get(key)
+        self.kvs[key] = {
+            "value": value,
+            "create_revision": kv["create_revision"] if kv else self.revision,
+            "mod_revision": self.revision,
+            "version": kv["version"] + 1 if kv else 1}
+
+    def _kv(self, key):
+        kv = self.kvs[key]
+        return {"key": base64.b64encode(key),
+                "value": base64.b64encode(kv["value"]),
+                "create_revision": str(kv["create_revision"]),
+                "mod_revision": str(kv["mod_revision"]),
+                "version": str(kv["version"])}
+
+
+class TestEtcdV3Client(unittest.TestCase):
+
+    def setUp(self):
+        self.client = EtcdV3Client()
+        self.gateway = FakeGateway()
+        self.client.http = self.gateway
+
+    def test_write_read(self):
+        """
+        Test writing and reading keys, with the revision as the etcd index.
+        """
+        result = self.client.write("/calico/v1/a", "1")
+        assert_equal(result.action, "set")
+        index = result.modifiedIndex
+        result = self.client.read("/calico/v1/a", quorum=True)
+        assert_equal((result.key, result.value), ("/calico/v1/a", "1"))
+        assert_equal(result.modifiedIndex, index)
+        assert_equal(result.etcd_index, index)
+        assert_false(self.gateway.requests[-1][1]["serializable"])
+
+        result = self.client.write("/calico/v1/a", 2)
+        assert_true(result.modifiedIndex > index)
+        assert_equal(result.createdIndex, index)
+        assert_equal(result._prev_node.value, "1")
+        assert_raises(EtcdKeyNotFound, self.client.read, "/calico/v1/b")
+
+    def test_read_directory(self):
+        """
+        Test reading key prefixes as directories.
+        """
+        self.client.write("/calico/a/x", "1")
+        self.client.write("/calico/a/y/z", "2")
+        self.client.write("/calico/b", "3")
+        self.client.write("/calicob", "4")
+
+        result = self.client.read("/calico", recursive=True)
+        assert_true(result.dir)
+        assert_equal([(leaf.key, leaf.value) for leaf in result.leaves],
+                     [("/calico/a/x", "1"), ("/calico/a/y/z", "2"),
+                      ("/calico/b", "3")])
+
+        result = self.client.read("/calico/")
+        assert_equal([(child.key, child.dir) for child in result.leaves],
+                     [("/calico/a", True), ("/calico/b", False)])
+
+    def test_compare_and_swap(self):
+        """
+        Test compare-and-swap writes raise the v2 exceptions.
+        """
+        result = self.client.write("/key", "1", prevExist=False)
+        assert_equal(result.action, "create")
+        assert_raises(EtcdAlreadyExist, self.client.write, "/key", "2",
+                      prevExist=False)
+        assert_raises(EtcdKeyNotFound, self.client.write, "/other", "2",
+                      prevIndex=1)
+
+        result = self.client.read("/key")
+        self.client.write("/key", "2")
+        result.value = "3"
+        assert_raises(EtcdCompareFailed, self.client.update, result)
+        result = self.client.read("/key")
+        result.value = "3"
+        updated = self.client.update(result)
+        assert_equal(updated.action, "compareAndSwap")
+        assert_equal(self.client.read("/key").value, "3")
+
+        assert_raises(EtcdCompareFailed, self.client.write, "/key", "4",
+                      prevValue="2")
+
+    def test_ttl(self):
+        """
+        Test keys with a TTL are attached to a lease.
+        """
+        self.client.write("/key", "1", ttl=10)
+        assert_equal(self.gateway.requests[0], ("lease/grant", {"TTL": 10}))
+        assert_equal(self.gateway.requests[1][1]["lease"], "7")
+
+    def test_delete(self):
+        """
+        Test deleting keys and directories.
+        """
+        self.client.write("/dir/a", "1")
+        self.client.write("/dir/b/c", "2")
+        self.client.write("/key", "1")
+        index = self.client.read("/key").modifiedIndex
+
+        assert_raises(EtcdCompareFailed, self.client.delete, "/key",
+                      prevIndex=index + 1)
+        result = self.client.delete("/key", prevIndex=index)
+        assert_equal(result.action, "compareAndDelete")
+        assert_raises(EtcdKeyNotFound, self.client.delete, "/key")
+
+        assert_raises(EtcdDirNotEmpty, self.client.delete, "/dir", dir=True)
+        self.client.delete("/dir", recursive=True)
+        assert_equal(self.gateway.kvs, {})
+        assert_raises(EtcdKeyNotFound, self.client.delete, "/dir",
+                      recursive=True)
+
+    def test_txn(self):
+        """
+        Test multi-key transactions.
+        """
+        self.client.write("/a", "1")
+        index = self.client.read("/a").modifiedIndex
+
+        assert_false(self.client.txn([("/a", index + 1)],
+                                     [(TXN_PUT, "/b", "2")]))
+        assert_true(self.client.txn([("/a", index), ("/b", None)],
+                                    [(TXN_DELETE, "/a", None),
+                                     (TXN_PUT, "/b", "2")]))
+        assert_raises(EtcdKeyNotFound, self.client.read, "/a")
+        assert_equal(self.client.read("/b").value, "2")
+        assert_false(self.client.txn([("/b", None)], []))
+
+    def test_failover(self):
+        """
+        Test requests are retried against the other hosts.
+        """
+        client = EtcdV3Client(host=(("10.0.0.1", 2379), ("10.0.0.2", 2379)))
+        gateway = FakeGateway()
+        calls = []
+
+        def urlopen(method, url, **kwargs):
+            calls.append(url)
+            if "10.0.0.1" in url:
+                raise MaxRetryError(None, url)
+            return gateway.urlopen(method, url, **kwargs)
+        client.http = Mock(urlopen=urlopen)
+
+        client.write("/key", "1")
+        client.read("/key")
+        assert_equal([url.split("/")[2] for url in calls],
+                     ["10.0.0.1:2379", "10.0.0.2:2379", "10.0.0.2:2379"])
+
+        client.http = Mock(urlopen=Mock(side_effect=MaxRetryError(None, "")))
+        assert_raises(EtcdConnectionFailed, client.read, "/key")
+
+    def test_error_response(self):
+        """
+        Test gateway errors are raised as EtcdExceptions.
+        """
+        self.client.http = Mock(urlopen=Mock(return_value=Mock(
+            status=400, data='{"error": "bad request", "code": 3}')))
+        with assert_raises(EtcdException) as cm:
+            self.client.read("/key")
+        assert_true("bad request" in str(cm.exception))
+
+    def test_unsupported(self):
+        """
+        Test watches and in-order keys are rejected.
+        """
+        assert_raises(EtcdException, self.client.read, "/key", wait=True)
+        assert_raises(EtcdException, self.client.write, "/key", "1",
+                      append=True)
+
+    def test_ipam(self):
+        """
+        Test IPAM assignments with the v3 backend, writing each block and
+        its handle in a single transaction.
+        """
+        client = IPAMClient(etcd_client=self.client)
+        client.add_ip_pool(4, IPPool(IPNetwork("10.10.0.0/24")))
+        v4, _ = client.auto_assign_ips(3, 0, "handle1", {}, host="host1")
+        assert_equal(len(v4), 3)
+        assert_equal(sorted(client.get_ip_assignments_by_handle("handle1")),
+                     sorted(v4))
+
+        del self.gateway.requests[:]
+        client.release_ips({v4[0]})
+        txns = [request for method, request in self.gateway.requests
+                if method == "kv/txn"]
+        assert_equal(len(txns), 1)
+        assert_equal(len(txns[0]["success"]), 2)
+
+        client.release_ip_by_handle("handle1")
+        assert_raises(KeyError, client.get_ip_assignments_by_handle,
+                      "handle1")
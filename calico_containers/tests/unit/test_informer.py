@@ -0,0 +1,154 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import Queue
+import unittest
+
+from etcd import EtcdEventIndexCleared
+from mock import patch
+from netaddr import IPNetwork
+from nose.tools import assert_equal, assert_raises, assert_true
+
+from pycalico.datastore import DatastoreClient, HOSTS_PATH
+from pycalico.datastore_datatypes import IPPool, Rule, Rules
+from pycalico.informer import Informer, SET, DELETE, ENDPOINTS, PROFILES
+from pycalico.memory_etcd import MemoryEtcdClient
+
+
+class TestInformer(unittest.TestCase):
+
+    def setUp(self):
+        self.etcd_client = MemoryEtcdClient()
+        self.datastore = DatastoreClient(etcd_client=self.etcd_client)
+        self.events = Queue.Queue()
+        self.informer = None
+
+    def tearDown(self):
+        if self.informer is not None:
+            self.informer.stop()
+            self.informer.join(5)
+
+    def start_informer(self, **kwargs):
+        self.informer = Informer(etcd_client=self.etcd_client,
+                                 watch_timeout=0.05, retry_delay=0.01,
+                                 **kwargs)
+        self.informer.add_listener(
+            lambda *change: self.events.put(change))
+        self.informer.start()
+
+    def next_event(self):
+        return self.events.get(timeout=5)
+
+    def create_endpoint(self, workload_id, ip):
+        endpoint = self.datastore.create_endpoint("host1", "docker",
+                                                  workload_id, [ip])
+        self.datastore.set_endpoint(endpoint)
+        return endpoint
+
+    def test_load(self):
+        """
+        Test the mirrored subtrees are loaded, and read through the typed
+        APIs.
+        """
+        ep1 = self.create_endpoint("wl1", "10.0.0.1")
+        rules = Rules(inbound_rules=[Rule(action="allow")],
+                      outbound_rules=[])
+        self.datastore.create_profile("prof1", rules)
+        self.datastore.add_ip_pool(4, IPPool("10.0.0.0/16"))
+        self.datastore.create_policy("tier1", "pol1", "a == 'b'", order=10)
+        self.datastore.create_host("host1", "192.168.0.1", "fd00::1", None)
+
+        self.start_informer()
+        self.etcd_client.stats.clear()
+        assert_equal(self.informer.get_endpoints(hostname="host1"), [ep1])
+        assert_equal(self.informer.get_endpoints(workload_id="wl2"), [])
+        assert_equal(self.informer.get_profile_names(), {"prof1"})
+        assert_equal(self.informer.get_profile("prof1").rules, rules)
+        assert_raises(KeyError, self.informer.get_profile, "prof2")
+        assert_equal(self.informer.get_ip_pools(4),
+                     [IPPool("10.0.0.0/16")])
+        assert_equal(self.informer.get_ip_pools(6), [])
+        policy, = self.informer.get_policies()
+        assert_equal((policy.tier_name, policy.policy_name, policy.order,
+                      policy.selector), ("tier1", "pol1", 10, "a == 'b'"))
+        assert_equal(self.informer.get_policies(tier_name="tier2"), [])
+        assert_equal(self.informer.get_hostnames_from_ips(["192.168.0.1"]),
+                     {"192.168.0.1": "host1"})
+        # All of the reads were served from memory.
+        assert_equal(self.etcd_client.stats["read"], 0)
+
+    def test_changes(self):
+        """
+        Test changes are mirrored, and reported to listeners.
+        """
+        self.start_informer(subtrees=(ENDPOINTS,))
+        assert_raises(ValueError, self.informer.get_profile_names)
+
+        ep1 = self.create_endpoint("wl1", "10.0.0.1")
+        action, key, _ = self.next_event()
+        assert_equal((action, key), (SET, HOSTS_PATH +
+                                     "host1/workload/docker/wl1/endpoint/" +
+                                     ep1.endpoint_id))
+        assert_equal(self.informer.get_endpoints(), [ep1])
+
+        ep1.ipv4_nets = {IPNetwork("10.0.0.2/32")}
+        self.datastore.update_endpoint(ep1)
+        assert_equal(self.next_event(), (SET, key, ep1.to_json()))
+        assert_equal(self.informer.get(key), ep1.to_json())
+
+        self.datastore.remove_workload("host1", "docker", "wl1")
+        assert_equal(self.next_event(), (DELETE, key, None))
+        assert_equal(self.informer.get_endpoints(), [])
+        assert_equal(self.informer.items(HOSTS_PATH), [])
+
+    def test_resync(self):
+        """
+        Test a subtree is reloaded when its watch falls behind, and listeners
+        are told about the differences.
+        """
+        self.datastore.create_profile("prof1")
+        self.datastore.create_profile("prof2")
+        read = self.etcd_client.read
+        dropped = []
+
+        def lossy_read(key, **kwargs):
+            if kwargs.get("wait") and not dropped:
+                # Change the profiles while the watch is not running.
+                dropped.append(key)
+                self.etcd_client.delete(key + "prof1", recursive=True,
+                                        dir=True)
+                self.etcd_client.write(key + "prof2/tags", '["new"]')
+                raise EtcdEventIndexCleared("Cleared")
+            return read(key, **kwargs)
+
+        with patch.object(self.etcd_client, "read", side_effect=lossy_read):
+            self.start_informer(subtrees=(PROFILES,))
+            # The initial load reports every key.
+            loaded = [self.next_event() for _ in range(6)]
+            assert_true(all(action == SET for action, _, _ in loaded))
+            changes = sorted([self.next_event() for _ in range(4)])
+        assert_equal([(action, key.rsplit("/", 2)[1:])
+                      for action, key, _ in changes],
+                     [(DELETE, ["prof1", "labels"]),
+                      (DELETE, ["prof1", "rules"]),
+                      (DELETE, ["prof1", "tags"]),
+                      (SET, ["prof2", "tags"])])
+        assert_equal(self.informer.get_profile_names(), {"prof2"})
+        assert_equal(self.informer.get_profile("prof2").tags, {"new"})
+
+    def test_invalid_subtree(self):
+        """
+        Test an unknown subtree is rejected.
+        """
+        assert_raises(ValueError, Informer, etcd_client=self.etcd_client,
+                      subtrees=("unknown",))
@@ -12,23 +12,35 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import copy
+import gzip
 from netaddr import IPNetwork, IPAddress
 from nose.tools import *
 from mock import patch, ANY, call, Mock
 import unittest
 import json
-from etcd import EtcdResult, Client, EtcdAlreadyExist, EtcdKeyNotFound, EtcdCompareFailed
+from StringIO import StringIO
+from etcd import EtcdResult, Client, EtcdAlreadyExist, EtcdKeyNotFound, EtcdCompareFailed, \
+    EtcdException
 
 from pycalico.ipam import (IPAMClient, BlockHandleReaderWriter,
                            CASError, NoFreeBlocksError, _block_datastore_key,
                            _handle_datastore_key, HostAffinityClaimedError,
-                           IPAMConfigConflictError, _random_subnets_from_cidr,
+                           IPAMConfigConflictError, BlockNotSparseError,
+                           HandleMigrationError,
+                           _sharded_handle_datastore_key,
+                           AFFINITY_CLAIMED, AFFINITY_CLAIMED_BY_OTHER,
+                           AFFINITY_SKIPPED, AFFINITY_ERROR,
+                           READ_QUORUM, READ_LOCAL,
+                           _random_subnets_from_cidr,
                            _random_subnets_from_cidrs)
-from pycalico.datastore_errors import PoolNotFound, InvalidBlockSizeError
-from pycalico.block import AllocationBlock, AddressNotAssignedError, BLOCK_SIZE
+from pycalico.datastore_errors import (PoolNotFound, InvalidBlockSizeError,
+                                       DataStoreError)
+from pycalico.block import AllocationBlock, AddressNotAssignedError, BLOCK_SIZE, \
+    AlreadyAssignedError, get_block_cidr_for_address
 from pycalico.handle import AllocationHandle, AddressCountTooLow
 from pycalico.datastore import IPAM_CONFIG_PATH
 from pycalico.datastore_datatypes import IPPool, IPAMConfig
+from pycalico.memory_etcd import MemoryEtcdClient, MemoryEtcdTxnClient
 from tests.unit.test_block import (_test_block_empty_v4, _test_block_empty_v6,
                          BLOCK_V6_1, BLOCK_V4_1, _test_block_not_empty_v4)
 from tests.unit.test_block import BLOCK_V4_1
@@ -560,6 +572,135 @@ class TestIPAMClient(unittest.TestCase):
                 call(first_free_block)
             ])
 
+    def test_order_affine_blocks(self):
+        """
+        Test ordering of affine blocks for auto-assignment.
+        """
+        blocks = [BLOCK_V4_1, BLOCK_V4_2, BLOCK_V4_3]
+
+        # With no handle or block state, the order is unchanged.
+        assert_list_equal(self.client._order_affine_blocks(blocks, None),
+                          blocks)
+
+        # The handle rotates the starting block, consistently.
+        starts = set()
+        for ii in xrange(20):
+            handle_id = "handle%s" % ii
+            ordered = self.client._order_affine_blocks(blocks, handle_id)
+            assert_list_equal(ordered,
+                              self.client._order_affine_blocks(blocks,
+                                                               handle_id))
+            assert_equal(set(ordered), set(blocks))
+            start = blocks.index(ordered[0])
+            assert_list_equal(ordered, blocks[start:] + blocks[:start])
+            starts.add(start)
+        assert_equal(starts, {0, 1, 2})
+
+        # Full blocks go last, then recent CAS failures, and blocks known to
+        # have free addresses go first.
+        self.client._block_free_addresses[BLOCK_V4_1] = 0
+        self.client._block_free_addresses[BLOCK_V4_3] = 10
+        assert_list_equal(self.client._order_affine_blocks(blocks, None),
+                          [BLOCK_V4_3, BLOCK_V4_2, BLOCK_V4_1])
+        with patch("pycalico.ipam.time.time", return_value=100.0):
+            self.client._block_cas_failures[BLOCK_V4_3] = 99.5
+            assert_list_equal(self.client._order_affine_blocks(blocks, None),
+                              [BLOCK_V4_2, BLOCK_V4_3, BLOCK_V4_1])
+            # The CAS failure is forgotten after the backoff.
+            self.client._block_cas_failures[BLOCK_V4_3] = 98.0
+            assert_list_equal(self.client._order_affine_blocks(blocks, None),
+                              [BLOCK_V4_3, BLOCK_V4_2, BLOCK_V4_1])
+
+    def test_auto_assign_records_block_state(self):
+        """
+        Test auto assign records the free addresses and CAS failures of the
+        blocks it assigns from.
+        """
+        block = _test_block_empty_v4()
+
+        def read(key, quorum):
+            m_result = Mock(spec=EtcdResult)
+            m_result.value = block.to_json()
+            return m_result
+        self.m_etcd_client.read.side_effect = read
+        self.m_etcd_client.update.side_effect = [EtcdCompareFailed(), None]
+
+        with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
+                   return_value=[BLOCK_V4_1]):
+            (ipv4s, ipv6s) = self.client.auto_assign_ips(2, 0, None, {},
+                                                         host=TEST_HOST)
+        assert_equal(len(ipv4s), 2)
+        assert_true(BLOCK_V4_1 in self.client._block_cas_failures)
+        assert_equal(self.client._block_free_addresses[BLOCK_V4_1],
+                     BLOCK_SIZE - 2)
+
+    def test_auto_assign_spare_block_watermark(self):
+        """
+        Test auto assign schedules a background spare block check when the
+        watermark is configured.
+        """
+        self.client.spare_block_watermark = 10
+        with patch("pycalico.ipam.IPAMClient._allocate_ips_explicit_blocks",
+                   return_value=[IPAddress("10.11.12.0")]), \
+             patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
+                   return_value=[BLOCK_V4_1]), \
+             patch("pycalico.ipam.IPAMClient._check_spare_blocks") as m_check:
+            self.client.auto_assign_ips(1, 0, None, {}, host=TEST_HOST)
+            self.client._wait_for_spare_block_checks()
+            m_check.assert_called_once_with(TEST_HOST, 4, None)
+
+        # No check is scheduled without the watermark.
+        self.client.spare_block_watermark = None
+        with patch("pycalico.ipam.IPAMClient._allocate_ips_explicit_blocks",
+                   return_value=[IPAddress("10.11.12.0")]), \
+             patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
+                   return_value=[BLOCK_V4_1]), \
+             patch("pycalico.ipam.IPAMClient._check_spare_blocks") as m_check:
+            self.client.auto_assign_ips(1, 0, None, {}, host=TEST_HOST)
+            self.client._wait_for_spare_block_checks()
+            assert_equal(m_check.call_count, 0)
+
+    def test_check_spare_blocks(self):
+        """
+        Test _check_spare_blocks claims a block only when the free addresses
+        drop below the watermark.
+        """
+        block0 = _test_block_empty_v4()
+        block0.auto_assign(BLOCK_SIZE - 5, None, {}, TEST_HOST)
+
+        with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
+                   return_value=[BLOCK_V4_1]), \
+             patch("pycalico.ipam.BlockHandleReaderWriter._read_block",
+                   return_value=block0), \
+             patch("pycalico.ipam.BlockHandleReaderWriter._new_affine_block",
+                   return_value=BLOCK_V4_2) as m_new_block:
+            # Plenty of spare addresses.
+            self.client.spare_block_watermark = 5
+            assert_is_none(self.client._check_spare_blocks(TEST_HOST, 4,
+                                                           None))
+            assert_equal(m_new_block.call_count, 0)
+
+            # Below the watermark.
+            self.client.spare_block_watermark = 6
+            assert_equal(self.client._check_spare_blocks(TEST_HOST, 4, None),
+                         BLOCK_V4_2)
+            m_new_block.assert_called_once_with(TEST_HOST, 4, None,
+                                                IPAMConfig())
+
+            # Below the watermark, but no free blocks.
+            m_new_block.side_effect = NoFreeBlocksError
+            assert_is_none(self.client._check_spare_blocks(TEST_HOST, 4,
+                                                           None))
+
+            # Below the watermark, but auto-allocation is disabled.
+            m_new_block.reset_mock()
+            self.client.get_ipam_config.return_value = IPAMConfig(
+                                                auto_allocate_blocks=False,
+                                                strict_affinity=True)
+            assert_is_none(self.client._check_spare_blocks(TEST_HOST, 4,
+                                                           None))
+            assert_equal(m_new_block.call_count, 0)
+
     def test_assign(self):
         """
         Mainline test of assign_ip().
@@ -1087,9 +1228,10 @@ class TestIPAMClient(unittest.TestCase):
         self.m_etcd_client.read.side_effect = read
 
         # Mock out update, so we can fail the first one.  We should then get
-        # a successful update for the block, an update for the handle, an
-        # update for the next block.  The handle is then deleted.
-        update_errors = [EtcdCompareFailed(), None, None, None]
+        # a successful update for that block and an update for the other
+        # block.  The handle is then deleted in a single operation once both
+        # blocks have been released.
+        update_errors = [EtcdCompareFailed(), None, None]
 
         def update(result):
             error = update_errors.pop(0)
@@ -1117,6 +1259,36 @@ class TestIPAMClient(unittest.TestCase):
         self.assertEquals(block4.unallocated[-1], 13)
         self.assertEquals(block6.unallocated[-1], 45)
 
+    def test_release_ip_by_handle_partial_failure(self):
+        """
+        Test release_ip_by_handle when releasing from one block fails.  The
+        handle should still be decremented for the block that was released,
+        and the error re-raised.
+        """
+        cidr4 = BLOCK_V4_1
+        cidr6 = IPNetwork("2001:abcd:def0::/122")
+        handle_id = "handle_id_1"
+
+        handle0 = AllocationHandle(handle_id)
+        handle0.increment_block(cidr4, 2)
+        handle0.increment_block(cidr6, 1)
+
+        def m_release_block(_self, _handle_id, block_cidr):
+            assert_equal(_handle_id, handle_id)
+            if block_cidr == cidr4:
+                return 2
+            raise EtcdException("failed")
+
+        with patch("pycalico.ipam.IPAMClient._release_ip_by_handle_block",
+                   m_release_block), \
+             patch("pycalico.ipam.BlockHandleReaderWriter._read_handle",
+                   return_value=handle0), \
+             patch("pycalico.ipam.BlockHandleReaderWriter."
+                   "_decrement_handle_blocks") as m_decrement:
+            assert_raises(DataStoreError,
+                          self.client.release_ip_by_handle, handle_id)
+            m_decrement.assert_called_once_with(handle_id, {cidr4: 2})
+
     def test_release_ip_by_handle_no_block(self):
         """
         Test of release_ip_by_handle when referenced block does not exist.
@@ -1196,7 +1368,7 @@ class TestIPAMClient(unittest.TestCase):
         block6 = _test_block_empty_v6()
         block6.assign(ip6, handle_id0, {}, TEST_HOST)
 
-        def m_read_block(_self, block_cidr):
+        def m_read_block(_self, block_cidr, quorum=True):
             if block_cidr == block4.cidr:
                 return block4
             if block_cidr == block6.cidr:
@@ -1208,7 +1380,7 @@ class TestIPAMClient(unittest.TestCase):
         handle0.increment_block(cidr4, 5)
         handle0.increment_block(cidr6, 3)
 
-        def m_read_handle(_self, handle_id):
+        def m_read_handle(_self, handle_id, quorum=True):
             assert_equal(handle_id0, handle_id)
             return handle0
 
@@ -1228,6 +1400,15 @@ class TestIPAMClient(unittest.TestCase):
             ips = self.client.get_ip_assignments_by_handle(handle_id0)
             assert_list_equal([], ips)
 
+        # Test when reading a block fails for some other reason.
+        with patch("pycalico.ipam.BlockHandleReaderWriter._read_block",
+                   side_effect=EtcdException), \
+            patch("pycalico.ipam.BlockHandleReaderWriter._read_handle",
+                  m_read_handle):
+            assert_raises(DataStoreError,
+                          self.client.get_ip_assignments_by_handle,
+                          handle_id0)
+
     def test_get_assignment_attributes(self):
         """
         Test get_assignment_attributes() mainline.
@@ -1245,7 +1426,7 @@ class TestIPAMClient(unittest.TestCase):
         block6 = _test_block_empty_v6()
         block6.assign(ip6, handle_id6, attr6, TEST_HOST)
 
-        def m_read_block(_self, block_cidr):
+        def m_read_block(_self, block_cidr, quorum=True):
             if block_cidr == block4.cidr:
                 return block4
             if block_cidr == block6.cidr:
@@ -1274,18 +1455,89 @@ class TestIPAMClient(unittest.TestCase):
             assert not include_disabled
             return [IPPool("10.11.0.0/16"), IPPool("192.168.0.0/16")]
 
+        # The third block is claimed by another host.  Claim one block at a
+        # time so that the fourth block is skipped.
+        m_claim = Mock(side_effect=self._block_side_effects(
+            {IPNetwork("10.11.0.128/26"): HostAffinityClaimedError}))
         with patch("pycalico.ipam.BlockHandleReaderWriter.get_ipam_config",
                    return_value="config"), \
              patch("pycalico.ipam.BlockHandleReaderWriter._claim_block_affinity",
-                   side_effect=[None, None, HostAffinityClaimedError]), \
+                   m_claim), \
              patch("pycalico.datastore.DatastoreClient.get_ip_pools",
                    m_get_ip_pools):
-            claimed, not_claimed = self.client.claim_affinity(claim_cidr)
+            claimed, not_claimed = self.client.claim_affinity(claim_cidr,
+                                                              max_concurrent=1)
 
         assert_equal(claimed,
                      [IPNetwork("10.11.0.0/26"), IPNetwork("10.11.0.64/26")])
         assert_equal(not_claimed,
                      [IPNetwork("10.11.0.128/26")])
+        assert_equal(m_claim.call_count, 3)
+
+    def _block_side_effects(self, errors):
+        """
+        Return a side effect function for a per-block operation taking
+        (host, block_cidr, ...) that raises the error for the block, if any.
+        """
+        def side_effect(host, block_cidr, *args):
+            error = errors.get(block_cidr)
+            if error is not None:
+                raise error
+        return side_effect
+
+    def test_claim_affinity_blocks(self):
+        """
+        Test claim_affinity_blocks() reports the result for each block, with
+        and without continue_on_conflict.
+        """
+        claim_cidr = IPNetwork("10.11.0.0/24")
+        blocks = list(claim_cidr.subnet(26))
+        m_claim = Mock(side_effect=self._block_side_effects(
+            {blocks[1]: HostAffinityClaimedError}))
+        with patch("pycalico.ipam.BlockHandleReaderWriter.get_ipam_config",
+                   return_value="config"), \
+             patch("pycalico.ipam.BlockHandleReaderWriter._claim_block_affinity",
+                   m_claim), \
+             patch("pycalico.ipam.IPAMClient._validate_cidr_in_pools",
+                   return_value=True):
+            report = self.client.claim_affinity_blocks(
+                claim_cidr, host=TEST_HOST, continue_on_conflict=True)
+            assert_equal(report,
+                         [(blocks[0], AFFINITY_CLAIMED, None),
+                          (blocks[1], AFFINITY_CLAIMED_BY_OTHER, None),
+                          (blocks[2], AFFINITY_CLAIMED, None),
+                          (blocks[3], AFFINITY_CLAIMED, None)])
+            m_claim.assert_has_calls([call(TEST_HOST, block, ANY)
+                                      for block in blocks], any_order=True)
+
+            report = self.client.claim_affinity_blocks(
+                claim_cidr, host=TEST_HOST, max_concurrent=1)
+            assert_equal(report,
+                         [(blocks[0], AFFINITY_CLAIMED, None),
+                          (blocks[1], AFFINITY_CLAIMED_BY_OTHER, None),
+                          (blocks[2], AFFINITY_SKIPPED, None),
+                          (blocks[3], AFFINITY_SKIPPED, None)])
+
+    def test_claim_affinity_error(self):
+        """
+        Test claim_affinity() with an etcd error claiming a block.
+        """
+        claim_cidr = IPNetwork("10.11.0.0/24")
+        blocks = list(claim_cidr.subnet(26))
+        error = EtcdException()
+        m_claim = Mock(side_effect=self._block_side_effects({blocks[2]: error}))
+        with patch("pycalico.ipam.BlockHandleReaderWriter.get_ipam_config",
+                   return_value="config"), \
+             patch("pycalico.ipam.BlockHandleReaderWriter._claim_block_affinity",
+                   m_claim), \
+             patch("pycalico.ipam.IPAMClient._validate_cidr_in_pools",
+                   return_value=True):
+            report = self.client.claim_affinity_blocks(claim_cidr,
+                                                       max_concurrent=1)
+            assert_equal(report[2], (blocks[2], AFFINITY_ERROR, error))
+            assert_equal(report[3], (blocks[3], AFFINITY_SKIPPED, None))
+            assert_raises(DataStoreError, self.client.claim_affinity,
+                          claim_cidr)
 
     def test_claim_affinity_invalid_pool(self):
         """
@@ -1316,10 +1568,13 @@ class TestIPAMClient(unittest.TestCase):
         """
         release_cidr = IPNetwork("10.11.0.0/24")
 
+        m_release = Mock(side_effect=self._block_side_effects(
+            {IPNetwork("10.11.0.128/26"): HostAffinityClaimedError,
+             IPNetwork("10.11.0.192/26"): KeyError}))
         with patch("pycalico.ipam.BlockHandleReaderWriter.get_ipam_config",
                    return_value="config"), \
              patch("pycalico.ipam.BlockHandleReaderWriter._release_block_affinity",
-                   side_effect=[None, None, HostAffinityClaimedError, KeyError]):
+                   m_release):
             released, not_claimed, not_owned = self.client.release_affinity(release_cidr)
 
         assert_equal(released,
@@ -1347,9 +1602,95 @@ class TestIPAMClient(unittest.TestCase):
         with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
                    return_value=[net1, net2]), \
              patch("pycalico.ipam.BlockHandleReaderWriter._release_block_affinity",
-                   side_effect=[None, HostAffinityClaimedError, None, None]) as m_release:
+                   side_effect=self._block_side_effects(
+                       {net2: HostAffinityClaimedError})) as m_release:
             self.client.release_host_affinities("fred")
-            m_release.assert_has_calls([call("fred", net1), call("fred", net2)])
+            m_release.assert_has_calls([call("fred", net1), call("fred", net2)],
+                                       any_order=True)
+
+    def test_release_host_affinities_error(self):
+        """
+        Test release_host_affinities() raises errors releasing blocks, after
+        releasing the other blocks.
+        """
+        net1 = IPNetwork("1.2.3.0/26")
+        net2 = IPNetwork("1.2.3.64/26")
+
+        with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
+                   return_value=[net1, net2]), \
+             patch("pycalico.ipam.BlockHandleReaderWriter._release_block_affinity",
+                   side_effect=self._block_side_effects(
+                       {net1: KeyError})) as m_release:
+            assert_raises(KeyError, self.client.release_host_affinities,
+                          "fred")
+            assert_equal(m_release.call_count, 4)
+
+    def test_decommission_hosts(self):
+        """
+        Mainline test of decommission_hosts().
+        """
+        net1 = IPNetwork("1.2.3.0/26")
+        net2 = IPNetwork("1.2.3.64/26")
+        net3 = IPNetwork("1.2.3.128/26")
+        net4 = IPNetwork("1.2.3.192/26")
+        affine_blocks = {("host1", 4): [net1, net2],
+                         ("host2", 4): [net3],
+                         ("host3", 4): [net4]}
+        error = EtcdException()
+
+        def m_get_affine_blocks(host, version, pool):
+            if host == "host4":
+                raise error
+            return affine_blocks.get((host, version), [])
+
+        def m_release(host, block_cidr):
+            if block_cidr == net2:
+                raise HostAffinityClaimedError()
+            elif block_cidr == net3:
+                raise error
+            elif block_cidr == net4:
+                raise KeyError()
+
+        with patch("pycalico.ipam.BlockHandleReaderWriter._get_affine_blocks",
+                   side_effect=m_get_affine_blocks), \
+             patch("pycalico.ipam.BlockHandleReaderWriter._release_block_affinity",
+                   side_effect=m_release), \
+             patch("pycalico.ipam.RateLimiter", autospec=True) as m_limiter:
+            # Mock call counts are not thread safe, so count the acquires
+            # made by the worker threads explicitly.
+            acquired = []
+            m_limiter.return_value.acquire.side_effect = \
+                lambda: acquired.append(True)
+            summary = self.client.decommission_hosts(
+                ["host1", "host2", "host3", "host4"], max_blocks_per_sec=10)
+
+        m_limiter.assert_called_once_with(10)
+        assert_equal(len(acquired), 4)
+        assert_equal(summary["host1"], {"released": [net1],
+                                        "claimed_by_other": [net2],
+                                        "not_found": [],
+                                        "errors": [],
+                                        "removed": True})
+        assert_equal(summary["host2"], {"released": [],
+                                        "claimed_by_other": [],
+                                        "not_found": [],
+                                        "errors": [(net3, error)],
+                                        "removed": False})
+        assert_equal(summary["host3"], {"released": [],
+                                        "claimed_by_other": [],
+                                        "not_found": [net4],
+                                        "errors": [],
+                                        "removed": True})
+        assert_equal(summary["host4"], {"released": [],
+                                        "claimed_by_other": [],
+                                        "not_found": [],
+                                        "errors": [(None, error)],
+                                        "removed": False})
+        self.m_etcd_client.delete.assert_has_calls(
+            [call("/calico/ipam/v2/host/host1", recursive=True, dir=True),
+             call("/calico/ipam/v2/host/host3", recursive=True, dir=True)],
+            any_order=True)
+        assert_equal(self.m_etcd_client.delete.call_count, 2)
 
     def test_release_pool_affinities(self):
         """
@@ -1375,6 +1716,122 @@ class TestIPAMClient(unittest.TestCase):
                           self.client.release_pool_affinities,
                           IPPool("1.2.0.0/16"))
 
+    def _mock_read_all_blocks(self, blocks):
+        """
+        Mock out the recursive read of all blocks, returning the supplied
+        blocks.
+        """
+        def m_read(path, quorum, recursive):
+            assert quorum
+            assert recursive
+            result = Mock(spec=EtcdResult)
+            leaves = []
+            for block in blocks:
+                if path != _block_datastore_key(block.cidr)[:len(path)]:
+                    continue
+                node = Mock(spec=EtcdResult)
+                node.value = block.to_json()
+                node.key = _block_datastore_key(block.cidr)
+                leaves.append(node)
+            result.leaves = iter(leaves)
+            return result
+        self.m_etcd_client.read.side_effect = m_read
+
+    def _sparse_test_blocks(self):
+        """
+        Return a set of blocks for testing sparse block detection:
+          - host1 has 1 and 2 allocated blocks and a full block
+          - host2 has an empty block and a 1 allocated IPv6 block
+          - a 1 allocated block with no affinity.
+        """
+        def block(cidr, host, num):
+            b = AllocationBlock(IPNetwork(cidr), host, False)
+            b.auto_assign(num, None, {}, host, affinity_check=False)
+            return b
+        return [block("10.0.0.0/26", "host1", 2),
+                block("10.0.0.64/26", "host1", 1),
+                block("10.0.0.128/26", "host1", BLOCK_SIZE),
+                block("10.0.0.192/26", "host2", 0),
+                block("2001:abcd:def0::/122", "host2", 1),
+                block("10.0.1.0/26", None, 1)]
+
+    def test_get_sparse_affine_blocks(self):
+        """
+        Mainline test of get_sparse_affine_blocks().
+        """
+        self._mock_read_all_blocks(self._sparse_test_blocks())
+        sparse = self.client.get_sparse_affine_blocks()
+        assert_dict_equal(sparse, {
+            "host1": [(IPNetwork("10.0.0.64/26"), 1),
+                      (IPNetwork("10.0.0.0/26"), 2)],
+            "host2": [(IPNetwork("2001:abcd:def0::/122"), 1)]
+        })
+
+        # Only count blocks with a single address as sparse.
+        self._mock_read_all_blocks(self._sparse_test_blocks())
+        sparse = self.client.get_sparse_affine_blocks(max_allocated=1)
+        assert_dict_equal(sparse, {
+            "host1": [(IPNetwork("10.0.0.64/26"), 1)],
+            "host2": [(IPNetwork("2001:abcd:def0::/122"), 1)]
+        })
+
+    def test_compact_affine_blocks(self):
+        """
+        Mainline test of compact_affine_blocks().
+        """
+        self._mock_read_all_blocks(self._sparse_test_blocks())
+        with patch("pycalico.ipam.BlockHandleReaderWriter."
+                   "_release_block_affinity") as m_release:
+            sparse, released = self.client.compact_affine_blocks()
+
+        # Only host1 has more than one sparse block.  The least used block is
+        # released.
+        assert_equal(len(sparse), 2)
+        assert_list_equal(released, [("host1", IPNetwork("10.0.0.64/26"))])
+        m_release.assert_called_once_with("host1", IPNetwork("10.0.0.64/26"),
+                                          max_allocated=2)
+
+    def test_compact_affine_blocks_skip(self):
+        """
+        Test compact_affine_blocks() when blocks change before releasing them,
+        and in dry run mode.
+        """
+        self._mock_read_all_blocks(self._sparse_test_blocks())
+        with patch("pycalico.ipam.BlockHandleReaderWriter."
+                   "_release_block_affinity",
+                   side_effect=[BlockNotSparseError, KeyError,
+                                HostAffinityClaimedError]) as m_release:
+            _, released = self.client.compact_affine_blocks(
+                                                        max_sparse_blocks=0)
+            assert_equal(m_release.call_count, 3)
+        assert_list_equal(released, [])
+
+        self._mock_read_all_blocks(self._sparse_test_blocks())
+        with patch("pycalico.ipam.BlockHandleReaderWriter."
+                   "_release_block_affinity") as m_release:
+            sparse, released = self.client.compact_affine_blocks(
+                                                        max_sparse_blocks=0,
+                                                        dry_run=True)
+            assert_equal(m_release.call_count, 0)
+        assert_equal(len(sparse), 2)
+        assert_list_equal(released, [])
+
+    def test_compact_affine_blocks_no_auto_allocate(self):
+        """
+        Test compact_affine_blocks() does not release blocks when block
+        auto-allocation is disabled.
+        """
+        self.client.get_ipam_config.return_value = IPAMConfig(
+                                                auto_allocate_blocks=False,
+                                                strict_affinity=True)
+        self._mock_read_all_blocks(self._sparse_test_blocks())
+        with patch("pycalico.ipam.BlockHandleReaderWriter."
+                   "_release_block_affinity") as m_release:
+            _, released = self.client.compact_affine_blocks(
+                                                        max_sparse_blocks=0)
+            assert_equal(m_release.call_count, 0)
+        assert_list_equal(released, [])
+
     def test_remove_ipam_host(self):
         """
         Mainline test of remove_ipam_host().
@@ -1653,6 +2110,27 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
             "/calico/ipam/v2/host/test_host1/ipv4/block/%s" %
             str(BLOCK_V4_1).replace("/", "-"))
 
+    def test_release_block_affinity_not_sparse(self):
+        """
+        Test _release_block_affinity() with max_allocated set when the block
+        has too many addresses allocated.
+        """
+        block = _test_block_not_empty_v4()
+        m_result0 = Mock(spec=EtcdResult)
+        m_result0.value = block.to_json()
+        self.m_etcd_client.read.return_value = m_result0
+
+        with self.assertRaises(BlockNotSparseError):
+            self.client._release_block_affinity("test_host1", block.cidr,
+                                                max_allocated=1)
+        self.assertEqual(self.m_etcd_client.update.call_count, 0)
+        self.assertEqual(self.m_etcd_client.delete.call_count, 0)
+
+        # With a higher threshold, the block is released.
+        self.client._release_block_affinity("test_host1", block.cidr,
+                                            max_allocated=2)
+        self.m_etcd_client.update.assert_called_once_with(ANY)
+
     @patch("pycalico.ipam._random_subnets_from_cidrs",
            side_effect=gen_subnets)
     def test_new_affine_block_race(self, m_rand_subn):
@@ -2018,6 +2496,28 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         handle2 = AllocationHandle.from_etcd_result(m_result0)
         assert_equal(handle2.decrement_block(block_cidr, amount), 0)
 
+    def test_decrement_handle_blocks(self):
+        """
+        Test _decrement_handle_blocks updates several blocks in one CAS.
+        """
+        handle_id = "handle_id_1"
+        cidr6 = IPNetwork("2001:abcd:def0::/122")
+
+        handle0 = AllocationHandle(handle_id)
+        handle0.increment_block(BLOCK_V4_1, 5)
+        handle0.increment_block(cidr6, 3)
+        m_result0 = Mock(spec=EtcdResult)
+        m_result0.value = handle0.to_json()
+
+        self.m_etcd_client.read.return_value = m_result0
+
+        self.client._decrement_handle_blocks(handle_id, {BLOCK_V4_1: 5,
+                                                         cidr6: 1})
+        self.m_etcd_client.update.assert_called_once_with(m_result0)
+
+        handle2 = AllocationHandle.from_etcd_result(m_result0)
+        assert_dict_equal(handle2.block, {str(cidr6): 2})
+
     def test_decrement_handle_does_not_exist(self):
         """
         Test _decrement_handle when it does not exist.
@@ -2045,12 +2545,13 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         handle0.increment_block(block_cidr, amount)
         m_result0 = Mock(spec=EtcdResult)
         m_result0.value = handle0.to_json()
+        m_result0.key = _handle_datastore_key(handle_id)
         m_result0.modifiedIndex = 55555
 
         self.m_etcd_client.read.return_value = m_result0
 
         self.client._decrement_handle(handle_id, block_cidr, amount)
-        self.m_etcd_client.delete.assert_called_once_with(ANY,
+        self.m_etcd_client.delete.assert_called_once_with(m_result0.key,
                                                           prevIndex=55555)
 
     def test_decrement_handle_corrupt_count(self):
@@ -2088,6 +2589,7 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
             handle0.increment_block(block_cidr, amount)
             m_result0 = Mock(spec=EtcdResult)
             m_result0.value = handle0.to_json()
+            m_result0.key = _handle_datastore_key(handle_id)
             m_result0.modifiedIndex = 55555
             return m_result0
 
@@ -2131,6 +2633,44 @@ class TestBlockHandleReaderWriter(unittest.TestCase):
         self.assertRaises(CASError, self.client._compare_and_swap_handle,
                           handle0)
 
+    def test_sharded_handle_datastore_key(self):
+        """
+        Test handles are spread across shard directories.
+        """
+        key = _sharded_handle_datastore_key("handle_id_1")
+        assert_regexp_matches(
+            key, "^/calico/ipam/v2/handle-shard/[0-9a-f]{2}/handle_id_1$")
+        assert_equal(key, _sharded_handle_datastore_key("handle_id_1"))
+        shards = set(_sharded_handle_datastore_key("handle%s" % ii)
+                     .split("/")[-2] for ii in xrange(1000))
+        assert_true(len(shards) > 200)
+
+    def test_read_handle_sharded_fallback(self):
+        """
+        Test reading a handle with sharding enabled falls back to the legacy
+        layout, and that new handles are written to the sharded layout.
+        """
+        self.client.shard_handles = True
+        handle_id = "handle_id_1"
+        handle0 = AllocationHandle(handle_id)
+        handle0.increment_block(BLOCK_V4_1, 1)
+        m_result0 = Mock(spec=EtcdResult)
+        m_result0.value = handle0.to_json()
+        self.m_etcd_client.read.side_effect = [EtcdKeyNotFound(), m_result0]
+
+        handle = self.client._read_handle(handle_id)
+        assert_equal(handle.db_result, m_result0)
+        self.m_etcd_client.read.assert_has_calls([
+            call(_sharded_handle_datastore_key(handle_id), quorum=True),
+            call(_handle_datastore_key(handle_id), quorum=True)])
+
+        self.m_etcd_client.read.side_effect = EtcdKeyNotFound()
+        assert_raises(KeyError, self.client._read_handle, handle_id)
+        self.client._compare_and_swap_handle(handle0)
+        self.m_etcd_client.write.assert_called_once_with(
+            _sharded_handle_datastore_key(handle_id), handle0.to_json(),
+            prevExist=False)
+
 
 class TestIPAMConfig(unittest.TestCase):
     """
@@ -2232,6 +2772,345 @@ class TestIPAMConfig(unittest.TestCase):
         self.assertEquals(cfg0, cfg1)
 
 
+class TestIPAMClientMemoryEtcd(unittest.TestCase):
+    """
+    End to end tests of the IPAMClient against the in-memory datastore
+    backend.
+    """
+
+    def setUp(self):
+        self.etcd_client = MemoryEtcdClient()
+        self.client = IPAMClient(etcd_client=self.etcd_client)
+        self.client.add_ip_pool(4, IPPool("10.10.0.0/24"))
+
+    def test_assign_release_by_handle(self):
+        """
+        Test assigning across several blocks and releasing by handle.
+        """
+        (v4, v6) = self.client.auto_assign_ips(100, 0, "handle1", {},
+                                               host=TEST_HOST)
+        assert_equal(len(set(v4)), 100)
+        assert_equal(v6, [])
+        assert_true(all(ip in IPNetwork("10.10.0.0/24") for ip in v4))
+        blocks = self.client._get_affine_blocks(TEST_HOST, 4, None)
+        assert_equal(len(blocks), 2)
+
+        assert_equal(
+            sorted(self.client.get_ip_assignments_by_handle("handle1")),
+            sorted(v4))
+        self.client.release_ip_by_handle("handle1")
+        assert_raises(KeyError, self.client.get_ip_assignments_by_handle,
+                      "handle1")
+        assert_raises(EtcdKeyNotFound, self.etcd_client.read,
+                      _handle_datastore_key("handle1"))
+        assert_equal(self.client.get_sparse_affine_blocks(64), {})
+
+    def test_block_state(self):
+        """
+        Test the free addresses recorded for affine blocks are updated as
+        addresses are released, and blocks are forgotten when they lose
+        their affinity.  Non-affine blocks are not recorded.
+        """
+        (v4, _) = self.client.auto_assign_ips(64, 0, "handle1", {},
+                                              host=TEST_HOST)
+        block_cidr, = self.client._get_affine_blocks(TEST_HOST, 4, None)
+        assert_equal(self.client._block_free_addresses, {block_cidr: 0})
+
+        self.client.release_ips(set(v4[:2]))
+        assert_equal(self.client._block_free_addresses, {block_cidr: 2})
+        self.client.release_ip_by_handle("handle1")
+        assert_equal(self.client._block_free_addresses,
+                     {block_cidr: BLOCK_SIZE})
+
+        self.client.auto_assign_ips(1, 0, None, {}, host=TEST_HOST)
+        self.client.release_host_affinities(TEST_HOST)
+        assert_equal(self.client._block_free_addresses, {})
+
+        # With the pool's blocks all claimed by other hosts, another host
+        # assigns from a random non-affine block.
+        self.client.auto_assign_ips(1, 0, None, {}, host="host2")
+        self.client.auto_assign_ips(1, 0, None, {}, host="host3")
+        self.client.auto_assign_ips(1, 0, None, {}, host="host4")
+        other = IPAMClient(etcd_client=self.etcd_client)
+        (v4, _) = other.auto_assign_ips(1, 0, None, {}, host="host5")
+        assert_equal(len(v4), 1)
+        assert_equal(other._block_free_addresses, {})
+
+    def test_read_consistency(self):
+        """
+        Test read-only queries use the requested read consistency, while
+        assignments always use quorum reads.
+        """
+        m_etcd_client = Mock(wraps=self.etcd_client)
+        client = IPAMClient(etcd_client=m_etcd_client,
+                            read_consistency=READ_LOCAL)
+
+        def quorum_reads():
+            reads = [kwargs.get("quorum")
+                     for _, kwargs in m_etcd_client.read.call_args_list]
+            m_etcd_client.read.reset_mock()
+            return reads
+
+        v4, _ = client.auto_assign_ips(1, 0, "handle1", {"a": "b"},
+                                       host=TEST_HOST)
+        assert_not_in(False, quorum_reads())
+        assert_equal(client.get_ip_assignments_by_handle("handle1"), v4)
+        assert_equal(quorum_reads(), [False, False])
+        assert_equal(client.get_assignment_attributes(v4[0]), {"a": "b"})
+        assert_equal(quorum_reads(), [False])
+        assert_equal(client.get_sparse_affine_blocks(), {TEST_HOST: [
+            (get_block_cidr_for_address(v4[0]), 1)]})
+        assert_equal(quorum_reads(), [False, False])
+        client.get_assignment_attributes(v4[0], consistency=READ_QUORUM)
+        assert_equal(quorum_reads(), [True])
+
+        assert_raises(ValueError, client.get_assignment_attributes, v4[0],
+                      consistency="stale")
+        assert_raises(ValueError, IPAMClient, etcd_client=m_etcd_client,
+                      read_consistency="stale")
+
+    def test_export_restore(self):
+        """
+        Test exporting the IPAM data and restoring it into an empty
+        datastore.
+        """
+        self.client.auto_assign_ips(70, 0, "handle1", {"a": "b"},
+                                    host=TEST_HOST)
+        self.client.shard_handles = True
+        self.client.auto_assign_ips(2, 0, "handle2", {}, host="host2")
+        self.client.set_ipam_config = Mock()
+        self.etcd_client.write(IPAM_CONFIG_PATH, IPAMConfig().to_json())
+
+        f = StringIO()
+        count = self.client.export_ipam(f)
+        lines = f.getvalue().splitlines()
+        assert_equal(len(lines), count + 1)
+        assert_equal(json.loads(lines[0]),
+                     {"format": "calico-ipam", "version": 1})
+        keys = [json.loads(line)["key"] for line in lines[1:]]
+        # Config, 3 blocks, 2 handles, 3 affinities.
+        assert_equal(count, 9)
+        assert_equal(keys[0], "config")
+        assert_true(all(key.startswith("host/") for key in keys[-3:]))
+
+        etcd_client = MemoryEtcdClient()
+        client = IPAMClient(etcd_client=etcd_client, shard_handles=True)
+        f.seek(0)
+        assert_equal(client.restore_ipam(f, max_concurrent=4), (9, []))
+        assert_equal(
+            sorted(client.get_ip_assignments_by_handle("handle1")),
+            sorted(self.client.get_ip_assignments_by_handle("handle1")))
+        assert_equal(client.get_ip_assignments_by_handle("handle2"),
+                     self.client.get_ip_assignments_by_handle("handle2"))
+        assert_equal(sorted(client._get_all_affine_blocks("host2")),
+                     sorted(self.client._get_all_affine_blocks("host2")))
+
+        # Existing keys are only written when overwriting.
+        f.seek(0)
+        restored, failed = client.restore_ipam(f)
+        assert_equal(restored, 0)
+        assert_equal(len(failed), 9)
+        assert_true(isinstance(failed[0][1], EtcdAlreadyExist))
+        f.seek(0)
+        assert_equal(client.restore_ipam(f, overwrite=True), (9, []))
+
+    def test_export_restore_compressed(self):
+        """
+        Test exporting to and restoring from a compressed file.
+        """
+        self.client.auto_assign_ips(1, 0, "handle1", {}, host=TEST_HOST)
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode="wb") as f:
+            assert_equal(self.client.export_ipam(f), 3)
+
+        client = IPAMClient(etcd_client=MemoryEtcdClient())
+        buf.seek(0)
+        with gzip.GzipFile(fileobj=buf, mode="rb") as f:
+            assert_equal(client.restore_ipam(f), (3, []))
+        assert_equal(client.get_ip_assignments_by_handle("handle1"),
+                     self.client.get_ip_assignments_by_handle("handle1"))
+
+    def test_restore_invalid(self):
+        """
+        Test restoring invalid exports.
+        """
+        header = '{"format": "calico-ipam", "version": 1}\n'
+        for export in ['{"key": "config", "value": ""}\n',
+                       '{"format": "calico-ipam", "version": 2}\n',
+                       header + 'not json\n',
+                       header + '{"key": "config"}\n',
+                       header + '{"key": "/calico/v1/x", "value": ""}\n',
+                       header + '{"key": "host/../../x", "value": ""}\n']:
+            assert_raises(ValueError, self.client.restore_ipam,
+                          StringIO(export))
+
+    def test_claim_release_affinity(self):
+        """
+        Test claiming and releasing affinity across hosts.
+        """
+        cidr = IPNetwork("10.10.0.0/25")
+        claimed, unclaimed = self.client.claim_affinity(cidr, host="host1")
+        assert_equal(claimed, list(cidr.subnet(26)))
+        assert_equal(unclaimed, [])
+
+        claimed, unclaimed = self.client.claim_affinity(
+            IPNetwork("10.10.0.0/24"), host="host2", continue_on_conflict=True)
+        assert_equal(claimed, [IPNetwork("10.10.0.128/26"),
+                               IPNetwork("10.10.0.192/26")])
+        assert_equal(unclaimed, list(cidr.subnet(26)))
+
+        released, not_claimed, claimed_by_other = \
+            self.client.release_affinity(IPNetwork("10.10.0.0/24"),
+                                         host="host1")
+        assert_equal(released, list(cidr.subnet(26)))
+        assert_equal(not_claimed, [])
+        assert_equal(claimed_by_other, [IPNetwork("10.10.0.128/26"),
+                                        IPNetwork("10.10.0.192/26")])
+
+    def test_decommission_hosts(self):
+        """
+        Test decommissioning hosts removes their affinities and IPAM data,
+        leaving allocated addresses in place.
+        """
+        self.client.claim_affinity(IPNetwork("10.10.0.192/26"), host="host3")
+        (v4, _) = self.client.auto_assign_ips(1, 0, "handle1", {},
+                                              host="host1")
+        self.client.auto_assign_ips(1, 0, "handle2", {}, host="host2")
+
+        summary = self.client.decommission_hosts(["host1", "host2"])
+        for host in ("host1", "host2"):
+            assert_equal(len(summary[host]["released"]), 1)
+            assert_true(summary[host]["removed"])
+            assert_equal(self.client._get_all_affine_blocks(host), [])
+        assert_equal(self.client._get_all_affine_blocks("host3"),
+                     [IPNetwork("10.10.0.192/26")])
+        assert_equal(self.client.get_ip_assignments_by_handle("handle1"), v4)
+
+    def test_assign_ip_conflict(self):
+        """
+        Test assigning a specific address twice.
+        """
+        ip = IPAddress("10.10.0.5")
+        self.client.assign_ip(ip, None, {}, host=TEST_HOST)
+        assert_raises(AlreadyAssignedError, self.client.assign_ip, ip, None,
+                      {}, host=TEST_HOST)
+        assert_equal(self.client.release_ips({ip}), set())
+        assert_equal(self.client.release_ips({ip}), {ip})
+
+    def test_migrate_handles(self):
+        """
+        Test moving handles to the sharded layout, with a sharded client
+        using handles from both layouts.
+        """
+        sharded_client = IPAMClient(etcd_client=self.etcd_client,
+                                    shard_handles=True)
+        (v4, _) = self.client.auto_assign_ips(2, 0, "handle1", {},
+                                              host=TEST_HOST)
+        self.client.auto_assign_ips(1, 0, "handle2", {}, host=TEST_HOST)
+        sharded_client.auto_assign_ips(1, 0, "handle3", {}, host=TEST_HOST)
+
+        # The sharded client reads and updates legacy handles in place, and
+        # writes new handles to the sharded layout.
+        self.etcd_client.read(_handle_datastore_key("handle1"))
+        self.etcd_client.read(_sharded_handle_datastore_key("handle3"))
+        assert_equal(sorted(sharded_client.get_ip_assignments_by_handle(
+            "handle1")), sorted(v4))
+        sharded_client.release_ip_by_handle("handle2")
+        assert_raises(EtcdKeyNotFound, self.etcd_client.read,
+                      _handle_datastore_key("handle2"))
+
+        migrated, failed = sharded_client.migrate_handles()
+        assert_equal(migrated, ["handle1"])
+        assert_equal(failed, [])
+        assert_raises(EtcdKeyNotFound, self.etcd_client.read,
+                      _handle_datastore_key("handle1"))
+        self.etcd_client.read(_sharded_handle_datastore_key("handle1"))
+        assert_equal(sharded_client.migrate_handles(), ([], []))
+
+        sharded_client.release_ip_by_handle("handle1")
+        assert_raises(KeyError, sharded_client.get_ip_assignments_by_handle,
+                      "handle1")
+
+    def test_migrate_handle_conflict(self):
+        """
+        Test migrating a handle that is modified in both layouts while it is
+        moved.
+        """
+        self.client.auto_assign_ips(1, 0, "handle1", {}, host=TEST_HOST)
+        legacy_key = _handle_datastore_key("handle1")
+        sharded_key = _sharded_handle_datastore_key("handle1")
+        real_write = self.etcd_client.write
+
+        def write(key, value, **kwargs):
+            result = real_write(key, value, **kwargs)
+            if key == sharded_key:
+                # Concurrent updates to both copies.
+                real_write(legacy_key, value)
+                real_write(sharded_key, value)
+            return result
+
+        sharded_client = IPAMClient(etcd_client=self.etcd_client,
+                                    shard_handles=True)
+        with patch.object(self.etcd_client, "write", side_effect=write):
+            migrated, failed = sharded_client.migrate_handles()
+        assert_equal(migrated, [])
+        assert_equal([handle_id for handle_id, _ in failed], ["handle1"])
+        assert_true(isinstance(failed[0][1], HandleMigrationError))
+
+
+class TestIPAMClientMemoryEtcdTxn(TestIPAMClientMemoryEtcd):
+    """
+    End to end tests of the IPAMClient against the in-memory datastore
+    backend with transactions, which writes blocks and handles together.
+    """
+
+    def setUp(self):
+        self.etcd_client = MemoryEtcdTxnClient()
+        self.client = IPAMClient(etcd_client=self.etcd_client)
+        self.client.add_ip_pool(4, IPPool("10.10.0.0/24"))
+
+    def test_assign_single_txn(self):
+        """
+        Test assigning and releasing with a handle writes the block and the
+        handle in one transaction.
+        """
+        self.client.auto_assign_ips(1, 0, "handle1", {}, host=TEST_HOST)
+        stats = self.etcd_client.stats.copy()
+        (v4, _) = self.client.auto_assign_ips(1, 0, "handle1", {},
+                                              host=TEST_HOST)
+        assert_equal(self.etcd_client.stats["txn"] - stats["txn"], 1)
+        assert_equal(self.etcd_client.stats["write"], stats["write"])
+
+        stats = self.etcd_client.stats.copy()
+        self.client.release_ips(set(v4))
+        assert_equal(self.etcd_client.stats["txn"] - stats["txn"], 1)
+        assert_equal(self.etcd_client.stats["write"], stats["write"])
+        assert_equal(self.etcd_client.stats["delete"], stats["delete"])
+        assert_equal(len(self.client.get_ip_assignments_by_handle("handle1")),
+                     1)
+
+    def test_txn_conflict(self):
+        """
+        Test a conflicting transaction is retried without adjusting the
+        handle separately.
+        """
+        real_txn = self.etcd_client.txn
+        results = [False]
+
+        def txn(compare, success):
+            if results:
+                return results.pop()
+            return real_txn(compare, success)
+
+        with patch.object(self.etcd_client, "txn", side_effect=txn):
+            self.client.assign_ip(IPAddress("10.10.0.5"), "handle1", {},
+                                  host=TEST_HOST)
+        assert_equal(self.client.get_ip_assignments_by_handle("handle1"),
+                     [IPAddress("10.10.0.5")])
+        handle = self.client._read_handle("handle1")
+        assert_equal(handle.block, {"10.10.0.0/26": 1})
+
+
 class TestUtilityFunctions(unittest.TestCase):
     def test_random_subnets_from_cidr(self):
         for inputlen in xrange(16, 32):
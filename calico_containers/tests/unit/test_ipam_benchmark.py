@@ -0,0 +1,95 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from nose.tools import assert_equal, assert_true
+
+from benchmarks.ipam_benchmark import run_benchmark, main, OPERATIONS, \
+    _percentile
+
+
+class TestIPAMBenchmark(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        """
+        Run a small benchmark and check the results.
+        """
+        results = run_benchmark(hosts=2, workers=2, iterations=20,
+                                pool="10.0.0.0/24", latency=0,
+                                assign_ip_ratio=0.2)
+        assert_equal(sorted(results["operations"].keys()),
+                     sorted(OPERATIONS))
+        assert_equal(results["total"]["count"], 80)
+        assert_equal(sum(op["count"] for op in
+                         results["operations"].values()), 80)
+        assert_true(results["addresses_allocated"] > 0)
+        assert_true(results["datastore"]["ops_per_allocation"] > 0)
+        assert_true(results["total"]["p50_ms"] <=
+                    results["total"]["p99_ms"])
+        # Results must be serializable.
+        json.dumps(results)
+
+    def test_run_benchmark_assign_ip(self):
+        """
+        Test addresses assigned with assign_ip are counted and released.
+        """
+        results = run_benchmark(hosts=1, workers=2, iterations=30,
+                                pool="10.0.0.0/24", latency=0,
+                                assign_ip_ratio=1.0)
+        operations = results["operations"]
+        assign_ip = operations["assign_ip"]
+        assert_equal(operations["auto_assign_ips"]["count"], 0)
+        assert_true(assign_ip["count"] > 0)
+        assert_equal(results["addresses_allocated"],
+                     assign_ip["count"] - sum(assign_ip["errors"].values()))
+        assert_true(operations["release_ips"]["count"] +
+                    operations["release_ip_by_handle"]["count"] > 0)
+        assert_true(results["datastore"]["ops_per_allocation"] > 0)
+
+    def test_run_benchmark_transactions(self):
+        """
+        Run a small benchmark against a datastore with transactions.
+        """
+        results = run_benchmark(hosts=1, workers=2, iterations=10,
+                                pool="10.0.0.0/24", latency=0,
+                                transactions=True)
+        assert_true(results["config"]["transactions"])
+        assert_true(results["datastore"]["txn"] > 0)
+
+    def test_main_output(self):
+        """
+        Test the results are written to the output file.
+        """
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "results.json")
+            main(["--hosts", "1", "--workers", "1", "--iterations", "5",
+                  "--latency-ms", "0", "--output", path])
+            with open(path) as f:
+                results = json.load(f)
+            assert_equal(results["config"]["iterations"], 5)
+            assert_equal(results["total"]["count"], 5)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_percentile(self):
+        values = range(1, 101)
+        assert_equal(_percentile(values, 50), 50)
+        assert_equal(_percentile(values, 99), 99)
+        assert_equal(_percentile([5], 99), 5)
+        assert_equal(_percentile([], 50), 0.0)
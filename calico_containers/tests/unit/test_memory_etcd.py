@@ -0,0 +1,269 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import unittest
+
+from etcd import (EtcdKeyNotFound, EtcdAlreadyExist, EtcdCompareFailed,
+                  EtcdNotFile, EtcdNotDir, EtcdDirNotEmpty,
+                  EtcdEventIndexCleared, EtcdWatchTimedOut)
+from mock import patch
+from nose.tools import assert_equal, assert_raises, assert_true, \
+    assert_false
+
+from pycalico import memory_etcd
+from pycalico.etcdv3 import TXN_PUT, TXN_DELETE
+from pycalico.memory_etcd import MemoryEtcdClient, MemoryEtcdTxnClient
+
+
+class TestMemoryEtcdClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MemoryEtcdClient()
+
+    def test_write_read(self):
+        """
+        Test writing and reading back keys, including the etcd indexes.
+        """
+        result = self.client.write("/calico/v1/a", "value1")
+        assert_equal(result.action, "set")
+        assert_true(result.newKey)
+        created = result.modifiedIndex
+
+        result = self.client.read("/calico/v1/a")
+        assert_equal(result.key, "/calico/v1/a")
+        assert_equal(result.value, "value1")
+        assert_equal(result.modifiedIndex, created)
+        assert_equal(result.createdIndex, created)
+        assert_equal(result.etcd_index, created)
+
+        # Non-string values are stored as strings.  Overwriting a key bumps
+        # its modifiedIndex.
+        result = self.client.write("/calico/v1/a", 10)
+        assert_false(result.newKey)
+        assert_true(result.modifiedIndex > created)
+        assert_equal(self.client.read("/calico/v1/a").value, "10")
+
+        assert_raises(EtcdKeyNotFound, self.client.read, "/calico/v1/b")
+        assert_equal(self.client.stats["write"], 2)
+        assert_equal(self.client.stats["read"], 3)
+
+    def test_directories(self):
+        """
+        Test directory semantics: intermediate directories are created,
+        directories cannot be overwritten by values and values cannot be
+        treated as directories.
+        """
+        self.client.write("/calico/v1/dir/key", "value")
+        assert_true(self.client.read("/calico/v1/dir").dir)
+
+        assert_raises(EtcdNotFile, self.client.write, "/calico/v1/dir", "v")
+        assert_raises(EtcdNotFile, self.client.write, "/calico/v1/dir",
+                      None, dir=True)
+        assert_raises(EtcdNotDir, self.client.write,
+                      "/calico/v1/dir/key/sub", "v")
+        assert_raises(EtcdNotDir, self.client.read, "/calico/v1/dir/key/sub")
+
+        # Directories are only deleted with dir or recursive set.
+        assert_raises(EtcdNotFile, self.client.delete, "/calico/v1/dir")
+        assert_raises(EtcdDirNotEmpty, self.client.delete, "/calico/v1/dir",
+                      dir=True)
+        self.client.delete("/calico/v1/dir", recursive=True)
+        assert_raises(EtcdKeyNotFound, self.client.read, "/calico/v1/dir")
+
+    def test_read_recursive(self):
+        """
+        Test recursive and non-recursive directory reads.
+        """
+        self.client.write("/calico/a/x", "1")
+        self.client.write("/calico/a/y/z", "2")
+        self.client.write("/calico/b", "3")
+
+        result = self.client.read("/calico", recursive=True)
+        assert_equal(sorted((leaf.key, leaf.value) for leaf in result.leaves),
+                     [("/calico/a/x", "1"), ("/calico/a/y/z", "2"),
+                      ("/calico/b", "3")])
+
+        # A non-recursive read lists the immediate children only.
+        result = self.client.read("/calico/", sorted=True)
+        assert_equal([child.key for child in result.leaves],
+                     ["/calico/a", "/calico/b"])
+
+    def test_cas_prev_exist(self):
+        """
+        Test prevExist compare-and-swap.
+        """
+        result = self.client.write("/key", "1", prevExist=False)
+        assert_equal(result.action, "create")
+        assert_raises(EtcdAlreadyExist, self.client.write, "/key", "2",
+                      prevExist=False)
+        assert_raises(EtcdKeyNotFound, self.client.write, "/other", "2",
+                      prevExist=True)
+        result = self.client.write("/key", "2", prevExist=True)
+        assert_equal(result.action, "update")
+        assert_equal(result._prev_node.value, "1")
+        assert_equal(self.client.stats["cas_failures"], 2)
+
+    def test_cas_prev_index_value(self):
+        """
+        Test prevIndex and prevValue compare-and-swap, including via update.
+        """
+        self.client.write("/key", "1")
+        result = self.client.read("/key")
+        index = result.modifiedIndex
+
+        # A concurrent write invalidates the read result.
+        self.client.write("/key", "2")
+        result.value = "3"
+        assert_raises(EtcdCompareFailed, self.client.update, result)
+
+        result = self.client.read("/key")
+        result.value = "3"
+        updated = self.client.update(result)
+        assert_equal(updated.action, "compareAndSwap")
+        assert_true(updated.modifiedIndex > index)
+        assert_equal(updated.createdIndex, result.createdIndex)
+
+        assert_raises(EtcdCompareFailed, self.client.write, "/key", "4",
+                      prevValue="2")
+        self.client.write("/key", "4", prevValue="3")
+        assert_raises(EtcdKeyNotFound, self.client.write, "/none", "4",
+                      prevIndex=1)
+        assert_equal(self.client.stats["cas_failures"], 3)
+
+    def test_delete_cas(self):
+        """
+        Test compare-and-delete.
+        """
+        self.client.write("/key", "1")
+        index = self.client.read("/key").modifiedIndex
+        assert_raises(EtcdCompareFailed, self.client.delete, "/key",
+                      prevIndex=index + 1)
+        assert_raises(EtcdCompareFailed, self.client.delete, "/key",
+                      prevValue="2")
+        result = self.client.delete("/key", prevIndex=index)
+        assert_equal(result.action, "compareAndDelete")
+        assert_raises(EtcdKeyNotFound, self.client.delete, "/key")
+        assert_equal(self.client.stats["cas_failures"], 2)
+
+    def test_append(self):
+        """
+        Test in-order keys created with append.
+        """
+        key1 = self.client.write("/queue", "a", append=True).key
+        key2 = self.client.write("/queue", "b", append=True).key
+        assert_true(key1 < key2)
+        result = self.client.read("/queue", sorted=True)
+        assert_equal([leaf.value for leaf in result.leaves], ["a", "b"])
+
+    def test_ttl(self):
+        """
+        Test keys expire after their TTL.
+        """
+        with patch("pycalico.memory_etcd.time.time", autospec=True) as m_time:
+            m_time.return_value = 1000.0
+            self.client.write("/key", "1", ttl=10)
+            assert_equal(self.client.read("/key").ttl, 10)
+            m_time.return_value = 1011.0
+            assert_raises(EtcdKeyNotFound, self.client.read, "/key")
+
+    def test_latency(self):
+        """
+        Test the injected latency is applied to each operation.
+        """
+        client = MemoryEtcdClient(latency=lambda: 0.5)
+        with patch("pycalico.memory_etcd.time.sleep",
+                   autospec=True) as m_sleep:
+            client.write("/key", "1")
+            client.read("/key")
+            assert_equal(m_sleep.call_count, 2)
+            m_sleep.assert_called_with(0.5)
+
+    def test_watch(self):
+        """
+        Test waiting for changes, from both history and live writes.
+        """
+        first = self.client.write("/calico/a", "1").modifiedIndex
+        self.client.write("/calico/b", "2")
+
+        # Events already in the history are returned immediately.
+        result = self.client.read("/calico", wait=True, waitIndex=first,
+                                  recursive=True)
+        assert_equal((result.key, result.value), ("/calico/a", "1"))
+
+        # Non-recursive watches only match the key itself.
+        assert_raises(EtcdWatchTimedOut, self.client.read, "/calico",
+                      wait=True, waitIndex=first, timeout=0.01)
+
+        def write():
+            self.client.write("/calico/c", "3")
+        thread = threading.Timer(0.01, write)
+        thread.start()
+        result = self.client.read("/calico/c", wait=True, timeout=5)
+        thread.join()
+        assert_equal(result.value, "3")
+
+    def test_watch_index_cleared(self):
+        """
+        Test watching from an index that has left the event history.
+        """
+        with patch.object(memory_etcd, "EVENT_HISTORY_SIZE", 2):
+            client = MemoryEtcdClient()
+        for ii in range(3):
+            client.write("/key", str(ii))
+        assert_raises(EtcdEventIndexCleared, client.read, "/key", wait=True,
+                      waitIndex=1)
+
+
+class TestMemoryEtcdTxnClient(unittest.TestCase):
+
+    def setUp(self):
+        self.client = MemoryEtcdTxnClient()
+
+    def test_txn(self):
+        """
+        Test transactions are applied atomically with a single index, and
+        only if the comparisons succeed.
+        """
+        index = self.client.write("/calico/a", "1").modifiedIndex
+        assert_false(self.client.txn([("/calico/a", index + 1)],
+                                     [(TXN_PUT, "/calico/b", "2")]))
+        assert_false(self.client.txn([("/calico/a", None)], []))
+        assert_raises(EtcdKeyNotFound, self.client.read, "/calico/b")
+
+        assert_true(self.client.txn([("/calico/a", index),
+                                     ("/calico/dir/b", None)],
+                                    [(TXN_DELETE, "/calico/a", None),
+                                     (TXN_PUT, "/calico/dir/b", "2"),
+                                     (TXN_PUT, "/calico/c", "3")]))
+        assert_raises(EtcdKeyNotFound, self.client.read, "/calico/a")
+        b = self.client.read("/calico/dir/b")
+        c = self.client.read("/calico/c")
+        assert_equal((b.value, c.value), ("2", "3"))
+        assert_equal(b.modifiedIndex, c.modifiedIndex)
+        assert_equal(self.client.stats["txn"], 3)
+        assert_equal(self.client.stats["cas_failures"], 2)
+
+        # Changes are seen by watchers.
+        result = self.client.read("/calico/c", wait=True, waitIndex=index + 1)
+        assert_equal(result.value, "3")
+
+    def test_txn_not_applied_on_error(self):
+        """
+        Test an invalid operation prevents the whole transaction.
+        """
+        self.client.write("/calico/dir/a", "1")
+        assert_raises(EtcdNotFile, self.client.txn, [],
+                      [(TXN_PUT, "/calico/b", "2"),
+                       (TXN_PUT, "/calico/dir", "3")])
+        assert_raises(EtcdKeyNotFound, self.client.read, "/calico/b")
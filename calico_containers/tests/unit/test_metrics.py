@@ -0,0 +1,179 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+import urllib2
+
+from netaddr import IPAddress, IPNetwork
+from nose.tools import assert_equal, assert_raises, assert_true, assert_in
+
+from pycalico import metrics
+from pycalico.block import AlreadyAssignedError
+from pycalico.datastore_datatypes import IPPool
+from pycalico.ipam import IPAMClient
+from pycalico.memory_etcd import MemoryEtcdClient
+from pycalico.util import map_concurrently
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.MetricsRegistry()
+        self.registry.enabled = True
+
+    def test_counter(self):
+        """
+        Test counters are recorded per label value and rendered.
+        """
+        counter = self.registry.counter("test_total", "Test count.",
+                                        ("kind",))
+        counter.inc(kind="a")
+        counter.inc(2, kind="a")
+        counter.inc(kind='b"\n')
+        assert_equal(counter.value(kind="a"), 3)
+        assert_equal(self.registry.render(),
+                     '# HELP test_total Test count.\n'
+                     '# TYPE test_total counter\n'
+                     'test_total{kind="a"} 3.0\n'
+                     'test_total{kind="b\\"\\n"} 1.0\n')
+
+    def test_histogram(self):
+        """
+        Test histogram buckets are rendered cumulatively.
+        """
+        histogram = self.registry.histogram("test_seconds", "Test time.",
+                                            buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        assert_equal(histogram.count(), 4)
+        assert_equal(self.registry.render().splitlines()[2:],
+                     ['test_seconds_bucket{le="0.1"} 2',
+                      'test_seconds_bucket{le="1.0"} 3',
+                      'test_seconds_bucket{le="+Inf"} 4',
+                      'test_seconds_sum 5.65',
+                      'test_seconds_count 4'])
+
+    def test_disabled(self):
+        """
+        Test nothing is recorded while the registry is disabled, and that
+        clearing resets the metrics.
+        """
+        counter = self.registry.counter("test_total", "Test count.")
+        histogram = self.registry.histogram("test_seconds", "Test time.")
+        counter.inc()
+        self.registry.enabled = False
+        counter.inc()
+        histogram.observe(1)
+        assert_equal(counter.value(), 1)
+        assert_equal(histogram.count(), 0)
+
+        self.registry.clear()
+        assert_equal(counter.value(), 0)
+
+    def test_write_to_file(self):
+        """
+        Test writing the metrics to a file.
+        """
+        self.registry.counter("test_total", "Test count.").inc()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, "pycalico.prom")
+            metrics.write_to_file(path, registry=self.registry)
+            with open(path) as f:
+                assert_equal(f.read(), self.registry.render())
+            assert_equal(os.listdir(tmp_dir), ["pycalico.prom"])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_http_server(self):
+        """
+        Test serving the metrics over HTTP.
+        """
+        self.registry.counter("test_total", "Test count.").inc()
+        server = metrics.start_http_server(0, registry=self.registry)
+        try:
+            response = urllib2.urlopen("http://127.0.0.1:%s/metrics" %
+                                       server.server_address[1])
+            assert_equal(response.info()["Content-Type"],
+                         metrics.CONTENT_TYPE)
+            assert_equal(response.read(), self.registry.render())
+        finally:
+            server.shutdown()
+            server.server_close()
+
+
+class TestApiMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.REGISTRY.clear()
+        metrics.enable()
+
+    def tearDown(self):
+        metrics.disable()
+        metrics.REGISTRY.clear()
+
+    def test_api_call(self):
+        """
+        Test API calls record their duration and errors, and set the current
+        method for nested calls and worker threads.
+        """
+        def worker(_):
+            return metrics.current_method()
+
+        with metrics.api_call("outer"):
+            with metrics.api_call("inner"):
+                assert_equal(metrics.current_method(), "outer")
+            results = map_concurrently(worker, [1, 2], 2)
+        assert_equal(results, [("outer", None), ("outer", None)])
+        assert_equal(metrics.current_method(), "")
+
+        with assert_raises(ValueError):
+            with metrics.api_call("failing"):
+                raise ValueError()
+        assert_equal(metrics.API_DURATION.count(method="outer"), 1)
+        assert_equal(metrics.API_DURATION.count(method="inner"), 1)
+        assert_equal(metrics.API_ERRORS.value(method="failing",
+                                              error="ValueError"), 1)
+
+    def test_ipam_metrics(self):
+        """
+        Test IPAM operations record allocation, block and error metrics.
+        """
+        client = IPAMClient(etcd_client=MemoryEtcdClient())
+        client.add_ip_pool(4, IPPool(IPNetwork("10.10.0.0/24")))
+
+        v4, _ = client.auto_assign_ips(2, 0, None, {}, host="host1")
+        client.assign_ip(IPAddress("10.10.0.200"), None, {}, host="host1")
+        client.release_ips(set(v4))
+        assert_raises(AlreadyAssignedError, client.assign_ip,
+                      IPAddress("10.10.0.200"), None, {}, host="host1")
+
+        assert_equal(metrics.ADDRESSES_ALLOCATED.value(
+            method="auto_assign_ips", version=4), 2)
+        assert_equal(metrics.ADDRESSES_ALLOCATED.value(
+            method="assign_ip", version=4), 1)
+        assert_equal(metrics.ADDRESSES_RELEASED.value(
+            method="release_ips", version=4), 2)
+        assert_equal(metrics.BLOCKS_CLAIMED.value(
+            method="auto_assign_ips"), 1)
+        assert_equal(metrics.API_ERRORS.value(
+            method="assign_ip", error="AlreadyAssignedError"), 1)
+        assert_true(metrics.API_DURATION.count(method="auto_assign_ips") > 0)
+        assert_in('pycalico_ipam_addresses_allocated_total'
+                  '{method="auto_assign_ips",version="4"} 2.0',
+                  metrics.REGISTRY.render())
@@ -0,0 +1,173 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from nose.tools import assert_equal, assert_raises
+from nose_parameterized import parameterized
+
+from pycalico.selector import parse_selector, SelectorIndex
+
+LABELS = {"role": "db", "env": "prod", "tier": "back"}
+
+
+class TestSelector(unittest.TestCase):
+
+    @parameterized.expand([
+        ("", True),
+        ("all()", True),
+        ("role == 'db'", True),
+        ('role == "web"', False),
+        ("role != 'web'", True),
+        ("missing != 'web'", True),
+        ("has(env)", True),
+        ("!has(env)", False),
+        ("has(missing)", False),
+        ("env in {'prod', 'staging'}", True),
+        ("env in {}", False),
+        ("env not in {'prod'}", False),
+        ("missing not in {'prod'}", True),
+        ("role == 'db' && env == 'test'", False),
+        ("role == 'db' && (env == 'test' || has(tier))", True),
+        ("role == 'web' || !(env == 'test')", True),
+        ("!!has(role)", True),
+        ("has == 'x' || has(has)", False),
+    ])
+    def test_evaluate(self, selector, expected):
+        """
+        Test selectors are parsed and evaluated against labels.
+        """
+        assert_equal(parse_selector(selector).evaluate(LABELS), expected)
+
+    @parameterized.expand([
+        ("role ==",),
+        ("role == db",),
+        ("role 'db'",),
+        ("has(role",),
+        ("(role == 'db'",),
+        ("role == 'db')",),
+        ("role == 'db' &&",),
+        ("env in {'a' 'b'}",),
+        ("env not {'a'}",),
+        ("role == 'db' @",),
+    ])
+    def test_parse_invalid(self, selector):
+        """
+        Test invalid selectors are rejected.
+        """
+        assert_raises(ValueError, parse_selector, selector)
+
+    def test_str(self):
+        """
+        Test parsed selectors are rendered in canonical form, and compare
+        equal when their canonical forms are equal.
+        """
+        selector = parse_selector(
+            "a=='1'&&(b in {'3','2'}||!has(c))&&d not in {'x'}")
+        assert_equal(str(selector),
+                     'a == "1" && (b in {"2", "3"} || !has(c)) && d != "x"')
+        assert_equal(parse_selector(str(selector)), selector)
+        assert_equal(parse_selector(""), parse_selector("all()"))
+
+
+class TestSelectorIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = SelectorIndex()
+        self.endpoints = {
+            "ep1": {"role": "db", "env": "prod"},
+            "ep2": {"role": "db", "env": "test"},
+            "ep3": {"role": "web", "env": "prod"},
+            "ep4": {},
+        }
+        for endpoint_id, labels in self.endpoints.iteritems():
+            self.index.set_endpoint(endpoint_id, labels)
+        self.policies = {
+            "pol1": "role == 'db'",
+            "pol2": "env in {'prod'} && has(role)",
+            "pol3": "role == 'web' || env == 'test'",
+            "pol4": "!has(role)",
+            "pol5": "",
+        }
+        for policy_id, selector in self.policies.iteritems():
+            self.index.set_policy(policy_id, selector)
+
+    def check_index(self):
+        """
+        Check the index agrees with evaluating every selector against every
+        endpoint.
+        """
+        selectors = self.policies.values() + [
+            "role != 'db'", "env not in {'prod', 'test'}", "has(env)",
+            "role == 'db' && env == 'prod'", "role in {'db', 'web'}"]
+        for selector in selectors:
+            parsed = parse_selector(selector)
+            assert_equal(self.index.select_endpoints(selector),
+                         set(endpoint_id for endpoint_id, labels
+                             in self.endpoints.iteritems()
+                             if parsed.evaluate(labels)))
+        for endpoint_id, labels in self.endpoints.iteritems():
+            assert_equal(self.index.policies_for_endpoint(endpoint_id),
+                         set(policy_id for policy_id, selector
+                             in self.policies.iteritems()
+                             if parse_selector(selector).evaluate(labels)))
+
+    def test_select(self):
+        """
+        Test the endpoints matching a selector, and the policies matching an
+        endpoint, are found through the index.
+        """
+        self.check_index()
+        assert_equal(self.index.select_endpoints("role == 'db'"),
+                     {"ep1", "ep2"})
+        assert_equal(self.index.policies_for_endpoint("ep3"),
+                     {"pol2", "pol3", "pol5"})
+        assert_equal(self.index.select_policies({"role": "cache"}),
+                     {"pol5"})
+        assert_raises(KeyError, self.index.policies_for_endpoint, "ep5")
+
+    def test_updates(self):
+        """
+        Test the index is updated as endpoints and policies change.
+        """
+        self.endpoints["ep1"] = {"role": "web"}
+        self.index.set_endpoint("ep1", self.endpoints["ep1"])
+        del self.endpoints["ep2"]
+        self.index.remove_endpoint("ep2")
+        self.index.remove_endpoint("ep2")
+        self.endpoints["ep5"] = {"env": "test", "zone": "a"}
+        self.index.set_endpoint("ep5", self.endpoints["ep5"])
+        self.policies["pol1"] = "zone == 'a'"
+        self.index.set_policy("pol1", self.policies["pol1"])
+        del self.policies["pol4"]
+        self.index.remove_policy("pol4")
+        self.check_index()
+
+        # Nothing is left behind in the inverted indexes.
+        for endpoint_id in list(self.endpoints):
+            self.index.remove_endpoint(endpoint_id)
+        for policy_id in list(self.policies):
+            self.index.remove_policy(policy_id)
+        assert_equal(self.index._label_index, {})
+        assert_equal(self.index._key_index, {})
+        assert_equal(self.index._policy_terms, {})
+        assert_equal(self.index._unindexed_policies, set())
+
+    def test_invalid_policy(self):
+        """
+        Test an invalid policy selector is rejected, leaving the index
+        unchanged.
+        """
+        assert_raises(ValueError, self.index.set_policy, "pol1", "role ==")
+        assert_equal(self.index.select_policies({"role": "db"}),
+                     {"pol1", "pol5"})
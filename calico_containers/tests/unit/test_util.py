@@ -17,6 +17,8 @@
 
 
 from subprocess import CalledProcessError, check_output
+import threading
+import time
 import unittest
 from mock import patch
 
@@ -631,3 +633,71 @@ class TestUtil(unittest.TestCase):
         m_check_output.return_value = output
         self.assertEqual(util.get_ipv6_link_local("eth1"), "fd80:24e2:f998:72d7::2")
         m_check_output.assert_called_with(["ip", "-6", "addr", "show", "dev", "eth1"])
+
+    def test_map_concurrently(self):
+        """
+        Test map_concurrently returns results and errors in item order.
+        """
+        def fn(item):
+            if item % 3 == 0:
+                raise ValueError(item)
+            return item * 2
+
+        for max_workers in (1, 4):
+            results = util.map_concurrently(fn, range(10), max_workers)
+            self.assertEqual(len(results), 10)
+            for item, (result, error) in enumerate(results):
+                if item % 3 == 0:
+                    self.assertIsNone(result)
+                    self.assertIsInstance(error, ValueError)
+                    self.assertEqual(error.args, (item,))
+                else:
+                    self.assertEqual(result, item * 2)
+                    self.assertIsNone(error)
+
+    def test_map_concurrently_bounded(self):
+        """
+        Test map_concurrently never exceeds max_workers concurrent calls.
+        """
+        lock = threading.Lock()
+        state = {"active": 0, "max": 0}
+
+        def fn(item):
+            with lock:
+                state["active"] += 1
+                state["max"] = max(state["max"], state["active"])
+            time.sleep(0.01)
+            with lock:
+                state["active"] -= 1
+            return item
+
+        results = util.map_concurrently(fn, range(20), 3)
+        self.assertEqual([r for r, _ in results], range(20))
+        self.assertTrue(1 < state["max"] <= 3)
+
+    def test_map_concurrently_no_items(self):
+        """
+        Test map_concurrently with no items.
+        """
+        self.assertEqual(util.map_concurrently(str, [], 5), [])
+
+    @patch("pycalico.util.time.sleep", autospec=True)
+    @patch("pycalico.util.time.time", autospec=True)
+    def test_rate_limiter(self, m_time, m_sleep):
+        """
+        Test RateLimiter spaces out operations at the configured rate.
+        """
+        m_time.return_value = 100.0
+        limiter = util.RateLimiter(4)
+        limiter.acquire()
+        self.assertEqual(m_sleep.call_count, 0)
+        limiter.acquire()
+        m_sleep.assert_called_once_with(0.25)
+        limiter.acquire()
+        m_sleep.assert_called_with(0.5)
+
+        # After an idle period, the next operation proceeds immediately.
+        m_sleep.reset_mock()
+        m_time.return_value = 200.0
+        limiter.acquire()
+        self.assertEqual(m_sleep.call_count, 0)
@@ -0,0 +1,89 @@
+# Copyright (c) 2016 Tigera, Inc. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import Queue
+import unittest
+
+from etcd import EtcdEventIndexCleared, EtcdException
+from mock import patch
+from nose.tools import assert_equal, assert_true
+
+from pycalico.memory_etcd import MemoryEtcdClient
+from pycalico.watch import TreeWatcher
+
+
+class TestTreeWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.etcd_client = MemoryEtcdClient()
+        self.events = Queue.Queue()
+        self.watcher = TreeWatcher(
+            self.etcd_client, "/calico/tree/",
+            lambda items: self.events.put(("load", items)),
+            lambda *change: self.events.put(change),
+            watch_timeout=0.05, retry_delay=0.01)
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.watcher.join(5)
+
+    def next_event(self):
+        return self.events.get(timeout=5)
+
+    def test_load_and_watch(self):
+        """
+        Test the subtree is loaded, and changes are then reported in order.
+        """
+        self.etcd_client.write("/calico/tree/a", "1")
+        self.etcd_client.write("/calico/other", "1")
+        self.watcher.start()
+        assert_equal(self.next_event(), ("load", [("/calico/tree/a", "1")]))
+
+        self.etcd_client.write("/calico/tree/a", "2")
+        self.etcd_client.write("/calico/other", "2")
+        self.etcd_client.write("/calico/tree/b/c", "3")
+        self.etcd_client.delete("/calico/tree/b", recursive=True)
+        assert_equal(self.next_event(), ("set", "/calico/tree/a", "2", False))
+        assert_equal(self.next_event(),
+                     ("set", "/calico/tree/b/c", "3", False))
+        assert_equal(self.next_event(),
+                     ("delete", "/calico/tree/b", None, True))
+
+    def test_missing_tree(self):
+        """
+        Test watching a subtree that does not exist yet.
+        """
+        self.watcher.start()
+        assert_equal(self.next_event(), ("load", None))
+        self.etcd_client.write("/calico/tree/a", "1")
+        assert_equal(self.next_event(), ("set", "/calico/tree/a", "1", False))
+
+    def test_reload(self):
+        """
+        Test the subtree is reloaded when the watch falls behind or fails.
+        """
+        self.etcd_client.write("/calico/tree/a", "1")
+        read = self.etcd_client.read
+        errors = [EtcdEventIndexCleared(), EtcdException()]
+
+        def m_read(key, **kwargs):
+            if kwargs.get("wait") and errors:
+                raise errors.pop(0)
+            return read(key, **kwargs)
+
+        with patch.object(self.etcd_client, "read", m_read):
+            self.watcher.start()
+            for _ in range(3):
+                assert_equal(self.next_event(),
+                             ("load", [("/calico/tree/a", "1")]))
+            assert_true(not errors)